@@ -1,23 +1,210 @@
-from passlib.context import CryptContext
-from jose import JWTError, jwt
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Optional
+import asyncio
+import base64
+import binascii
+import hashlib
+import hmac
+import json
 import os
+import threading
+import time
+
+from metrics import registry
+import timing
 
 # JWT settings
 SECRET_KEY = os.getenv("SECRET_KEY", "secret-key-change-in-production")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# Verify HS256 tokens with the specialized verifier below instead of python-jose
+JWT_FAST_PATH = os.getenv("JWT_FAST_PATH", "true").lower() in ("1", "true", "yes")
+JWT_VERIFIED_CACHE_SIZE = int(os.getenv("JWT_VERIFIED_CACHE_SIZE", 4096))
+
+# Password hashing pool settings
+PASSWORD_HASH_EXECUTOR = os.getenv("PASSWORD_HASH_EXECUTOR", "thread")  # "thread" or "process"
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", min(4, os.cpu_count() or 1)))
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", 64))
+
+_pwd_context = None
+
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+def get_pwd_context():
+    """passlib and bcrypt are imported on first use, since only the /auth routes need them."""
+    global _pwd_context
+    if _pwd_context is None:
+        from passlib.context import CryptContext
+        _pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    return _pwd_context
+
+hash_queue_wait = registry.histogram(
+    "password_hash_queue_wait_seconds", "Time a hashing job waited for a free worker", ["operation"]
+)
+hash_duration = registry.histogram(
+    "password_hash_duration_seconds", "Time spent inside bcrypt", ["operation"]
+)
+hash_rejected = registry.counter(
+    "password_hash_rejected_total", "Hashing jobs rejected because the pool was saturated", ["operation"]
+)
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify a password against its hash."""
-    return pwd_context.verify(plain_password, hashed_password)
+    return get_pwd_context().verify(plain_password, hashed_password)
 
 def get_password_hash(password: str) -> str:
     """Hash a password."""
-    return pwd_context.hash(password)
+    return get_pwd_context().hash(password)
+
+class HashPoolSaturated(Exception):
+    """Raised when the password hashing queue is full."""
+
+
+def _timed_call(func, *args):
+    """Run func in a worker and report when it actually started and finished."""
+    started = time.perf_counter()
+    result = func(*args)
+    return result, started, time.perf_counter()
+
+
+class PasswordHashPool:
+    """Bounded executor that keeps bcrypt off the event loop."""
+
+    def __init__(self, kind: str = "thread", workers: int = 4, max_queue: int = 64):
+        self.kind = kind
+        self.workers = workers
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self._executor: Optional[Executor] = None
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="password-hash"
+                )
+        return self._executor
+
+    async def run(self, operation: str, func, *args):
+        """Run a hashing function in the pool, rejecting work once the queue is full."""
+        if self.in_flight >= self.workers + self.max_queue:
+            hash_rejected.inc(operation)
+            raise HashPoolSaturated(f"Password hashing pool is saturated ({self.in_flight} in flight)")
+        self.in_flight += 1
+        submitted = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            result, started, finished = await loop.run_in_executor(
+                self.executor, _timed_call, func, *args
+            )
+        finally:
+            self.in_flight -= 1
+        # perf_counter is CLOCK_MONOTONIC on Linux, so it is comparable across worker processes
+        hash_queue_wait.observe(max(started - submitted, 0.0), operation)
+        hash_duration.observe(finished - started, operation)
+        # Includes queueing, which is part of what the request waited for
+        timing.add("bcrypt", finished - submitted)
+        return result
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+hash_pool = PasswordHashPool(PASSWORD_HASH_EXECUTOR, PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_QUEUE)
+registry.gauge(
+    "password_hash_in_flight", "Hashing jobs running or queued", lambda: hash_pool.in_flight
+)
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """Verify a password in the hashing pool."""
+    return await hash_pool.run("verify", verify_password, plain_password, hashed_password)
+
+
+async def get_password_hash_async(password: str) -> str:
+    """Hash a password in the hashing pool."""
+    return await hash_pool.run("hash", get_password_hash, password)
+
+
+def _b64url_decode(segment: str) -> bytes:
+    return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
+
+
+class HS256Verifier:
+    """Verifies the HS256 tokens this app issues, checking only `sub` and `exp`.
+
+    The HMAC key schedule is computed once and copied per token, signatures
+    are compared in constant time, and recently verified tokens are kept in
+    a small LRU until they expire so repeats skip the HMAC and JSON work.
+    """
+
+    def __init__(self, secret: str, cache_size: int = 4096, clock=time.time):
+        self._mac = hmac.new(secret.encode(), digestmod=hashlib.sha256)
+        self.cache_size = cache_size
+        self.clock = clock
+        # token -> claims; tokens are only cached once verified, and dropped at exp
+        self._verified: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._headers = {}  # encoded header -> whether it is an acceptable HS256 header
+
+    def _header_ok(self, segment: str) -> bool:
+        accepted = self._headers.get(segment)
+        if accepted is None:
+            try:
+                header = json.loads(_b64url_decode(segment))
+            except (ValueError, binascii.Error):
+                return False
+            accepted = isinstance(header, dict) and header.get("alg") == "HS256" and header.get("typ", "JWT") == "JWT"
+            if len(self._headers) < 16:  # Only a handful of distinct valid headers exist
+                self._headers[segment] = accepted
+        return accepted
+
+    def decode(self, token: str) -> Optional[dict]:
+        """Return the token's claims, or None if it is malformed, forged, expired or has no sub."""
+        now = self.clock()
+        with self._lock:
+            claims = self._verified.get(token)
+            if claims is not None:
+                if claims["exp"] > now:
+                    self._verified.move_to_end(token)
+                    return claims
+                del self._verified[token]
+
+        header, dot, rest = token.partition(".")
+        payload, dot2, signature = rest.partition(".")
+        if not dot or not dot2 or "." in signature or not self._header_ok(header):
+            return None
+        mac = self._mac.copy()
+        mac.update(token[:len(header) + 1 + len(payload)].encode())
+        expected = base64.urlsafe_b64encode(mac.digest()).rstrip(b"=")
+        if not hmac.compare_digest(expected, signature.encode()):
+            return None
+        try:
+            claims = json.loads(_b64url_decode(payload))
+        except (ValueError, binascii.Error):
+            return None
+        if not isinstance(claims, dict) or not isinstance(claims.get("sub"), str):
+            return None
+        exp = claims.get("exp")
+        if not isinstance(exp, (int, float)) or exp <= now:
+            return None
+
+        if self.cache_size > 0:
+            with self._lock:
+                self._verified[token] = claims
+                while len(self._verified) > self.cache_size:
+                    self._verified.popitem(last=False)
+        return claims
+
+
+hs256_verifier = HS256Verifier(SECRET_KEY, JWT_VERIFIED_CACHE_SIZE)
+
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """Create a JWT access token."""
@@ -27,16 +214,32 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
     to_encode.update({"exp": expire})
+    from jose import jwt  # python-jose and cryptography load on first use
+
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def verify_token(token: str) -> Optional[str]:
-    """Verify a JWT token and return the username."""
+def decode_token(token: str) -> Optional[dict]:
+    """Verify a JWT token and return its claims."""
+    if JWT_FAST_PATH and ALGORITHM == "HS256":
+        return hs256_verifier.decode(token)
+    return decode_token_jose(token)
+
+def decode_token_jose(token: str) -> Optional[dict]:
+    """Verify a JWT token with python-jose's generic decoder."""
+    from jose import JWTError, jwt
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            return None
-        return username
     except JWTError:
         return None
+    if payload.get("sub") is None:
+        return None
+    return payload
+
+def verify_token(token: str) -> Optional[str]:
+    """Verify a JWT token and return the username."""
+    payload = decode_token(token)
+    if payload is None:
+        return None
+    return payload["sub"]
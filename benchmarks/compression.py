@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Storage size and request latency of notes with and without compression.
+
+Builds a corpus from this repository's own Markdown and Python files: many
+short notes, some tens of KB long and a few multi-MB documents. It seeds one
+SQLite database per NOTE_COMPRESSION setting, each in a fresh interpreter, and
+reports the database file size. It then times GET /notes?limit=N and GET
+/notes/{id} for the largest note in-process, with each Accept-Encoding, and
+reports response bytes and the transfer time those bytes would take at
+--mbps.
+
+    python benchmarks/compression.py --notes 300 --large 3 --requests 50
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load_test import PASSWORD, percentile  # noqa: E402
+
+
+def build_corpus(notes: int, large: int, seed: int = 7) -> list:
+    """(title, content) pairs cut from the repository's text: short, medium and multi-MB notes."""
+    text = ""
+    for path in sorted(glob.glob(os.path.join(ROOT, "*.md")) + glob.glob(os.path.join(ROOT, "*.py"))):
+        with open(path, encoding="utf-8") as source:
+            text += source.read() + "\n"
+    rng = random.Random(seed)
+
+    def excerpt(size: int) -> str:
+        parts = []
+        while sum(map(len, parts)) < size:
+            start = rng.randrange(len(text))
+            parts.append(text[start:start + min(size, 20000)])
+        return "".join(parts)[:size]
+
+    corpus = []
+    for index in range(notes):
+        size = rng.choice((300, 800, 2000)) if index % 10 else rng.choice((20000, 60000))
+        corpus.append((f"Note {index}", excerpt(size)))
+    for index in range(large):
+        corpus.append((f"Document {index}", excerpt(2 * 1024 * 1024)))
+    return corpus
+
+
+def seed(database_url: str, corpus: list) -> None:
+    os.environ["DATABASE_URL"] = database_url
+    sys.path.insert(0, ROOT)
+    from sqlalchemy import insert
+    from auth import get_password_hash
+    from database import Note, User, create_tables, engine
+
+    create_tables()
+    with engine.begin() as connection:
+        user_id = connection.execute(
+            insert(User).values(username="bench0", email="bench0@example.com",
+                                hashed_password=get_password_hash(PASSWORD))
+        ).inserted_primary_key[0]
+        connection.execute(insert(Note), [
+            {"title": title, "content": content, "owner_id": user_id} for title, content in corpus
+        ])
+    with engine.connect() as connection:
+        connection.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        connection.exec_driver_sql("VACUUM")
+
+
+async def measure(http, headers, url: str, encoding: str, requests: int, mbps: float) -> dict:
+    headers = {**headers, "Accept-Encoding": encoding}
+    for _ in range(3):  # Warm-up: caches, compiled SQL
+        await http.get(url, headers=headers)
+    latencies = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        response = await http.get(url, headers=headers)
+        latencies.append(time.perf_counter() - start)
+        response.raise_for_status()
+    latencies.sort()
+    wire_bytes = int(response.headers["content-length"])
+    return {
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "response_bytes": wire_bytes,
+        "transfer_ms": round(wire_bytes * 8 / (mbps * 1e6) * 1000, 2),
+    }
+
+
+async def run_requests(args) -> dict:
+    import httpx
+    import compression
+    from main import app
+
+    encodings = ["identity", "gzip"] + (["br"] if compression.brotli is not None else [])
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+        login = await http.post("/auth/login", json={"username": "bench0", "password": PASSWORD})
+        headers = {"Authorization": f"Bearer {login.json()['access_token']}"}
+        last = (await http.get("/notes/summary?limit=1000", headers=headers)).json()[-1]["id"]
+        for label, url in ((f"GET /notes?limit={args.page}", f"/notes?limit={args.page}"),
+                           ("GET /notes/{id} (2 MB)", f"/notes/{last}")):
+            results[label] = {
+                encoding: await measure(http, headers, url, encoding, args.requests, args.mbps)
+                for encoding in encodings
+            }
+    return results
+
+
+def child(args) -> dict:
+    """One NOTE_COMPRESSION setting, measured in this (fresh) interpreter."""
+    directory = tempfile.mkdtemp(prefix="notes-bench-")
+    path = os.path.join(directory, "bench.db")
+    start = time.perf_counter()
+    seed(f"sqlite:///{path}", build_corpus(args.notes, args.large))
+    return {
+        "seed_seconds": round(time.perf_counter() - start, 2),
+        "database_bytes": os.path.getsize(path),
+        "requests": asyncio.run(run_requests(args)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--notes", type=int, default=300)
+    parser.add_argument("--large", type=int, default=3, help="Multi-MB documents added to the corpus")
+    parser.add_argument("--page", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--mbps", type=float, default=50.0, help="Link speed for the transfer_ms estimate")
+    parser.add_argument("--codecs", default="none,zlib", help="NOTE_COMPRESSION settings to compare")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(child(args)))
+        return
+
+    corpus = build_corpus(args.notes, args.large)
+    result = {
+        "notes": len(corpus),
+        "corpus_bytes": sum(len(content.encode()) for _, content in corpus),
+        "python": sys.version.split()[0],
+        "codecs": {},
+    }
+    for codec in args.codecs.split(","):
+        env = {**os.environ, "NOTE_COMPRESSION": codec, "RATE_LIMIT_ENABLED": "false",
+               "SECRET_KEY": os.getenv("SECRET_KEY", "benchmark-secret")}
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", "--notes", str(args.notes),
+             "--large", str(args.large), "--page", str(args.page), "--requests", str(args.requests),
+             "--mbps", str(args.mbps)],
+            env=env, cwd=ROOT, check=True, capture_output=True, text=True,
+        ).stdout
+        result["codecs"][codec] = json.loads(output.strip().splitlines()[-1])
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
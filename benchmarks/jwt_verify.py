@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark: JWT verification per call, python-jose vs the HS256 fast path.
+
+    python benchmarks/jwt_verify.py --number 20000
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SECRET_KEY", "benchmark-secret")
+
+from auth import SECRET_KEY, HS256Verifier, create_access_token, decode_token_jose  # noqa: E402
+
+
+def per_call_us(func, number: int, repeat: int = 5) -> float:
+    return round(min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    token = create_access_token({"sub": "benchmark-user"}, timedelta(minutes=30))
+    uncached = HS256Verifier(SECRET_KEY, cache_size=0)
+    cached = HS256Verifier(SECRET_KEY, cache_size=1024)
+    assert uncached.decode(token) == decode_token_jose(token)
+
+    result = {
+        "jose_decode_us": per_call_us(lambda: decode_token_jose(token), args.number),
+        "hs256_verify_us": per_call_us(lambda: uncached.decode(token), args.number),
+        "hs256_cached_us": per_call_us(lambda: cached.decode(token), args.number),
+        "python": sys.version.split()[0],
+    }
+    result["speedup_uncached"] = round(result["jose_decode_us"] / result["hs256_verify_us"], 1)
+    result["speedup_cached"] = round(result["jose_decode_us"] / result["hs256_cached_us"], 1)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+Reproducible load test for the Notes API.
+
+Seeds a throwaway database with N users and M notes each, then drives a
+mixed workload against the real `main.app`, either in-process through
+httpx's ASGI transport or over HTTP against a uvicorn subprocess. Reports
+throughput and p50/p95/p99 latency per endpoint, and can save or compare
+JSON baselines so regressions show up as numbers.
+
+    python benchmarks/load_test.py --workload read --save benchmarks/baselines/read.json
+    python benchmarks/load_test.py --workload read --compare benchmarks/baselines/read.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Requests per workload, as (weight, operation) pairs
+WORKLOADS = {
+    "login": [(1, "login")],
+    "read": [(8, "list_notes"), (2, "get_note")],
+    "write": [(1, "get_note"), (4, "update_note")],
+    "churn": [(1, "create_note"), (1, "delete_note")],
+    "mixed": [(1, "login"), (6, "list_notes"), (2, "get_note"), (2, "update_note"),
+              (1, "create_note"), (1, "delete_note")],
+}
+
+PASSWORD = "benchmark-password"
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def seed_database(database_url: str, users: int, notes_per_user: int, content_bytes: int = 0) -> List[dict]:
+    """Create users and notes directly through the sync engine; bcrypt runs once."""
+    os.environ["DATABASE_URL"] = database_url
+    sys.path.insert(0, ROOT)
+    from sqlalchemy import insert
+    from auth import get_password_hash
+    from database import User, Note, create_tables, engine
+
+    create_tables()
+    hashed = get_password_hash(PASSWORD)
+    accounts = []
+    with engine.begin() as connection:
+        for index in range(users):
+            username = f"bench{index}"
+            user_id = connection.execute(
+                insert(User).values(username=username, email=f"{username}@example.com",
+                                    hashed_password=hashed)
+            ).inserted_primary_key[0]
+            connection.execute(insert(Note), [
+                {"title": f"Note {n}",
+                 "content": (f"Benchmark note {n} " * max(20, content_bytes // 16 + 1))[:content_bytes or None],
+                 "owner_id": user_id}
+                for n in range(notes_per_user)
+            ])
+            accounts.append({"username": username, "id": user_id})
+    engine.dispose()
+    return accounts
+
+
+class VirtualClient:
+    """One simulated user: logs in, remembers its note ids and versions."""
+
+    def __init__(self, http, username: str, stats: Dict[str, List[float]], errors: Dict[str, int]):
+        self.http = http
+        self.username = username
+        self.stats = stats
+        self.errors = errors
+        self.headers = {}
+        self.versions: Dict[int, int] = {}
+
+    async def call(self, label: str, method: str, url: str, expected=(200,), **kwargs):
+        start = time.perf_counter()
+        response = await self.http.request(method, url, **kwargs)
+        self.stats[label].append(time.perf_counter() - start)
+        if response.status_code not in expected:
+            self.errors[f"{label} {response.status_code}"] += 1
+        return response
+
+    async def login(self):
+        response = await self.call("POST /auth/login", "POST", "/auth/login",
+                                   json={"username": self.username, "password": PASSWORD})
+        if response.status_code == 200:
+            self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    async def list_notes(self):
+        response = await self.call("GET /notes", "GET", "/notes?limit=100", headers=self.headers)
+        if response.status_code == 200:
+            for note in response.json():
+                self.versions.setdefault(note["id"], note["version"])
+
+    def _pick_note(self):
+        return random.choice(list(self.versions)) if self.versions else None
+
+    async def get_note(self):
+        note_id = self._pick_note()
+        if note_id is None:
+            return await self.list_notes()
+        response = await self.call("GET /notes/{id}", "GET", f"/notes/{note_id}",
+                                   expected=(200, 404), headers=self.headers)
+        if response.status_code == 200:
+            self.versions[note_id] = response.json()["version"]
+
+    async def update_note(self):
+        note_id = self._pick_note()
+        if note_id is None:
+            return await self.list_notes()
+        # Occasionally send a stale version on purpose to exercise the 409 path
+        version = self.versions[note_id] - (1 if random.random() < 0.1 else 0)
+        response = await self.call(
+            "PUT /notes/{id}", "PUT", f"/notes/{note_id}", expected=(200, 404, 409),
+            headers=self.headers, json={"content": f"edited {time.time()}", "version": version},
+        )
+        if response.status_code == 200:
+            self.versions[note_id] = response.json()["version"]
+        elif response.status_code == 409 and "X-Current-Version" in response.headers:
+            self.versions[note_id] = int(response.headers["X-Current-Version"])
+        elif response.status_code == 404:
+            self.versions.pop(note_id, None)
+
+    async def create_note(self):
+        response = await self.call("POST /notes", "POST", "/notes", expected=(201,), headers=self.headers,
+                                   json={"title": "churn", "content": "churn " * 50})
+        if response.status_code == 201:
+            self.versions[response.json()["id"]] = 1
+
+    async def delete_note(self):
+        note_id = self._pick_note()
+        if note_id is None:
+            return await self.create_note()
+        await self.call("DELETE /notes/{id}", "DELETE", f"/notes/{note_id}", expected=(204, 404),
+                        headers=self.headers)
+        self.versions.pop(note_id, None)
+
+
+async def run_workload(http, accounts, workload: str, concurrency: int, requests: int) -> dict:
+    stats: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    weights, operations = zip(*WORKLOADS[workload])
+    clients = [VirtualClient(http, accounts[i % len(accounts)]["username"], stats, errors)
+               for i in range(concurrency)]
+    # Warm-up is not measured: every client logs in and learns its notes
+    for client in clients:
+        await client.login()
+        await client.list_notes()
+    stats.clear()
+    errors.clear()
+
+    remaining = requests
+
+    async def worker(client: VirtualClient):
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            operation = random.choices(operations, weights)[0]
+            await getattr(client, operation)()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(client) for client in clients))
+    elapsed = time.perf_counter() - started
+
+    endpoints = {}
+    for label, samples in sorted(stats.items()):
+        samples.sort()
+        endpoints[label] = {
+            "count": len(samples),
+            "throughput_rps": round(len(samples) / elapsed, 1),
+            "p50_ms": round(percentile(samples, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(samples, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(samples, 0.99) * 1000, 2),
+        }
+    return {
+        "workload": workload,
+        "concurrency": concurrency,
+        "requests": requests,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(sum(len(s) for s in stats.values()) / elapsed, 1),
+        "endpoints": endpoints,
+        "errors": dict(errors),
+    }
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def run(args) -> dict:
+    import httpx
+
+    accounts = seed_database(args.database_url, args.users, args.notes)
+    if args.mode == "asgi":
+        from main import app
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+            return await run_workload(http, accounts, args.workload, args.concurrency, args.requests)
+
+    port = _free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning", "--workers", str(args.workers)],
+        # Tables were created by seed_database, so workers skip schema setup like under start.py
+        cwd=ROOT, env={**os.environ, "DATABASE_URL": args.database_url, "NOTES_SCHEMA_READY": "1"},
+    )
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits) as http:
+            for _ in range(100):
+                try:
+                    await http.get("/health")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+            return await run_workload(http, accounts, args.workload, args.concurrency, args.requests)
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> List[str]:
+    """List endpoints whose p95 or throughput regressed by more than tolerance."""
+    regressions = []
+    for label, current in result["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(label)
+        if not previous:
+            continue
+        if current["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{label}: p95 {previous['p95_ms']}ms -> {current['p95_ms']}ms")
+        if current["throughput_rps"] < previous["throughput_rps"] * (1 - tolerance):
+            regressions.append(
+                f"{label}: throughput {previous['throughput_rps']} -> {current['throughput_rps']} rps"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workload", choices=sorted(WORKLOADS), default="mixed")
+    parser.add_argument("--mode", choices=["asgi", "uvicorn"], default="asgi")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--notes", type=int, default=200, help="notes seeded per user")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes (uvicorn mode)")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--database-url", help="defaults to a fresh SQLite file in a temp dir")
+    parser.add_argument("--save", help="write the result as a JSON baseline")
+    parser.add_argument("--compare", help="compare against a JSON baseline and exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    if not args.database_url:
+        args.database_url = f"sqlite:///{tempfile.mkdtemp(prefix='notes-bench-')}/bench.db"
+    os.environ.setdefault("SECRET_KEY", "benchmark-secret")
+
+    result = asyncio.run(run(args))
+    result["mode"] = args.mode
+    result["workers"] = args.workers if args.mode == "uvicorn" else 1
+    result["host"] = {"python": sys.version.split()[0], "cpu_count": os.cpu_count()}
+    print(json.dumps(result, indent=2))
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as handle:
+            json.dump(result, handle, indent=2)
+            handle.write("\n")
+    if args.compare:
+        with open(args.compare) as handle:
+            regressions = compare(result, json.load(handle), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
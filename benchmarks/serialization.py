@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+CPU cost of serializing note pages, with and without FAST_JSON_RESPONSES.
+
+Seeds one user with notes of a given size, then calls GET /notes?limit=100
+and GET /notes/{id} in-process and reports process CPU time and wall time
+per request for the pydantic response_model path and the fast path.
+
+    python benchmarks/serialization.py --content-bytes 4000 --requests 300
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load_test import PASSWORD, seed_database  # noqa: E402
+
+
+async def measure(http, headers, url: str, requests: int) -> dict:
+    for _ in range(10):  # Warm-up: caches, compiled SQL
+        await http.get(url, headers=headers)
+    cpu, wall = time.process_time(), time.perf_counter()
+    for _ in range(requests):
+        response = await http.get(url, headers=headers)
+        response.raise_for_status()
+    cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+    return {
+        "cpu_ms_per_request": round(cpu / requests * 1000, 3),
+        "wall_ms_per_request": round(wall / requests * 1000, 3),
+        "response_bytes": len(response.content),
+    }
+
+
+async def run(args) -> dict:
+    import httpx
+    import fastjson
+    from main import app
+
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+        login = await http.post("/auth/login", json={"username": "bench0", "password": PASSWORD})
+        headers = {"Authorization": f"Bearer {login.json()['access_token']}"}
+        first_id = (await http.get("/notes?limit=1", headers=headers)).json()[0]["id"]
+        for label, url in (("GET /notes?limit=100", "/notes?limit=100"), ("GET /notes/{id}", f"/notes/{first_id}")):
+            results[label] = {}
+            for mode, enabled in (("response_model", False), ("fast", True)):
+                fastjson.FAST_JSON_RESPONSES = enabled
+                results[label][mode] = await measure(http, headers, url, args.requests)
+            before = results[label]["response_model"]["cpu_ms_per_request"]
+            after = results[label]["fast"]["cpu_ms_per_request"]
+            results[label]["cpu_speedup"] = round(before / after, 2) if after else None
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--notes", type=int, default=200)
+    parser.add_argument("--content-bytes", type=int, default=4000)
+    parser.add_argument("--requests", type=int, default=300)
+    args = parser.parse_args()
+
+    database_url = f"sqlite:///{tempfile.mkdtemp(prefix='notes-bench-')}/bench.db"
+    os.environ.setdefault("SECRET_KEY", "benchmark-secret")
+    seed_database(database_url, users=1, notes_per_user=args.notes, content_bytes=args.content_bytes)
+
+    import fastjson
+    result = {
+        "notes": args.notes,
+        "content_bytes": args.content_bytes,
+        "orjson": fastjson.orjson is not None,
+        "python": sys.version.split()[0],
+        "endpoints": asyncio.run(run(args)),
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Cold-start benchmark for the Notes API.
+
+Measures, over several fresh interpreter runs:
+  * the cumulative `python -X importtime` cost of `import main`, with the
+    slowest top-level imports, and
+  * the wall time from launching uvicorn to the first successful /health
+    response (process start, imports, lifespan startup, socket bind).
+
+Like load_test.py it can save and compare JSON baselines:
+
+    python benchmarks/startup.py --save benchmarks/baselines/startup.json
+    python benchmarks/startup.py --compare benchmarks/baselines/startup.json
+"""
+import argparse
+import json
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from collections import defaultdict
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def _env(database_url: str) -> dict:
+    return {**os.environ, "DATABASE_URL": database_url, "SECRET_KEY": os.getenv("SECRET_KEY", "benchmark-secret")}
+
+
+def measure_imports(database_url: str) -> Dict[str, float]:
+    """Cumulative import time in ms of main and of each module main imports directly."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=ROOT, env=_env(database_url), capture_output=True, text=True, check=True,
+    )
+    modules = {}
+    for line in result.stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        _, cumulative, indent, name = match.groups()
+        # main sits at depth 0 and its direct imports at depth 1 (two extra spaces)
+        if len(indent) <= 3:
+            modules[name] = int(cumulative) / 1000
+    return modules
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def measure_first_response(database_url: str, timeout: float = 30.0) -> float:
+    """Milliseconds from spawning uvicorn to the first 200 from /health."""
+    port = _free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=ROOT, env=_env(database_url),
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1) as response:
+                    if response.status == 200:
+                        return (time.perf_counter() - started) * 1000
+            except OSError:
+                time.sleep(0.005)
+        raise RuntimeError("server did not answer /health in time")
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+
+
+def run(runs: int) -> dict:
+    imports: Dict[str, List[float]] = defaultdict(list)
+    first_response = []
+    directory = tempfile.mkdtemp(prefix="notes-startup-")
+    for index in range(runs):
+        # A new database each run, so every start pays for schema creation like a fresh host
+        for name, value in measure_imports(f"sqlite:///{directory}/imports-{index}.db").items():
+            imports[name].append(value)
+        first_response.append(measure_first_response(f"sqlite:///{directory}/serve-{index}.db"))
+    medians = {name: round(statistics.median(values), 1) for name, values in imports.items()}
+    slowest = sorted((name for name in medians if name != "main"), key=medians.get, reverse=True)[:10]
+    return {
+        "runs": runs,
+        "import_main_ms": medians.get("main"),
+        "first_response_ms": round(statistics.median(first_response), 1),
+        "slowest_imports_ms": {name: medians[name] for name in slowest},
+    }
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> List[str]:
+    regressions = []
+    for key in ("import_main_ms", "first_response_ms"):
+        if baseline.get(key) and result[key] > baseline[key] * (1 + tolerance):
+            regressions.append(f"{key}: {baseline[key]} -> {result[key]}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--save", help="write the result as a JSON baseline")
+    parser.add_argument("--compare", help="compare against a JSON baseline and exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    args = parser.parse_args()
+
+    result = run(args.runs)
+    result["host"] = {"python": sys.version.split()[0], "cpu_count": os.cpu_count()}
+    print(json.dumps(result, indent=2))
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as handle:
+            json.dump(result, handle, indent=2)
+            handle.write("\n")
+    if args.compare:
+        with open(args.compare) as handle:
+            regressions = compare(result, json.load(handle), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
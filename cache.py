@@ -0,0 +1,501 @@
+"""
+In-process caches for the request hot path
+"""
+import asyncio
+import json
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Optional, Tuple
+import os
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from database import Note, User
+from metrics import registry
+
+# User cache settings
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", 300))
+
+# Note cache settings; NOTE_CACHE_SIZE=0 turns the cache off
+NOTE_CACHE_SIZE = int(os.getenv("NOTE_CACHE_SIZE", 10000))
+NOTE_CACHE_TTL_SECONDS = float(os.getenv("NOTE_CACHE_TTL_SECONDS", 60))
+# memory:// (in-process stand-in) or redis://...; empty keeps notes in a per-process LRU
+NOTE_CACHE_SHARED_URL = os.getenv("NOTE_CACHE_SHARED_URL", "")
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries also expire after a per-entry TTL."""
+
+    def __init__(self, maxsize: int, ttl: float, clock: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (expires_at, value), oldest first
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= self.clock():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (self.clock() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: Hashable) -> Any:
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return entry[1] if entry else None
+
+    def discard_where(self, predicate: Callable[[Hashable, Any], bool]) -> int:
+        """Drop every entry matching predicate(key, value); O(n), meant for rare invalidations."""
+        with self._lock:
+            stale = [key for key, (_, value) in self._data.items() if predicate(key, value)]
+            for key in stale:
+                del self._data[key]
+        return len(stale)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+@dataclass(frozen=True)
+class CachedUser:
+    """Detached, read-only view of a User row kept in the user cache."""
+    id: int
+    username: str
+    email: str
+    created_at: datetime
+
+    @classmethod
+    def from_orm(cls, user: User) -> "CachedUser":
+        return cls(id=user.id, username=user.username, email=user.email, created_at=user.created_at)
+
+
+# Authenticated users keyed by bearer token; entries never outlive the token's exp
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL_SECONDS)
+
+registry.counter_func("user_cache_hits_total", "Authenticated user cache hits", lambda: user_cache.hits)
+registry.counter_func("user_cache_misses_total", "Authenticated user cache misses", lambda: user_cache.misses)
+registry.counter_func(
+    "user_cache_evictions_total", "Authenticated user cache LRU evictions", lambda: user_cache.evictions
+)
+registry.gauge("user_cache_entries", "Authenticated user cache size", lambda: len(user_cache))
+
+
+def invalidate_user(user_id: int) -> int:
+    """Forget every cached token that resolves to the given user."""
+    return user_cache.discard_where(lambda _token, user: user.id == user_id)
+
+
+# Invalidation runs after commit, so a request that misses the cache between
+# flush and commit can't re-cache the old row. Ids are collected at flush time;
+# UPDATE/DELETE statements against User that bypass the unit of work can't be
+# attributed to ids, so they clear the whole cache instead.
+_PENDING_KEY = "invalidate_user_ids"
+_ALL_USERS = "*"
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_changed_users(session, flush_context):
+    pending = session.info.setdefault(_PENDING_KEY, set())
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            pending.add(obj.id)
+    for obj in session.dirty:
+        if isinstance(obj, User) and session.is_modified(obj):
+            pending.add(obj.id)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _collect_bulk_user_changes(orm_execute_state):
+    if (orm_execute_state.is_update or orm_execute_state.is_delete) and \
+            orm_execute_state.bind_mapper is not None and orm_execute_state.bind_mapper.class_ is User:
+        orm_execute_state.session.info.setdefault(_PENDING_KEY, set()).add(_ALL_USERS)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_committed_users(session):
+    pending = session.info.pop(_PENDING_KEY, None)
+    if not pending:
+        return
+    if _ALL_USERS in pending:
+        user_cache.clear()
+        return
+    for user_id in pending:
+        invalidate_user(user_id)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_pending_users(session, previous_transaction):
+    session.info.pop(_PENDING_KEY, None)
+
+
+@dataclass(frozen=True)
+class CachedNote:
+    """Detached, read-only copy of a Note row kept in the note cache."""
+    id: int
+    title: str
+    content: str
+    created_at: datetime
+    updated_at: datetime
+    owner_id: int
+    version: int
+
+    @classmethod
+    def from_orm(cls, note: Note) -> "CachedNote":
+        return cls(id=note.id, title=note.title, content=note.content, created_at=note.created_at,
+                   updated_at=note.updated_at, owner_id=note.owner_id, version=note.version)
+
+    def to_json(self) -> bytes:
+        data = asdict(self)
+        data["created_at"] = self.created_at.isoformat() if self.created_at else None
+        data["updated_at"] = self.updated_at.isoformat() if self.updated_at else None
+        return json.dumps(data).encode()
+
+    @classmethod
+    def from_json(cls, raw: bytes) -> "CachedNote":
+        data = json.loads(raw)
+        for field in ("created_at", "updated_at"):
+            if data[field] is not None:
+                data[field] = datetime.fromisoformat(data[field])
+        return cls(**data)
+
+
+NoteKey = Tuple[int, int]  # (owner_id, note_id)
+
+
+class LocalNoteBackend:
+    """Per-process LRU; a set never replaces a newer version of the same note."""
+
+    # Other workers' writes don't invalidate it, so hits must be checked against the database
+    shared = False
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.entries = TTLCache(maxsize, ttl)
+
+    @property
+    def evictions(self) -> int:
+        return self.entries.evictions
+
+    async def get(self, key: NoteKey) -> Optional[CachedNote]:
+        return self.entries.get(key)
+
+    async def set(self, key: NoteKey, note: CachedNote) -> None:
+        current = self.entries.get(key)
+        if current is None or current.version <= note.version:
+            self.entries.set(key, note)
+
+    def delete(self, keys: Iterable[NoteKey]) -> None:
+        for key in keys:
+            self.entries.pop(key)
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class InMemorySharedStore:
+    """Stand-in for a shared key-value store (Redis-like get/set/delete on bytes with expiry).
+
+    Lives in this process only; used for development and tests in place of
+    a real shared store.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self._data: Dict[str, Tuple[float, bytes]] = {}
+
+    async def get(self, key: str) -> Optional[bytes]:
+        entry = self._data.get(key)
+        if entry is None or entry[0] <= self.clock():
+            self._data.pop(key, None)
+            return None
+        return entry[1]
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        self._data[key] = (self.clock() + ttl, value)
+
+    async def delete(self, *keys: str) -> None:
+        for key in keys:
+            self._data.pop(key, None)
+
+    async def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class RedisSharedStore:
+    """Shared store on Redis; needs the optional `redis` package."""
+
+    def __init__(self, url: str):
+        import redis.asyncio as redis
+
+        self.client = redis.from_url(url)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.client.get(key)
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        await self.client.set(key, value, px=max(1, int(ttl * 1000)))
+
+    async def delete(self, *keys: str) -> None:
+        if keys:
+            await self.client.delete(*keys)
+
+    async def clear(self) -> None:
+        keys = [key async for key in self.client.scan_iter(match="note:*")]
+        await self.delete(*keys)
+
+    def __len__(self) -> int:
+        return 0  # Not tracked; the store is shared with other processes
+
+
+class SharedNoteBackend:
+    """Notes cached in a store shared by every worker, so one worker's invalidation reaches all."""
+
+    evictions = 0  # Evictions happen inside the store
+    shared = True
+
+    def __init__(self, store, ttl: float):
+        self.store = store
+        self.ttl = ttl
+        self._pending = set()
+
+    @staticmethod
+    def _key(key: NoteKey) -> str:
+        return "note:%d:%d" % key
+
+    async def get(self, key: NoteKey) -> Optional[CachedNote]:
+        raw = await self.store.get(self._key(key))
+        return CachedNote.from_json(raw) if raw is not None else None
+
+    async def set(self, key: NoteKey, note: CachedNote) -> None:
+        await self.store.set(self._key(key), note.to_json(), self.ttl)
+
+    def _run(self, coroutine) -> None:
+        # Called from commit hooks, which are synchronous: run as a task on the loop when
+        # there is one (async sessions), or to completion otherwise (sync sessions)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            asyncio.run(coroutine)
+            return
+        task = loop.create_task(coroutine)
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    def delete(self, keys: Iterable[NoteKey]) -> None:
+        self._run(self.store.delete(*(self._key(key) for key in keys)))
+
+    def clear(self) -> None:
+        self._run(self.store.clear())
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+
+class NoteCache:
+    """Read-through cache of notes keyed by (owner_id, note_id).
+
+    Concurrent misses for one key share a single load. A load that overlaps
+    an invalidation of its key doesn't fill the cache, so an old row read
+    before a commit can't be cached after it.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stale = 0
+        self._inflight: Dict[NoteKey, asyncio.Future] = {}
+        self._epoch = 0
+        self._cleared_at = 0
+        # key -> epoch of its last invalidation; only needs to outlive in-flight loads
+        self._invalidated = TTLCache(max(NOTE_CACHE_SIZE, 1), NOTE_CACHE_TTL_SECONDS)
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    @property
+    def validates_hits(self) -> bool:
+        """Whether a hit must be confirmed against the note's current version before use."""
+        return self.backend is not None and not self.backend.shared
+
+    async def get(self, key: NoteKey) -> Optional[CachedNote]:
+        if self.backend is None:
+            return None
+        note = await self.backend.get(key)
+        if note is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return note
+
+    async def load(self, key: NoteKey, loader: Callable[[], Awaitable[Optional[CachedNote]]]) -> Optional[CachedNote]:
+        """Run loader once for all concurrent callers of key and cache what it returns."""
+        if self.backend is None:
+            return await loader()
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        epoch = self._epoch
+        try:
+            note = await loader()
+        except BaseException as exc:
+            future.set_exception(exc)
+            future.exception()  # Retrieved here, so an unawaited failure isn't logged
+            raise
+        else:
+            future.set_result(note)
+        finally:
+            del self._inflight[key]
+        if note is not None and self._cleared_at <= epoch and self._invalidated.get(key, -1) <= epoch:
+            await self.backend.set(key, note)
+        return note
+
+    async def get_or_load(self, key: NoteKey, loader) -> Optional[CachedNote]:
+        note = await self.get(key)
+        return note if note is not None else await self.load(key, loader)
+
+    def invalidate(self, keys: Iterable[NoteKey]) -> None:
+        keys = list(keys)
+        self._epoch += 1
+        for key in keys:
+            self._invalidated.set(key, self._epoch)
+        if self.backend is not None:
+            self.backend.delete(keys)
+
+    def clear(self) -> None:
+        self._epoch += 1
+        self._invalidated.clear()
+        self._cleared_at = self._epoch
+        if self.backend is not None:
+            self.backend.clear()
+
+
+def note_backend_from_settings():
+    if NOTE_CACHE_SIZE <= 0:
+        return None
+    if NOTE_CACHE_SHARED_URL.startswith("memory://"):
+        return SharedNoteBackend(InMemorySharedStore(), NOTE_CACHE_TTL_SECONDS)
+    if NOTE_CACHE_SHARED_URL:
+        return SharedNoteBackend(RedisSharedStore(NOTE_CACHE_SHARED_URL), NOTE_CACHE_TTL_SECONDS)
+    return LocalNoteBackend(NOTE_CACHE_SIZE, NOTE_CACHE_TTL_SECONDS)
+
+
+note_cache = NoteCache(note_backend_from_settings())
+
+registry.counter_func("note_cache_hits_total", "Note cache hits", lambda: note_cache.hits)
+registry.counter_func("note_cache_misses_total", "Note cache misses", lambda: note_cache.misses)
+registry.counter_func(
+    "note_cache_coalesced_total", "Note cache misses that waited on another request's load",
+    lambda: note_cache.coalesced
+)
+registry.counter_func(
+    "note_cache_stale_total", "Note cache hits dropped because the note's version had moved on",
+    lambda: note_cache.stale
+)
+registry.counter_func(
+    "note_cache_evictions_total", "Note cache LRU evictions",
+    lambda: note_cache.backend.evictions if note_cache.backend is not None else 0
+)
+registry.gauge(
+    "note_cache_entries", "Note cache size",
+    lambda: len(note_cache.backend) if note_cache.backend is not None else 0
+)
+registry.gauge(
+    "note_cache_hit_ratio", "Note cache hits / lookups since start",
+    lambda: note_cache.hits / max(note_cache.hits + note_cache.misses, 1)
+)
+
+
+# Notes are invalidated after commit like users above. Core UPDATE/DELETE
+# statements on notes name their keys with the `note_cache_keys` execution
+# option; ones that don't clear the whole cache.
+_PENDING_NOTES_KEY = "invalidate_note_keys"
+_ALL_NOTES = "*"
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_changed_notes(session, flush_context):
+    pending = session.info.setdefault(_PENDING_NOTES_KEY, set())
+    for obj in session.deleted:
+        if isinstance(obj, Note):
+            pending.add((obj.owner_id, obj.id))
+    for obj in session.dirty:
+        if isinstance(obj, Note) and session.is_modified(obj):
+            pending.add((obj.owner_id, obj.id))
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _collect_bulk_note_changes(orm_execute_state):
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    table = getattr(orm_execute_state.statement, "table", None)
+    if getattr(table, "name", None) != Note.__tablename__:
+        return
+    pending = orm_execute_state.session.info.setdefault(_PENDING_NOTES_KEY, set())
+    keys = orm_execute_state.execution_options.get("note_cache_keys")
+    if keys is None:
+        pending.add(_ALL_NOTES)
+    else:
+        pending.update(keys)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_committed_notes(session):
+    pending = session.info.pop(_PENDING_NOTES_KEY, None)
+    if not pending:
+        return
+    if _ALL_NOTES in pending:
+        note_cache.clear()
+    else:
+        note_cache.invalidate(pending)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_pending_notes(session, previous_transaction):
+    session.info.pop(_PENDING_NOTES_KEY, None)
@@ -0,0 +1,94 @@
+"""
+Per-owner change feed for incremental sync.
+
+Every write to a user's notes takes the next numbers from that user's row in
+note_change_counters and stamps them on notes.change_seq, or on a
+note_tombstones row when the note is deleted. The counter row stays locked
+until the writing transaction commits, so an owner's sequence numbers become
+visible in order and a client resuming from its last position never skips
+a change that committed late.
+"""
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import insert, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import Note, NoteChangeCounter, NoteTombstone
+
+_UPSERTS = {"postgresql": postgresql_insert, "sqlite": sqlite_insert}
+
+# (change_seq, note id, note or None for a deletion)
+Change = Tuple[int, int, Optional[Note]]
+
+
+async def allocate_change_seqs(db: AsyncSession, owner_id: int, count: int = 1) -> int:
+    """Reserve `count` consecutive sequence numbers for owner_id's writes and return the first.
+
+    Call it as late in the transaction as possible: the counter row is
+    locked from here until commit.
+    """
+    upsert = _UPSERTS.get(db.get_bind().dialect.name)
+    if upsert is not None:
+        statement = upsert(NoteChangeCounter).values(owner_id=owner_id, last_seq=count)
+        last_seq = await db.scalar(
+            statement.on_conflict_do_update(
+                index_elements=[NoteChangeCounter.owner_id],
+                set_={"last_seq": NoteChangeCounter.last_seq + count},
+            ).returning(NoteChangeCounter.last_seq)
+        )
+    else:
+        last_seq = await db.scalar(
+            update(NoteChangeCounter)
+            .where(NoteChangeCounter.owner_id == owner_id)
+            .values(last_seq=NoteChangeCounter.last_seq + count)
+            .returning(NoteChangeCounter.last_seq)
+        )
+        if last_seq is None:
+            await db.execute(insert(NoteChangeCounter).values(owner_id=owner_id, last_seq=count))
+            last_seq = count
+    return last_seq - count + 1
+
+
+async def record_tombstones(db: AsyncSession, owner_id: int, note_ids: Iterable[int]) -> Dict[int, int]:
+    """Add the deletions of note_ids to owner_id's change feed; returns note id -> change_seq."""
+    note_ids = sorted(note_ids)
+    if not note_ids:
+        return {}
+    first = await allocate_change_seqs(db, owner_id, len(note_ids))
+    seqs = {note_id: first + offset for offset, note_id in enumerate(note_ids)}
+    await db.execute(insert(NoteTombstone), [
+        {"owner_id": owner_id, "note_id": note_id, "change_seq": change_seq}
+        for note_id, change_seq in seqs.items()
+    ])
+    return seqs
+
+
+async def changes_since(
+    db: AsyncSession, owner_id: int, after: Tuple[int, int], limit: int
+) -> Tuple[List[Change], bool]:
+    """Notes written and deleted after position `after`, in feed order, and whether more follow.
+
+    Positions are (change_seq, note id) pairs; the id breaks ties between
+    notes written before the feed existed, which all share change_seq 0.
+    """
+    notes = (await db.scalars(
+        select(Note)
+        .where(Note.owner_id == owner_id, tuple_(Note.change_seq, Note.id) > tuple_(*after))
+        .order_by(Note.change_seq, Note.id)
+        .limit(limit + 1)
+    )).all()
+    tombstones = (await db.execute(
+        select(NoteTombstone.change_seq, NoteTombstone.note_id)
+        .where(NoteTombstone.owner_id == owner_id,
+               tuple_(NoteTombstone.change_seq, NoteTombstone.note_id) > tuple_(*after))
+        .order_by(NoteTombstone.change_seq, NoteTombstone.note_id)
+        .limit(limit + 1)
+    )).all()
+    changes = sorted(
+        [(note.change_seq, note.id, note) for note in notes]
+        + [(row.change_seq, row.note_id, None) for row in tombstones],
+        key=lambda change: change[:2],
+    )
+    return changes[:limit], len(changes) > limit
@@ -0,0 +1,221 @@
+"""
+Compression of large note content, at rest and on the wire
+
+CompressedText stores a value above NOTE_COMPRESSION_MIN_BYTES on SQLite as a
+BLOB: a format marker naming the codec (zstd when the optional `zstandard`
+package is installed, zlib otherwise) followed by the compressed UTF-8 text.
+Rows written before compression, and short values, stay plain TEXT and read
+back unchanged. The same decoder is registered on SQLite connections as the
+SQL function note_text(), so the full-text index sees plaintext; other SQLite
+clients that write to notes must register it as well, for as long as notes
+may be compressed (see search.create_search_index). PostgreSQL
+already compresses large values itself (TOAST), so values are stored as is
+there and its search index keeps working on the column.
+
+ResponseCompressionMiddleware gzip- or Brotli-encodes /notes responses whose
+body is at least RESPONSE_COMPRESSION_MIN_BYTES, using a faster level for
+bodies past RESPONSE_COMPRESSION_FAST_BYTES.
+"""
+import asyncio
+import os
+import time
+import zlib
+from typing import Optional
+
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy.types import Text, TypeDecorator
+
+import timing
+from metrics import registry
+
+try:  # Optional: better ratio and much faster decompression than zlib
+    import zstandard
+except ImportError:  # pragma: no cover - depends on the environment
+    zstandard = None
+
+try:  # Optional: `br` responses
+    import brotli
+except ImportError:  # pragma: no cover - depends on the environment
+    brotli = None
+
+# zstd, zlib or none; stored values record their codec, so this can change at any time
+NOTE_COMPRESSION = os.getenv("NOTE_COMPRESSION", "zstd" if zstandard is not None else "zlib").lower()
+NOTE_COMPRESSION_MIN_BYTES = int(os.getenv("NOTE_COMPRESSION_MIN_BYTES", 4096))
+RESPONSE_COMPRESSION_ENABLED = os.getenv("RESPONSE_COMPRESSION_ENABLED", "true").lower() in ("1", "true", "yes")
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESSION_MIN_BYTES", 1024))
+# Bodies this large are compressed at the fastest level, off the event loop
+RESPONSE_COMPRESSION_FAST_BYTES = int(os.getenv("RESPONSE_COMPRESSION_FAST_BYTES", 1024 * 1024))
+
+COMPRESSED_PATH_PREFIX = "/notes"
+
+# Stored values start with MAGIC and one codec byte
+MAGIC = b"\x00NC"
+_ZLIB = b"z"
+_ZSTD = b"s"
+
+response_bytes = registry.counter(
+    "http_response_compression_bytes_total", "Response body bytes before and after compression",
+    ["encoding", "stage"]
+)
+
+
+def _compressor(codec: str):
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("NOTE_COMPRESSION=zstd needs the zstandard package")
+        return _ZSTD, zstandard.ZstdCompressor(level=3).compress
+    if codec == "zlib":
+        return _ZLIB, lambda data: zlib.compress(data, 6)
+    return None
+
+
+_note_compressor = _compressor(NOTE_COMPRESSION)
+# Off (NOTE_COMPRESSION=none) lets the full-text triggers do without note_text(); see search.py
+NOTE_COMPRESSION_ENABLED = _note_compressor is not None
+
+
+def compress_text(value: str, min_bytes: int = NOTE_COMPRESSION_MIN_BYTES):
+    """The stored form of value: marked compressed bytes, or value itself if compressing doesn't pay."""
+    if _note_compressor is None or len(value) * 4 < min_bytes:  # A character is at most 4 bytes
+        return value
+    data = value.encode()
+    if len(data) < min_bytes:
+        return value
+    tag, compress = _note_compressor
+    compressed = MAGIC + tag + compress(data)
+    return compressed if len(compressed) < len(data) else value
+
+
+def decompress_text(value):
+    """Inverse of compress_text; plain text (including rows older than compression) passes through."""
+    if not isinstance(value, bytes):
+        return value
+    if not value.startswith(MAGIC):
+        return value.decode()
+    tag, payload = value[len(MAGIC):len(MAGIC) + 1], value[len(MAGIC) + 1:]
+    if tag == _ZLIB:
+        return zlib.decompress(payload).decode()
+    if tag == _ZSTD:
+        if zstandard is None:
+            raise RuntimeError("Note content is zstd-compressed; install the zstandard package to read it")
+        return zstandard.ZstdDecompressor().decompress(payload).decode()
+    raise ValueError("Unknown note compression codec %r" % tag)
+
+
+class CompressedText(TypeDecorator):
+    """Text that SQLite stores compressed once it reaches NOTE_COMPRESSION_MIN_BYTES."""
+
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None or dialect.name != "sqlite":
+            return value
+        return compress_text(value)
+
+    def process_result_value(self, value, dialect):
+        return decompress_text(value)
+
+
+class note_text(FunctionElement):
+    """SQL expression for a CompressedText column's plaintext, for use inside queries (e.g. substr)."""
+
+    type = Text()
+    name = "note_text"
+    inherit_cache = True
+
+
+@compiles(note_text)
+def _compile_note_text(element, compiler, **kw):
+    return compiler.process(element.clauses, **kw)  # Stored uncompressed
+
+
+@compiles(note_text, "sqlite")
+def _compile_note_text_sqlite(element, compiler, **kw):
+    return "note_text(%s)" % compiler.process(element.clauses, **kw)
+
+
+def register_sqlite_functions(dbapi_connection, connection_record):
+    # Used by the full-text triggers and the view they index
+    dbapi_connection.create_function("note_text", 1, decompress_text, deterministic=True)
+
+
+def _accepted_encoding(scope) -> Optional[str]:
+    for name, value in scope["headers"]:
+        if name == b"accept-encoding":
+            accepted = set()
+            for part in value.decode("latin-1").lower().split(","):
+                coding, _, params = part.partition(";")
+                params = params.replace(" ", "")
+                try:
+                    if params.startswith("q=") and float(params[2:]) == 0:  # q=0: explicitly refused
+                        continue
+                except ValueError:
+                    continue
+                accepted.add(coding.strip())
+            if brotli is not None and "br" in accepted:
+                return "br"
+            if "gzip" in accepted:
+                return "gzip"
+            return None
+    return None
+
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    fast = len(body) >= RESPONSE_COMPRESSION_FAST_BYTES
+    if encoding == "br":
+        return brotli.compress(body, quality=1 if fast else 4)
+    compressor = zlib.compressobj(1 if fast else 4, zlib.DEFLATED, 31)  # wbits=31 writes a gzip container
+    return compressor.compress(body) + compressor.flush()
+
+
+class ResponseCompressionMiddleware:
+    """Pure ASGI middleware compressing complete /notes response bodies; streamed bodies pass through."""
+
+    def __init__(self, app, min_bytes: int = RESPONSE_COMPRESSION_MIN_BYTES):
+        self.app = app
+        self.min_bytes = min_bytes
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or not RESPONSE_COMPRESSION_ENABLED
+                or not scope["path"].startswith(COMPRESSED_PATH_PREFIX)):
+            return await self.app(scope, receive, send)
+        encoding = _accepted_encoding(scope)
+        start_message = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start_message, passthrough
+            if passthrough:
+                return await send(message)
+            if message["type"] == "http.response.start":
+                # Held back until the first body message shows whether the body is complete
+                start_message = message
+                return
+            passthrough = True
+            headers = list(start_message.get("headers", []))
+            if any(name == b"content-encoding" for name, _ in headers) or message.get("more_body", False):
+                await send(start_message)
+                return await send(message)
+
+            body = message.get("body", b"")
+            if encoding is not None and len(body) >= self.min_bytes:
+                started = time.perf_counter()
+                if len(body) >= RESPONSE_COMPRESSION_FAST_BYTES:
+                    compressed = await asyncio.to_thread(compress_body, body, encoding)
+                else:
+                    compressed = compress_body(body, encoding)
+                timing.add("compress", time.perf_counter() - started)
+                response_bytes.inc(encoding, "in", amount=len(body))
+                response_bytes.inc(encoding, "out", amount=len(compressed))
+                body = compressed
+                headers = [(name, value) for name, value in headers if name != b"content-length"]
+                headers += [(b"content-encoding", encoding.encode()), (b"content-length", str(len(body)).encode())]
+            # Caches must keep the encodings apart, compressed or not
+            if not any(name == b"vary" and b"accept-encoding" in value.lower() for name, value in headers):
+                headers.append((b"vary", b"Accept-Encoding"))
+            await send({**start_message, "headers": headers})
+            await send({**message, "body": body})
+
+        await self.app(scope, receive, send_compressed)
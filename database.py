@@ -1,27 +1,334 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy import create_engine, event, inspect, text, BigInteger, Boolean, Column, Integer, String, DateTime, ForeignKey, Index
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import Session, sessionmaker, relationship
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 from datetime import datetime
+from fastapi import Request, Response
+from typing import List, Optional
+import itertools
+import math
 import os
+import time
+
+from compression import CompressedText, register_sqlite_functions
+from metrics import registry
+from search import create_search_index
+
+def _normalize_database_url(url: str) -> str:
+    # For PostgreSQL URLs that start with postgres://, convert to postgresql://
+    if url.startswith("postgres://"):
+        return url.replace("postgres://", "postgresql://", 1)
+    return url
 
 # Database configuration
-SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./notes.db")
+SQLALCHEMY_DATABASE_URL = _normalize_database_url(os.getenv("DATABASE_URL", "sqlite:///./notes.db"))
+
+def get_async_database_url(url: str) -> str:
+    """Map a sync database URL onto its asyncio driver (aiosqlite/asyncpg)."""
+    if url.startswith("sqlite:"):
+        return url.replace("sqlite:", "sqlite+aiosqlite:", 1)
+    if url.startswith("postgresql:"):
+        return url.replace("postgresql:", "postgresql+asyncpg:", 1)
+    return url
+
+ASYNC_SQLALCHEMY_DATABASE_URL = os.getenv(
+    "ASYNC_DATABASE_URL", get_async_database_url(SQLALCHEMY_DATABASE_URL)
+)
+
+def _env_flag(name: str, default: str) -> bool:
+    return os.getenv(name, default).lower() in ("1", "true", "yes")
+
+# Read replicas, comma-separated in the same form as DATABASE_URL; see RoutingSession
+DATABASE_REPLICA_URLS = [
+    _normalize_database_url(url.strip()) for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()
+]
+# round_robin or least_connections
+REPLICA_BALANCE = os.getenv("REPLICA_BALANCE", "round_robin")
+# After a client's commit its reads stay on the primary this long; keep it above the replicas' lag
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", 5))
+# A replica that failed to connect is skipped this long before it is tried again
+REPLICA_RETRY_SECONDS = float(os.getenv("REPLICA_RETRY_SECONDS", 30))
+
+# Connection pool settings
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = _env_flag("DB_POOL_PRE_PING", "true")
+# Set when migrations own the schema; the app then never runs DDL on startup
+DB_MIGRATIONS_MANAGED = _env_flag("DB_MIGRATIONS_MANAGED", "false")
+# SQLAlchemy's compiled-SQL cache and asyncpg's server-side prepared statement cache
+DB_QUERY_CACHE_SIZE = int(os.getenv("DB_QUERY_CACHE_SIZE", 500))
+DB_PREPARED_STATEMENT_CACHE_SIZE = int(os.getenv("DB_PREPARED_STATEMENT_CACHE_SIZE", 100))
+
+# SQLite pragmas applied to every new connection
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000)),
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024)),
+    "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", -64000)),  # negative = KiB
+    "temp_store": os.getenv("SQLITE_TEMP_STORE", "MEMORY"),
+    # Off by default in SQLite; note_revisions relies on ON DELETE CASCADE
+    "foreign_keys": "ON",
+}
+
+pool_wait = registry.histogram(
+    "db_pool_wait_seconds", "Time checkouts spent blocked on an exhausted pool", ["engine"]
+)
+
+
+class _TimedPoolMixin:
+    """Records how long checkouts blocked because every connection was in use."""
+    metric_label = "sync"
 
-# For PostgreSQL URLs that start with postgres://, convert to postgresql://
-if SQLALCHEMY_DATABASE_URL.startswith("postgres://"):
-    SQLALCHEMY_DATABASE_URL = SQLALCHEMY_DATABASE_URL.replace("postgres://", "postgresql://", 1)
+    def _do_get(self):
+        # Checkouts that can reuse an idle connection or open an overflow one don't wait;
+        # timing them would report connect time as queueing.
+        exhausted = self.checkedin() == 0 and -1 < self._max_overflow <= self.overflow()
+        if not exhausted:
+            return super()._do_get()
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_wait.observe(time.perf_counter() - start, self.metric_label)
 
-# Configure engine based on database type
-if SQLALCHEMY_DATABASE_URL.startswith("sqlite"):
-    engine = create_engine(
-        SQLALCHEMY_DATABASE_URL, 
-        connect_args={"check_same_thread": False}
+
+class TimedQueuePool(_TimedPoolMixin, QueuePool):
+    metric_label = "sync"
+
+
+class TimedAsyncQueuePool(_TimedPoolMixin, AsyncAdaptedQueuePool):
+    metric_label = "async"
+
+
+class TimedReplicaQueuePool(_TimedPoolMixin, AsyncAdaptedQueuePool):
+    # Kept apart from "async", which the load shedder reads as the primary's pool wait
+    metric_label = "replica"
+
+
+def _is_sqlite_memory(url: str) -> bool:
+    return url.split("?")[0].rstrip("/").endswith((":memory:", "sqlite:", "aiosqlite:"))
+
+
+def _engine_options(url: str, is_async: bool, replica: bool = False) -> dict:
+    """Pool and driver options for an engine, driven by the DB_* environment settings."""
+    options = {"query_cache_size": DB_QUERY_CACHE_SIZE}
+    if url.startswith("sqlite"):
+        if not is_async:
+            options["connect_args"] = {"check_same_thread": False}
+        if _is_sqlite_memory(url):
+            # In-memory databases live in a single connection; keep SQLAlchemy's default pools there
+            return options
+    elif "+asyncpg" in url:
+        options["connect_args"] = {"prepared_statement_cache_size": DB_PREPARED_STATEMENT_CACHE_SIZE}
+    options.update(
+        poolclass=(TimedReplicaQueuePool if replica else TimedAsyncQueuePool) if is_async else TimedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
     )
-else:
-    # For PostgreSQL and other databases
-    engine = create_engine(SQLALCHEMY_DATABASE_URL)
+    return options
+
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **_engine_options(SQLALCHEMY_DATABASE_URL, is_async=False))
+
+# Async engine used by the request handlers so DB round-trips don't block the event loop
+async_engine = create_async_engine(
+    ASYNC_SQLALCHEMY_DATABASE_URL, **_engine_options(ASYNC_SQLALCHEMY_DATABASE_URL, is_async=True)
+)
+
+read_replicas = [
+    create_async_engine(url, **_engine_options(url, is_async=True, replica=True))
+    for url in map(get_async_database_url, DATABASE_REPLICA_URLS)
+]
+
+for _engine in (engine, async_engine.sync_engine, *(replica.sync_engine for replica in read_replicas)):
+    if _engine.dialect.name == "sqlite":
+        event.listen(_engine, "connect", _apply_sqlite_pragmas)
+        event.listen(_engine, "connect", register_sqlite_functions)
+
+
+def _dispose_inherited_pools():
+    # A forked worker (e.g. gunicorn --preload) must open its own connections rather than
+    # share the parent's sockets; close=False leaves the parent's connections alone
+    engine.dispose(close=False)
+    async_engine.sync_engine.dispose(close=False)
+    for replica in replica_set.replicas:
+        replica.engine.sync_engine.dispose(close=False)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_dispose_inherited_pools)
+
+
+def pool_stats(pool) -> dict:
+    """Snapshot of a pool's occupancy; pools without a fixed size report None."""
+    label = getattr(pool, "metric_label", None)
+    return {
+        "pool": type(pool).__name__,
+        "size": pool.size() if hasattr(pool, "size") else None,
+        "checked_out": pool.checkedout() if hasattr(pool, "checkedout") else None,
+        "checked_in": pool.checkedin() if hasattr(pool, "checkedin") else None,
+        # QueuePool counts unopened base connections as negative overflow
+        "overflow": max(pool.overflow(), 0) if hasattr(pool, "overflow") else None,
+        "wait_count": pool_wait.count(label) if label else 0,
+        "wait_seconds_total": pool_wait.total(label) if label else 0.0,
+        "wait_seconds_p99": pool_wait.quantile(0.99, label) if label else None,
+    }
+
+
+registry.gauge(
+    "db_pool_checked_out", "Connections checked out of the async pool",
+    lambda: pool_stats(async_engine.pool)["checked_out"] or 0
+)
+registry.gauge(
+    "db_pool_overflow", "Overflow connections open in the async pool",
+    lambda: pool_stats(async_engine.pool)["overflow"] or 0
+)
+
+
+routed_reads = registry.counter(
+    "db_routed_reads_total", "SELECT statements of replica-eligible sessions, by where they ran", ["target"]
+)
+replica_failures = registry.counter(
+    "db_replica_failures_total", "Replica connection failures that took it out of rotation", ["replica"]
+)
+
+
+class Replica:
+    """A read replica's engine, taken out of rotation for a while when it can't be reached."""
+
+    def __init__(self, engine, name: str, retry_seconds: float = REPLICA_RETRY_SECONDS):
+        self.engine = engine
+        self.name = name
+        self.retry_seconds = retry_seconds
+        self.down_until = 0.0
+        event.listen(engine.sync_engine, "handle_error", self._handle_error)
+
+    @property
+    def healthy(self) -> bool:
+        # Once the wait is over the next read tries it again and a failure restarts the wait
+        return time.monotonic() >= self.down_until
+
+    def checked_out(self) -> int:
+        pool = self.engine.pool
+        return pool.checkedout() if hasattr(pool, "checkedout") else 0
+
+    def _handle_error(self, exception_context):
+        # No connection means connecting failed; is_disconnect covers a replica lost mid-use
+        if exception_context.connection is None or exception_context.is_disconnect:
+            self.down_until = time.monotonic() + self.retry_seconds
+            replica_failures.inc(self.name)
+
+
+class ReplicaSet:
+    """Healthy replica selection."""
+
+    def __init__(self, replicas: List[Replica], balance: str = REPLICA_BALANCE):
+        self.replicas = replicas
+        self.balance = balance
+        self._turn = itertools.count()
+
+    def choose(self) -> Optional[Replica]:
+        """Next healthy replica, or None when reads must go to the primary."""
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        start = next(self._turn) % len(healthy)
+        ordered = healthy[start:] + healthy[:start]
+        if self.balance == "least_connections":
+            return min(ordered, key=lambda replica: replica.checked_out())  # Ties keep round-robin order
+        return ordered[0]
+
+    async def dispose(self) -> None:
+        for replica in self.replicas:
+            await replica.engine.dispose()
+
+
+replica_set = ReplicaSet([Replica(replica, f"replica{index}") for index, replica in enumerate(read_replicas)])
+
+# Session.info keys: set by get_async_db, read by RoutingSession and its events
+READ_REPLICA = "read_replica"
+_RESPONSE = "response"
+_WROTE = "wrote"
+
+# Time of the client's last commit, so every worker keeps its next reads on the primary
+LAST_WRITE_COOKIE = "last_write"
+
+
+class RoutingSession(Session):
+    """Session that can send plain SELECTs to a read replica.
+
+    Only sessions with info["read_replica"] set (those of GET and HEAD
+    requests) are routed, so a write handler never validates against a
+    lagging copy. Everything else goes to the primary: flushes and DML,
+    SELECT ... FOR UPDATE, statements with execution option
+    read_primary=True and reads after a write in the same transaction. A
+    commit sets the last_write cookie, and get_async_db leaves requests
+    carrying it within READ_YOUR_WRITES_SECONDS unrouted, whichever worker
+    they reach. With no healthy replica, reads use the primary.
+    """
+
+    def __init__(self, replicas: Optional[ReplicaSet] = None, **kw):
+        super().__init__(**kw)
+        self.replicas = replicas if replicas is not None else replica_set
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self.info.get(READ_REPLICA) and getattr(clause, "is_select", False):
+            replica = None
+            if not (self._flushing or self.info.get(_WROTE)
+                    or getattr(clause, "_for_update_arg", None) is not None
+                    or clause.get_execution_options().get("read_primary")):
+                replica = self.replicas.choose()
+            routed_reads.inc("replica" if replica is not None else "primary")
+            if replica is not None:
+                return replica.engine.sync_engine
+        return super().get_bind(mapper, clause=clause, **kw)
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _note_flush(session, flush_context):
+    session.info[_WROTE] = True
+
+
+@event.listens_for(RoutingSession, "do_orm_execute")
+def _note_dml(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info[_WROTE] = True
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _open_read_your_writes_window(session):
+    response = session.info.get(_RESPONSE)
+    if session.info.pop(_WROTE, False) and response is not None and session.replicas.replicas:
+        if "set-cookie" in response.headers:  # A later commit of the same request restarts the window
+            del response.headers["set-cookie"]
+        response.set_cookie(LAST_WRITE_COOKIE, "%.3f" % time.time(), max_age=math.ceil(READ_YOUR_WRITES_SECONDS),
+                            httponly=True, samesite="lax")
+
+
+@event.listens_for(RoutingSession, "after_soft_rollback")
+def _discard_writes(session, previous_transaction):
+    session.info.pop(_WROTE, None)
+
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine, class_=AsyncSession, sync_session_class=RoutingSession,
+    autoflush=False, expire_on_commit=False
+)
 
 Base = declarative_base()
 
@@ -42,14 +349,65 @@ class Note(Base):
     
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String(200), nullable=False)
-    content = Column(Text, nullable=False)
+    # Compressed on SQLite above NOTE_COMPRESSION_MIN_BYTES; see compression.py
+    content = Column(CompressedText, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     owner_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     version = Column(Integer, default=1, nullable=False)  # For optimistic locking
+    # Position in the owner's change feed, taken from note_change_counters on every write
+    change_seq = Column(BigInteger, default=0, server_default="0", nullable=False)
     
     # Relationship with user
     owner = relationship("User", back_populates="notes")
+    
+    # ORM flushes of a loaded note add WHERE version = <loaded version> and bump it,
+    # raising StaleDataError if another writer got there first
+    __mapper_args__ = {"version_id_col": version}
+    
+    __table_args__ = (
+        # Keyset pagination: WHERE owner_id = ? AND id > ? ORDER BY id
+        Index("ix_notes_owner_id_id", "owner_id", "id"),
+        # Change feed: WHERE owner_id = ? AND change_seq > ? ORDER BY change_seq
+        Index("ix_notes_owner_id_change_seq", "owner_id", "change_seq"),
+    )
+
+class NoteTombstone(Base):
+    """A deleted note's place in its owner's change feed."""
+    __tablename__ = "note_tombstones"
+
+    id = Column(Integer, primary_key=True)
+    owner_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    note_id = Column(Integer, nullable=False)
+    change_seq = Column(BigInteger, nullable=False)
+    deleted_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_note_tombstones_owner_id_change_seq", "owner_id", "change_seq"),
+    )
+
+class NoteChangeCounter(Base):
+    """Last change sequence number handed out for an owner's notes."""
+    __tablename__ = "note_change_counters"
+
+    owner_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    last_seq = Column(BigInteger, nullable=False)
+
+class NoteRevision(Base):
+    __tablename__ = "note_revisions"
+
+    id = Column(Integer, primary_key=True)
+    note_id = Column(Integer, ForeignKey("notes.id", ondelete="CASCADE"), nullable=False)
+    version = Column(Integer, nullable=False)
+    # Snapshots hold the full content in data, deltas a JSON edit script against the previous version
+    is_snapshot = Column(Boolean, nullable=False)
+    title = Column(String(200), nullable=False)
+    data = Column(CompressedText, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_note_revisions_note_id_version", "note_id", "version", unique=True),
+    )
 
 # Dependency to get database session
 def get_db():
@@ -59,6 +417,32 @@ def get_db():
     finally:
         db.close()
 
+def recently_wrote(request: Request) -> bool:
+    """Whether the request's last_write cookie is within READ_YOUR_WRITES_SECONDS of now."""
+    try:
+        age = time.time() - float(request.cookies.get(LAST_WRITE_COOKIE, ""))
+    except ValueError:
+        return False
+    # Either side of now, for clock skew between hosts; a forged far-future time is ignored
+    return abs(age) < READ_YOUR_WRITES_SECONDS
+
+# Dependency to get an async database session
+async def get_async_db(request: Request, response: Response):
+    async with AsyncSessionLocal() as db:
+        # Reads of safe methods may be served by a replica; see RoutingSession
+        db.info[READ_REPLICA] = request.method in ("GET", "HEAD") and not recently_wrote(request)
+        db.info[_RESPONSE] = response
+        yield db
+
 # Create tables
 def create_tables():
     Base.metadata.create_all(bind=engine)
+    # create_all skips columns added to tables that already exist
+    if "change_seq" not in {column["name"] for column in inspect(engine).get_columns("notes")}:
+        with engine.begin() as connection:
+            connection.execute(text("ALTER TABLE notes ADD COLUMN change_seq BIGINT NOT NULL DEFAULT 0"))
+    # create_all skips indexes on tables that already exist
+    for index in Note.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+    with engine.begin() as connection:
+        create_search_index(connection)
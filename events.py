@@ -0,0 +1,215 @@
+"""
+Push notifications of note changes to connected clients.
+
+Handlers publish an event after each commit; NoteEventBroker fans it out to
+the owner's subscribers in this process. With NOTE_EVENTS_URL set, events
+also go through a bus shared by all workers (memory:// in-process stand-in
+or redis://), so a subscriber hears about writes served by other workers.
+
+Events only say what changed ({"type", "id", "version", "change_seq"});
+clients read the note itself, or GET /notes/changes after a "resync" event,
+which is sent instead of events a slow subscriber could not keep up with.
+"""
+import asyncio
+import json
+import os
+import threading
+import uuid
+from collections import deque
+from typing import Callable, Dict, List, Optional, Set
+
+from metrics import registry
+
+# memory:// (in-process stand-in) or redis://...; empty fans out within this process only
+NOTE_EVENTS_URL = os.getenv("NOTE_EVENTS_URL", "")
+# Events buffered per subscriber before it is told to resync
+NOTE_EVENTS_QUEUE_SIZE = int(os.getenv("NOTE_EVENTS_QUEUE_SIZE", 256))
+# Idle seconds before a keep-alive ping, kept below proxies' idle timeouts
+NOTE_EVENTS_PING_SECONDS = float(os.getenv("NOTE_EVENTS_PING_SECONDS", 25))
+
+BusListener = Callable[[str, int, dict], None]  # (origin, owner_id, event)
+
+
+class Subscription:
+    """One client's buffered events; fed from any thread, read on the loop that created it."""
+
+    def __init__(self, owner_id: int, maxsize: int):
+        self.owner_id = owner_id
+        self.maxsize = maxsize
+        self.loop = asyncio.get_running_loop()
+        self.overflowed = False
+        self.closed = False
+        self._events = deque()
+        self._ready = asyncio.Event()
+
+    def deliver(self, event: dict) -> None:
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            self._append(event)
+            return
+        try:
+            self.loop.call_soon_threadsafe(self._append, event)
+        except RuntimeError:  # The subscriber's loop is gone
+            self.closed = True
+
+    def _append(self, event: dict) -> None:
+        if len(self._events) >= self.maxsize:
+            self.overflowed = True
+        else:
+            self._events.append(event)
+        self._ready.set()
+
+    def close(self) -> None:
+        self.closed = True
+        self._ready.set()
+
+    async def get(self, timeout: float) -> Optional[dict]:
+        """The next event, a resync event after an overflow, or None on timeout or close."""
+        if not self._events and not self.overflowed and not self.closed:
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        if self.overflowed:
+            return {"type": "resync"}
+        event = self._events.popleft() if self._events else None
+        if not self._events:
+            self._ready.clear()
+        return event
+
+
+class InMemoryEventBus:
+    """Stand-in for a cross-worker pub/sub channel.
+
+    Lives in this process only; brokers attached to the same bus behave like
+    workers sharing a real one, for development and tests.
+    """
+
+    def __init__(self):
+        self._listeners: List[BusListener] = []
+
+    def listen(self, callback: BusListener) -> None:
+        self._listeners.append(callback)
+
+    def start(self) -> None:
+        pass
+
+    def publish(self, origin: str, owner_id: int, event: dict) -> None:
+        for callback in list(self._listeners):
+            callback(origin, owner_id, event)
+
+
+class RedisEventBus:
+    """Cross-worker pub/sub on a Redis channel; needs the optional `redis` package."""
+
+    channel = "notes:events"
+
+    def __init__(self, url: str):
+        import redis.asyncio as redis
+
+        self.client = redis.from_url(url)
+        self._listeners: List[BusListener] = []
+        self._reader: Optional[asyncio.Task] = None
+        self._pending = set()
+
+    def listen(self, callback: BusListener) -> None:
+        self._listeners.append(callback)
+
+    def start(self) -> None:
+        """Start reading the channel; called on the serving loop by the first subscriber."""
+        if self._reader is None:
+            self._reader = asyncio.get_running_loop().create_task(self._read())
+
+    async def _read(self) -> None:
+        pubsub = self.client.pubsub()
+        await pubsub.subscribe(self.channel)
+        async for message in pubsub.listen():
+            if message["type"] != "message":
+                continue
+            data = json.loads(message["data"])
+            for callback in list(self._listeners):
+                callback(data["origin"], data["owner_id"], data["event"])
+
+    def publish(self, origin: str, owner_id: int, event: dict) -> None:
+        payload = json.dumps({"origin": origin, "owner_id": owner_id, "event": event})
+        task = asyncio.get_running_loop().create_task(self.client.publish(self.channel, payload))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+
+class NoteEventBroker:
+    """In-process pub/sub of note events keyed by owner, optionally bridged to a shared bus."""
+
+    def __init__(self, bus=None, queue_size: int = NOTE_EVENTS_QUEUE_SIZE):
+        self.bus = bus
+        self.queue_size = queue_size
+        self.origin = uuid.uuid4().hex
+        self.published = 0
+        self.resyncs = 0
+        self._subscribers: Dict[int, Set[Subscription]] = {}
+        self._lock = threading.Lock()
+        if bus is not None:
+            bus.listen(self._from_bus)
+
+    def subscribe(self, owner_id: int) -> Subscription:
+        if self.bus is not None:
+            self.bus.start()
+        subscription = Subscription(owner_id, self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(owner_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        subscription.close()
+        if subscription.overflowed:
+            self.resyncs += 1
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.owner_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.owner_id]
+
+    def publish(self, owner_id: int, event_type: str, note_id: int,
+                version: Optional[int] = None, change_seq: Optional[int] = None) -> None:
+        """Announce a committed change to one of owner_id's notes."""
+        event = {"type": event_type, "id": note_id, "version": version, "change_seq": change_seq}
+        self.published += 1
+        self._fan_out(owner_id, event)
+        if self.bus is not None:
+            self.bus.publish(self.origin, owner_id, event)
+
+    def _from_bus(self, origin: str, owner_id: int, event: dict) -> None:
+        if origin != self.origin:  # Local subscribers already have it
+            self._fan_out(owner_id, event)
+
+    def _fan_out(self, owner_id: int, event: dict) -> None:
+        with self._lock:
+            subscribers = list(self._subscribers.get(owner_id, ()))
+        for subscription in subscribers:
+            subscription.deliver(event)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+
+def event_bus_from_settings():
+    if NOTE_EVENTS_URL.startswith("memory://"):
+        return InMemoryEventBus()
+    if NOTE_EVENTS_URL:
+        return RedisEventBus(NOTE_EVENTS_URL)
+    return None
+
+
+note_events = NoteEventBroker(event_bus_from_settings())
+
+registry.gauge("note_events_subscribers", "Open note event subscriptions in this process",
+               lambda: len(note_events))
+registry.counter_func("note_events_published_total", "Note events published by this process",
+                      lambda: note_events.published)
+registry.counter_func("note_events_resyncs_total", "Subscribers that fell behind and were told to resync",
+                      lambda: note_events.resyncs)
@@ -0,0 +1,36 @@
+"""
+Fast JSON responses built straight from SQL rows
+
+Routes opt in with FAST_JSON_RESPONSES: they select plain columns, turn
+rows into dicts and hand them to FastJSONResponse, skipping ORM objects,
+response_model validation and jsonable_encoder. Output matches what the
+pydantic response models produce for the same rows.
+"""
+import json
+import os
+from datetime import datetime
+
+from fastapi import Response
+
+try:
+    import orjson
+except ImportError:  # Optional; the stdlib encoder is used without it
+    orjson = None
+
+FAST_JSON_RESPONSES = os.getenv("FAST_JSON_RESPONSES", "false").lower() in ("1", "true", "yes")
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        if orjson is not None:
+            # orjson writes naive datetimes in the same ISO format pydantic does
+            return orjson.dumps(content)
+        return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode()
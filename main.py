@@ -1,67 +1,234 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+from sqlalchemy import String, bindparam, delete, exists, func, insert, select, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import load_only
 from sqlalchemy.exc import IntegrityError
-from typing import List
-import uvicorn
+from sqlalchemy.orm.exc import StaleDataError
+from contextlib import asynccontextmanager
+from typing import List, Optional
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import time
 
-from database import get_db, create_tables, User, Note
+from database import (
+    AsyncSessionLocal, get_async_db, create_tables, pool_stats, engine, async_engine, User, Note, NoteRevision,
+    DB_MIGRATIONS_MANAGED, READ_REPLICA, replica_set
+)
 from schemas import (
     UserCreate, UserResponse, LoginRequest, Token,
-    NoteCreate, NoteUpdate, NoteResponse, ErrorResponse
+    NoteCreate, NoteUpdate, NoteResponse, ErrorResponse,
+    NoteSearchResult, BulkNoteCreate, BulkNoteUpdate, BulkNoteDelete, BulkResponse, ImportSummary,
+    NoteSummary, MAX_PREVIEW_CHARS, NoteRevisionInfo, NoteRevisionResponse,
+    NoteChanges
 )
 from auth import (
-    verify_password, get_password_hash, create_access_token, verify_token,
-    ACCESS_TOKEN_EXPIRE_MINUTES
+    verify_password_async, get_password_hash_async, create_access_token, decode_token,
+    HashPoolSaturated, ACCESS_TOKEN_EXPIRE_MINUTES, hash_pool
 )
+from metrics import registry
+from compression import ResponseCompressionMiddleware, note_text
+from cache import CachedNote, CachedUser, note_cache, user_cache
+from search import search_notes
+from events import NOTE_EVENTS_PING_SECONDS, note_events
+from changes import allocate_change_seqs, changes_since, record_tombstones
+from revisions import has_revision_column, rebuild_revision, revision_rows_async
+from transfer import EXPORT_MEDIA_TYPES, IMPORT_BATCH_SIZE, export_notes, import_notes
+from fastjson import FastJSONResponse
+import fastjson
+from ratelimit import RateLimitMiddleware
+from timing import TimedRoute, TimingMiddleware, instrument_engine, timed
 from datetime import timedelta
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Schema setup runs here rather than at import, and not at all when migrations manage
+    # the schema or start.py already ran it before starting workers
+    if not DB_MIGRATIONS_MANAGED and os.getenv("NOTES_SCHEMA_READY") != "1":
+        create_tables()
+    yield
+    # Runs once in-flight requests have drained; each worker closes its own connections
+    await async_engine.dispose()
+    await replica_set.dispose()
+    engine.dispose()
+    hash_pool.shutdown()
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Notes CRUD API",
     description="A simple CRUD API for managing notes with JWT authentication",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
+# Routes are declared below, after the route class is set
+app.router.route_class = TimedRoute
+# Innermost, so compression time lands in the request's Server-Timing header
+app.add_middleware(ResponseCompressionMiddleware)
+# Added before TimingMiddleware so it runs inside it, which then also records refused requests
+app.add_middleware(RateLimitMiddleware)
+app.add_middleware(TimingMiddleware)
+instrument_engine(engine)
+instrument_engine(async_engine.sync_engine)
+for _replica in replica_set.replicas:
+    instrument_engine(_replica.engine.sync_engine)
 
 # Security scheme
 security = HTTPBearer()
 
-# Create database tables on startup
-create_tables()
+@app.exception_handler(HashPoolSaturated)
+async def hash_pool_saturated_handler(request: Request, exc: HashPoolSaturated):
+    """Shed auth load instead of queueing unbounded bcrypt work."""
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Authentication service is busy. Please retry shortly."},
+        headers={"Retry-After": "1"},
+    )
+
+def encode_cursor(last_id: int) -> str:
+    """Encode the last seen note id as an opaque pagination cursor."""
+    raw = json.dumps({"id": last_id}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> int:
+    """Decode a cursor produced by encode_cursor."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return int(json.loads(base64.urlsafe_b64decode(padded))["id"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid pagination cursor"
+        )
+
+def encode_change_cursor(change_seq: int, note_id: int) -> str:
+    """Encode a change feed position as an opaque sync cursor."""
+    raw = json.dumps({"seq": change_seq, "id": note_id}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_change_cursor(cursor: str) -> tuple:
+    """Decode a cursor produced by encode_change_cursor into (change_seq, note id)."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        position = json.loads(base64.urlsafe_b64decode(padded))
+        return int(position["seq"]), int(position["id"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid sync cursor"
+        )
+
+def note_etag(note_id: int, version: int) -> str:
+    """Strong ETag for one note; (id, version) changes on every write."""
+    return f'"n{note_id}-v{version}"'
+
+def page_etag(rows) -> str:
+    """Strong ETag for a page of notes, fingerprinted from each row's (id, version)."""
+    digest = hashlib.sha1(
+        ",".join(f"{note_id}:{version}" for note_id, version in rows).encode()
+    ).hexdigest()[:20]
+    return f'"p{len(rows)}-{digest}"'
+
+def etag_matches(header: Optional[str], etag: str, weak: bool = True) -> bool:
+    """Check an If-None-Match (weak comparison) or If-Match (strong comparison) header."""
+    if not header:
+        return False
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if weak and candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+def not_modified(etag: str, headers: Optional[dict] = None) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag, **(headers or {})})
+
+# Columns of NoteResponse, selected as plain rows by the FAST_JSON_RESPONSES path
+NOTE_RESPONSE_COLUMNS = (
+    Note.id, Note.title, Note.content, Note.created_at, Note.updated_at, Note.owner_id, Note.version
+)
+
+class NotePage:
+    """One page of a user's notes in id order, by keyset cursor or offset."""
+    
+    def __init__(self, owner_id: int, skip: int, limit: int, cursor: Optional[str]):
+        self.owner_id = owner_id
+        self.skip = skip
+        self.limit = limit
+        self.after_id = decode_cursor(cursor) if cursor is not None else None
+    
+    def query(self, *entities):
+        query = select(*entities).where(Note.owner_id == self.owner_id).order_by(Note.id)
+        if self.after_id is not None:
+            query = query.where(Note.id > self.after_id)
+        elif self.skip:
+            query = query.offset(self.skip)
+        # Fetch one extra row to learn whether another page exists
+        return query.limit(self.limit + 1)
+    
+    def headers(self, rows) -> dict:
+        """ETag and, when another page exists, X-Next-Cursor for the fetched rows."""
+        headers = {"ETag": page_etag([(row.id, row.version) for row in rows[:self.limit]])}
+        if len(rows) > self.limit and self.limit > 0:
+            headers["X-Next-Cursor"] = encode_cursor(rows[self.limit - 1].id)
+        return headers
 
 # Dependency to get current user
 async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
-) -> User:
+    db: AsyncSession = Depends(get_async_db)
+) -> CachedUser:
     """Get the current authenticated user."""
-    token = credentials.credentials
-    username = verify_token(token)
-    if username is None:
+    return await authenticate(credentials.credentials, db)
+
+async def authenticate(token: str, db: AsyncSession) -> CachedUser:
+    """Resolve a bearer token to its user, through the user cache."""
+    cached = user_cache.get(token)
+    if cached is not None:
+        return cached
+    
+    with timed("jwt"):
+        payload = decode_token(token)
+    if payload is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid authentication credentials",
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    user = db.query(User).filter(User.username == username).first()
+    with timed("user"):
+        query = select(User).where(User.username == payload["sub"])
+        user = await db.scalar(query)
+        if user is None and db.info.get(READ_REPLICA):
+            # A replica may not have the account yet, e.g. just after registration
+            user = await db.scalar(query.execution_options(read_primary=True))
     if user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="User not found",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    return user
+    
+    # Cache the verified user until the token expires (or the cache TTL, whichever is first)
+    current_user = CachedUser.from_orm(user)
+    user_cache.set(token, current_user, ttl=payload["exp"] - time.time())
+    return current_user
 
 # Auth endpoints
 @app.post("/auth/register", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
-async def register(user_data: UserCreate, db: Session = Depends(get_db)):
+async def register(user_data: UserCreate, db: AsyncSession = Depends(get_async_db)):
     """Register a new user."""
     try:
         # Check if user already exists
-        existing_user = db.query(User).filter(
+        existing_user = await db.scalar(select(User).where(
             (User.username == user_data.username) | (User.email == user_data.email)
-        ).first()
+        ))
         
         if existing_user:
             raise HTTPException(
@@ -70,7 +237,7 @@ async def register(user_data: UserCreate, db: Session = Depends(get_db)):
             )
         
         # Create new user
-        hashed_password = get_password_hash(user_data.password)
+        hashed_password = await get_password_hash_async(user_data.password)
         db_user = User(
             username=user_data.username,
             email=user_data.email,
@@ -78,24 +245,24 @@ async def register(user_data: UserCreate, db: Session = Depends(get_db)):
         )
         
         db.add(db_user)
-        db.commit()
-        db.refresh(db_user)
+        await db.commit()
+        await db.refresh(db_user)
         
         return db_user
         
     except IntegrityError:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
             detail="Username or email already registered"
         )
 
 @app.post("/auth/login", response_model=Token)
-async def login(login_data: LoginRequest, db: Session = Depends(get_db)):
+async def login(login_data: LoginRequest, db: AsyncSession = Depends(get_async_db)):
     """Authenticate user and return access token."""
-    user = db.query(User).filter(User.username == login_data.username).first()
+    user = await db.scalar(select(User).where(User.username == login_data.username))
     
-    if not user or not verify_password(login_data.password, user.hashed_password):
+    if not user or not await verify_password_async(login_data.password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
@@ -111,7 +278,7 @@ async def login(login_data: LoginRequest, db: Session = Depends(get_db)):
 
 # User endpoints
 @app.get("/users/me", response_model=UserResponse)
-async def get_current_user_profile(current_user: User = Depends(get_current_user)):
+async def get_current_user_profile(current_user: CachedUser = Depends(get_current_user)):
     """Get current user profile."""
     return current_user
 
@@ -119,8 +286,9 @@ async def get_current_user_profile(current_user: User = Depends(get_current_user
 @app.post("/notes", response_model=NoteResponse, status_code=status.HTTP_201_CREATED)
 async def create_note(
     note_data: NoteCreate,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    response: Response,
+    current_user: CachedUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Create a new note."""
     db_note = Note(
@@ -130,33 +298,192 @@ async def create_note(
     )
     
     db.add(db_note)
-    db.commit()
-    db.refresh(db_note)
+    db_note.change_seq = await allocate_change_seqs(db, current_user.id)
+    await db.commit()
+    await db.refresh(db_note)
+    note_events.publish(current_user.id, "created", db_note.id, db_note.version, db_note.change_seq)
     
+    response.headers["ETag"] = note_etag(db_note.id, db_note.version)
     return db_note
 
 @app.get("/notes", response_model=List[NoteResponse])
 async def get_notes(
+    request: Request,
+    response: Response,
+    skip: int = 0,
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    current_user: CachedUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Get notes for the current user, ordered by id.
+
+    Pass the X-Next-Cursor header of a page back as `cursor` to fetch the
+    next one; keyset pagination costs the same on every page, unlike `skip`.
+    Pages carry an ETag; a matching If-None-Match gets a 304 after reading
+    only the page's ids and versions.
+    """
+    page = NotePage(current_user.id, skip, limit, cursor)
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        versions = (await db.execute(page.query(Note.id, Note.version))).all()
+        headers = page.headers(versions)
+        if etag_matches(if_none_match, headers["ETag"]):
+            return not_modified(headers.pop("ETag"), headers)
+    
+    if fastjson.FAST_JSON_RESPONSES:
+        rows = (await db.execute(page.query(*NOTE_RESPONSE_COLUMNS))).all()
+        return FastJSONResponse([row._asdict() for row in rows[:limit]], headers=page.headers(rows))
+    
+    notes = (await db.scalars(page.query(Note))).all()
+    response.headers.update(page.headers(notes))
+    return notes[:limit]
+
+@app.get("/notes/summary", response_model=List[NoteSummary], response_model_exclude_none=True)
+async def get_note_summaries(
+    request: Request,
+    response: Response,
     skip: int = 0,
     limit: int = 100,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    cursor: Optional[str] = None,
+    preview: int = Query(0, ge=0, le=MAX_PREVIEW_CHARS),
+    current_user: CachedUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """List view of the current user's notes without their content.
+
+    Paginates like GET /notes. `preview=N` adds the first N characters of
+    the content, cut by the database so the rest never leaves it.
+    """
+    page = NotePage(current_user.id, skip, limit, cursor)
+    query = page.query(Note).options(load_only(Note.id, Note.title, Note.updated_at, Note.version))
+    if preview:
+        query = query.add_columns(func.substr(note_text(Note.content), 1, preview).label("preview"))
+    rows = (await db.execute(query)).all()
+    
+    headers = page.headers([row.Note for row in rows])
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return not_modified(headers.pop("ETag"), headers)
+    response.headers.update(headers)
+    return [
+        NoteSummary(id=row.Note.id, title=row.Note.title, updated_at=row.Note.updated_at,
+                    version=row.Note.version, preview=row.preview if preview else None)
+        for row in rows[:limit]
+    ]
+
+@app.get("/notes/changes", response_model=NoteChanges)
+async def get_note_changes(
+    since: Optional[str] = Query(None, description="Cursor returned by the previous sync; omit for a full sync"),
+    limit: int = Query(500, ge=1, le=5000),
+    current_user: CachedUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """Get all notes for the current user."""
-    notes = db.query(Note).filter(Note.owner_id == current_user.id).offset(skip).limit(limit).all()
-    return notes
+    """Notes created, updated or deleted after `since`, oldest change first.
+
+    Each note appears once, as last written, at its latest change_seq;
+    deletions come from tombstones. Keep calling with the returned cursor
+    while has_more is true, then store it for the next sync.
+    """
+    after = decode_change_cursor(since) if since is not None else (-1, 0)
+    changes, has_more = await changes_since(db, current_user.id, after, limit)
+    if changes:
+        after = changes[-1][:2]
+    return {
+        "changes": [
+            {"id": note_id, "change_seq": change_seq, "deleted": note is None, "note": note}
+            for change_seq, note_id, note in changes
+        ],
+        "cursor": encode_change_cursor(*after),
+        "has_more": has_more,
+    }
+
+@app.get("/notes/search", response_model=List[NoteSearchResult])
+async def search_user_notes(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    current_user: CachedUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Full-text search over the current user's note titles and content, best matches first."""
+    return await search_notes(db, current_user.id, q, limit, offset)
+
+@app.get("/notes/export", response_class=StreamingResponse)
+async def export_user_notes(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    gzip: bool = Query(False),
+    current_user: CachedUser = Depends(get_current_user)
+):
+    """Stream every note of the current user as NDJSON or CSV, optionally gzip-encoded."""
+    headers = {"Content-Disposition": f'attachment; filename="notes.{format}"'}
+    if gzip:
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(
+        export_notes(current_user.id, format, compress=gzip),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers=headers
+    )
+
+@app.post("/notes/import", response_model=ImportSummary)
+async def import_user_notes(
+    request: Request,
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    batch_size: int = Query(IMPORT_BATCH_SIZE, ge=1, le=10000),
+    current_user: CachedUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Import notes from a streamed NDJSON or CSV body (optionally gzip-encoded).
+
+    CSV bodies need a header row with `title` and `content` columns; other
+    columns, such as those written by /notes/export, are ignored.
+    """
+    gzipped = request.headers.get("content-encoding", "").lower() == "gzip"
+    return await import_notes(db, current_user.id, request.stream(), format, batch_size, gzipped)
 
 @app.get("/notes/{note_id}", response_model=NoteResponse)
 async def get_note(
     note_id: int,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    request: Request,
+    response: Response,
+    current_user: CachedUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """Get a specific note by ID."""
-    note = db.query(Note).filter(
-        Note.id == note_id,
-        Note.owner_id == current_user.id
-    ).first()
+    """Get a specific note by ID, through the note cache.
+
+    Hits from the per-process cache are confirmed against the version
+    column, since other workers' writes don't invalidate it. On a miss,
+    If-None-Match is checked against the version column alone, so a 304
+    never loads the content.
+    """
+    key = (current_user.id, note_id)
+    if_none_match = request.headers.get("if-none-match")
+    version_query = select(Note.version).where(Note.id == note_id, Note.owner_id == current_user.id)
+    note = await note_cache.get(key)
+    version = None
+    if note is not None and note_cache.validates_hits:
+        # A per-process cache doesn't see other workers' writes; confirm the hit without reading content
+        version = await db.scalar(version_query)
+        if version != note.version:
+            note_cache.stale += 1
+            note_cache.invalidate([key])
+            note = None
+    if note is None and if_none_match:
+        if version is None:
+            version = await db.scalar(version_query)
+        if version is not None and etag_matches(if_none_match, note_etag(note_id, version)):
+            return not_modified(note_etag(note_id, version))
+    
+    if note is None:
+        async def load_note() -> Optional[CachedNote]:
+            row = await db.scalar(select(Note).where(
+                Note.id == note_id,
+                Note.owner_id == current_user.id
+            ))
+            return CachedNote.from_orm(row) if row is not None else None
+        
+        note = await note_cache.load(key, load_note)
+    elif etag_matches(if_none_match, note_etag(note.id, note.version)):
+        return not_modified(note_etag(note.id, note.version))
     
     if not note:
         raise HTTPException(
@@ -164,67 +491,199 @@ async def get_note(
             detail="Note not found"
         )
     
+    if fastjson.FAST_JSON_RESPONSES:
+        return FastJSONResponse(vars(note), headers={"ETag": note_etag(note.id, note.version)})
+    response.headers["ETag"] = note_etag(note.id, note.version)
     return note
 
-@app.put("/notes/{note_id}", response_model=NoteResponse)
-async def update_note(
+@app.get("/notes/{note_id}/revisions", response_model=List[NoteRevisionInfo])
+async def list_note_revisions(
     note_id: int,
-    note_update: NoteUpdate,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    before: Optional[int] = Query(None, ge=1, description="Only versions older than this one"),
+    limit: int = Query(100, ge=1, le=1000),
+    current_user: CachedUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """List a note's versions, newest first, without rebuilding their content."""
+    note = (await db.execute(
+        select(Note.version, Note.title, Note.updated_at)
+        .where(Note.id == note_id, Note.owner_id == current_user.id)
+    )).first()
+    if not note:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Note not found"
+        )
+    
+    query = select(NoteRevision.version, NoteRevision.title, NoteRevision.created_at).where(
+        NoteRevision.note_id == note_id
+    )
+    if before is not None:
+        query = query.where(NoteRevision.version < before)
+    rows = (await db.execute(query.order_by(NoteRevision.version.desc()).limit(limit))).all()
+    revisions = [row._asdict() for row in rows]
+    # A note that was never updated has no history rows yet; its current version still counts
+    if (before is None or note.version < before) and (not rows or rows[0].version != note.version):
+        revisions = [{"version": note.version, "title": note.title, "created_at": note.updated_at}]
+        revisions += [row._asdict() for row in rows[:limit - 1]]
+    return revisions
+
+@app.get("/notes/{note_id}/revisions/{version}", response_model=NoteRevisionResponse)
+async def get_note_revision(
+    note_id: int,
+    version: int,
+    response: Response,
+    current_user: CachedUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """Update a note with optimistic locking to prevent race conditions."""
-    # Get the current note
-    note = db.query(Note).filter(
+    """Get one version of a note, rebuilt from the nearest snapshot in its history.
+
+    Past versions never change, so they are served as immutable.
+    """
+    note = await db.scalar(select(Note).where(
         Note.id == note_id,
         Note.owner_id == current_user.id
-    ).first()
-    
+    ))
     if not note:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Note not found"
         )
     
-    # Check version for optimistic locking
-    if note.version != note_update.version:
+    response.headers["ETag"] = note_etag(note_id, version)
+    if version == note.version:
+        return {"note_id": note.id, "version": note.version, "title": note.title,
+                "content": note.content, "created_at": note.updated_at}
+    revision = await rebuild_revision(db, note_id, version) if version < note.version else None
+    if revision is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Revision not found"
+        )
+    response.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+    return revision
+
+def check_update_preconditions(note_update: NoteUpdate, if_match: Optional[str], note_id: int, version: int) -> None:
+    """Raise 412 or 409 unless the request's If-Match / body version names `version`."""
+    current_etag = note_etag(note_id, version)
+    if if_match is not None and not etag_matches(if_match, current_etag, weak=False):
+        raise HTTPException(
+            status_code=status.HTTP_412_PRECONDITION_FAILED,
+            detail="Note has been modified by another user. Please refresh and try again.",
+            headers={"X-Current-Version": str(version), "ETag": current_etag}
+        )
+    if note_update.version is not None and version != note_update.version:
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
             detail="Note has been modified by another user. Please refresh and try again.",
-            headers={"X-Current-Version": str(note.version)}
+            headers={"X-Current-Version": str(version)}
+        )
+
+@app.put("/notes/{note_id}", response_model=NoteResponse)
+async def update_note(
+    note_id: int,
+    note_update: NoteUpdate,
+    request: Request,
+    response: Response,
+    current_user: CachedUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Update a note with optimistic locking to prevent race conditions.
+
+    The expected version comes from the body `version` or, alternatively,
+    an If-Match header carrying the note's ETag. The write is a single
+    compare-and-swap UPDATE ... WHERE version = ? RETURNING, so two writers
+    of the same version can't both succeed and the new row needs no refresh.
+    The revision history needs the previous text; it comes from the note
+    cache when that holds the expected version, otherwise from one SELECT.
+    """
+    if_match = request.headers.get("if-match")
+    if if_match is None and note_update.version is None:
+        raise HTTPException(
+            status_code=status.HTTP_428_PRECONDITION_REQUIRED,
+            detail="Send the note version in the body or as an If-Match ETag"
         )
     
-    # Update fields if provided
+    previous = await note_cache.get((current_user.id, note_id))
+    if previous is not None:
+        try:
+            check_update_preconditions(note_update, if_match, note_id, previous.version)
+        except HTTPException:
+            previous = None  # Another worker's write may not have reached this cache; ask the database
+    if previous is None:
+        previous = (await db.execute(
+            select(Note.version, Note.title, Note.content, Note.updated_at)
+            .where(Note.id == note_id, Note.owner_id == current_user.id)
+        )).first()
+        if not previous:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Note not found"
+            )
+        check_update_preconditions(note_update, if_match, note_id, previous.version)
+    
+    notes_table = Note.__table__
+    values = {"version": notes_table.c.version + 1}
     if note_update.title is not None:
-        note.title = note_update.title
+        values["title"] = note_update.title
     if note_update.content is not None:
-        note.content = note_update.content
-    
-    # Increment version
-    note.version += 1
+        values["content"] = note_update.content
+    values["change_seq"] = await allocate_change_seqs(db, current_user.id)
+    # Whether the replaced version is already in the history, so its snapshot is only written once
+    has_revision = exists().where(
+        NoteRevision.note_id == note_id, NoteRevision.version == previous.version
+    ).label("has_revision")
+    row = (await db.execute(
+        update(notes_table)
+        .where(
+            notes_table.c.id == note_id,
+            notes_table.c.owner_id == current_user.id,
+            notes_table.c.version == previous.version,
+        )
+        .values(**values)
+        .returning(*NOTE_RESPONSE_COLUMNS, Note.change_seq, has_revision)
+        .execution_options(note_cache_keys=[(current_user.id, note_id)])
+    )).first()
     
-    try:
-        db.commit()
-        db.refresh(note)
-        return note
-    except IntegrityError:
-        db.rollback()
+    if row is None:
+        # Changed or deleted after the versions were compared
+        await db.rollback()
+        version = await db.scalar(select(Note.version).where(
+            Note.id == note_id,
+            Note.owner_id == current_user.id
+        ))
+        if version is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Note not found"
+            )
+        check_update_preconditions(note_update, if_match, note_id, version)
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
-            detail="Failed to update note due to concurrent modification"
+            detail="Failed to update note due to concurrent modification",
+            headers={"X-Current-Version": str(version)}
         )
+    
+    await db.execute(insert(NoteRevision), await revision_rows_async(
+        note_id, previous.version, previous.title, previous.content, previous.updated_at,
+        row.has_revision, row.title, row.content
+    ))
+    await db.commit()
+    note_events.publish(current_user.id, "updated", note_id, row.version, row.change_seq)
+    response.headers["ETag"] = note_etag(note_id, row.version)
+    return row._asdict()
 
 @app.delete("/notes/{note_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_note(
     note_id: int,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: CachedUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Delete a note."""
-    note = db.query(Note).filter(
+    note = await db.scalar(select(Note).where(
         Note.id == note_id,
         Note.owner_id == current_user.id
-    ).first()
+    ))
     
     if not note:
         raise HTTPException(
@@ -232,8 +691,271 @@ async def delete_note(
             detail="Note not found"
         )
     
-    db.delete(note)
-    db.commit()
+    await db.delete(note)
+    change_seqs = await record_tombstones(db, current_user.id, [note.id])
+    try:
+        await db.commit()
+    except StaleDataError:
+        # version_id_col: the note was updated after it was loaded
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Failed to delete note due to concurrent modification"
+        )
+    note_events.publish(current_user.id, "deleted", note.id, change_seq=change_seqs[note.id])
+
+# Bulk notes endpoints
+async def _current_versions(db: AsyncSession, owner_id: int, note_ids: List[int]) -> dict:
+    """Map note id -> version for the given ids owned by owner_id, in one query."""
+    rows = await db.execute(
+        select(Note.id, Note.version).where(Note.owner_id == owner_id, Note.id.in_(set(note_ids)))
+    )
+    return dict(rows.all())
+
+@app.post("/notes/bulk", response_model=BulkResponse)
+async def bulk_create_notes(
+    bulk: BulkNoteCreate,
+    current_user: CachedUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Create many notes in one transaction with a single multi-row INSERT ... RETURNING."""
+    if not bulk.items:
+        return {"results": []}
+    first_seq = await allocate_change_seqs(db, current_user.id, len(bulk.items))
+    rows = [
+        {"title": item.title, "content": item.content, "owner_id": current_user.id, "change_seq": first_seq + index}
+        for index, item in enumerate(bulk.items)
+    ]
+    notes = (await db.scalars(
+        insert(Note).returning(Note, sort_by_parameter_order=True), rows
+    )).all()
+    await db.commit()
+    for note in notes:
+        note_events.publish(current_user.id, "created", note.id, note.version, note.change_seq)
+    
+    return {"results": [
+        {"index": index, "status": status.HTTP_201_CREATED, "id": note.id, "note": note}
+        for index, note in enumerate(notes)
+    ]}
+
+@app.patch("/notes/bulk", response_model=BulkResponse)
+async def bulk_update_notes(
+    bulk: BulkNoteUpdate,
+    current_user: CachedUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Update many notes in one transaction, applying the version check to each item.
+
+    Versions are checked against one locking SELECT that also reads the
+    pre-images, every passing item is written by a single executemany UPDATE
+    plus one executemany revision INSERT, and the new rows are read back with
+    one more SELECT, so the cost is four statements for any batch size.
+    """
+    # Row locks on PostgreSQL; SQLite's single writer makes the read-then-write safe already
+    current = {
+        row.id: list(row[1:]) for row in (await db.execute(
+            select(Note.id, Note.version, Note.title, Note.content, Note.updated_at, has_revision_column())
+            .where(Note.owner_id == current_user.id, Note.id.in_({item.id for item in bulk.items}))
+            .with_for_update()
+        )).all()
+    }
+    results = []
+    params = []
+    revisions = []
+    
+    for index, item in enumerate(bulk.items):
+        state = current.get(item.id)
+        current_version = state[0] if state else None
+        if current_version is None:
+            results.append({"index": index, "status": status.HTTP_404_NOT_FOUND, "id": item.id,
+                            "detail": "Note not found"})
+            continue
+        if current_version != item.version:
+            results.append({"index": index, "status": status.HTTP_409_CONFLICT, "id": item.id,
+                            "detail": "Note has been modified by another user.",
+                            "current_version": current_version})
+            continue
+        # Later items for the same note must carry the version this one produces
+        _, title, content, updated_at, has_revision = state
+        new_title = item.title if item.title is not None else title
+        new_content = item.content if item.content is not None else content
+        revisions.extend(await revision_rows_async(
+            item.id, current_version, title, content, updated_at, has_revision, new_title, new_content
+        ))
+        current[item.id] = [current_version + 1, new_title, new_content, None, True]
+        params.append({"b_id": item.id, "b_version": item.version,
+                       "b_title": item.title, "b_content": item.content})
+        results.append({"index": index, "status": status.HTTP_200_OK, "id": item.id})
+    
+    if params:
+        first_seq = await allocate_change_seqs(db, current_user.id, len(params))
+        for offset, param in enumerate(params):
+            param["b_seq"] = first_seq + offset
+        notes_table = Note.__table__
+        result = await db.execute(
+            update(notes_table)
+            .where(
+                notes_table.c.id == bindparam("b_id"),
+                notes_table.c.owner_id == current_user.id,
+                notes_table.c.version == bindparam("b_version"),
+            )
+            .values(
+                title=func.coalesce(bindparam("b_title", type_=String), notes_table.c.title),
+                content=func.coalesce(
+                    bindparam("b_content", type_=notes_table.c.content.type), notes_table.c.content
+                ),
+                version=notes_table.c.version + 1,
+                change_seq=bindparam("b_seq"),
+            )
+            .execution_options(note_cache_keys=[(current_user.id, p["b_id"]) for p in params]),
+            params,
+        )
+        if 0 <= result.rowcount < len(params):
+            # A writer got past the version check despite the lock; fail the batch rather than lose an update
+            await db.rollback()
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Failed to update notes due to concurrent modification"
+            )
+        await db.execute(insert(NoteRevision), revisions)
+        updated = {
+            note.id: note for note in (await db.scalars(
+                select(Note)
+                .where(Note.owner_id == current_user.id, Note.id.in_({p["b_id"] for p in params}))
+                .execution_options(populate_existing=True)
+            )).all()
+        }
+        for entry in results:
+            if entry["status"] == status.HTTP_200_OK:
+                entry["note"] = updated[entry["id"]]
+    
+    await db.commit()
+    if params:
+        for note in updated.values():
+            note_events.publish(current_user.id, "updated", note.id, note.version, note.change_seq)
+    return {"results": results}
+
+@app.post("/notes/bulk/delete", response_model=BulkResponse)
+async def bulk_delete_notes(
+    bulk: BulkNoteDelete,
+    current_user: CachedUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Delete many notes in one transaction; items carrying a version are only deleted at that version."""
+    versions = await _current_versions(db, current_user.id, [item.id for item in bulk.items])
+    results = {}
+    unversioned, versioned = [], []
+    
+    for index, item in enumerate(bulk.items):
+        current_version = versions.get(item.id)
+        if current_version is None:
+            results[index] = {"index": index, "status": status.HTTP_404_NOT_FOUND, "id": item.id,
+                              "detail": "Note not found"}
+        elif item.version is not None and item.version != current_version:
+            results[index] = {"index": index, "status": status.HTTP_409_CONFLICT, "id": item.id,
+                              "detail": "Note has been modified by another user.",
+                              "current_version": current_version}
+        else:
+            # Later items naming the same note see it as already gone
+            del versions[item.id]
+            if item.version is None:
+                unversioned.append((index, item.id))
+            else:
+                versioned.append((index, item.id, item.version))
+    
+    deleted = set()
+    if unversioned:
+        deleted.update((await db.scalars(
+            delete(Note)
+            .where(Note.owner_id == current_user.id, Note.id.in_([note_id for _, note_id in unversioned]))
+            .returning(Note.id)
+            .execution_options(
+                synchronize_session=False,
+                note_cache_keys=[(current_user.id, note_id) for _, note_id in unversioned]
+            )
+        )).all())
+    if versioned:
+        deleted.update((await db.scalars(
+            delete(Note)
+            .where(
+                Note.owner_id == current_user.id,
+                tuple_(Note.id, Note.version).in_([(note_id, version) for _, note_id, version in versioned])
+            )
+            .returning(Note.id)
+            .execution_options(
+                synchronize_session=False,
+                note_cache_keys=[(current_user.id, note_id) for _, note_id, _ in versioned]
+            )
+        )).all())
+    change_seqs = await record_tombstones(db, current_user.id, deleted)
+    await db.commit()
+    for note_id, change_seq in change_seqs.items():
+        note_events.publish(current_user.id, "deleted", note_id, change_seq=change_seq)
+    
+    for index, note_id, *_ in unversioned + versioned:
+        if note_id in deleted:
+            results[index] = {"index": index, "status": status.HTTP_204_NO_CONTENT, "id": note_id}
+        else:
+            results[index] = {"index": index, "status": status.HTTP_409_CONFLICT, "id": note_id,
+                              "detail": "Failed to delete note due to concurrent modification"}
+    return {"results": [results[index] for index in sorted(results)]}
+
+# Change notifications
+# Browsers can't set headers on a WebSocket, so they offer this subprotocol followed by the token
+WS_BEARER_PROTOCOL = "notes.bearer"
+
+@app.websocket("/notes/events")
+async def note_events_socket(websocket: WebSocket):
+    """Push an event for every committed change to the user's notes.
+
+    The bearer token comes in an Authorization header or, from browsers, as
+    the subprotocol after "notes.bearer" (never in the URL, which ends up in
+    access logs). The database is only used to authenticate; an idle
+    subscriber holds no connection from the pool.
+    """
+    token = None
+    authorization = websocket.headers.get("authorization", "")
+    protocols = websocket.scope.get("subprotocols", [])
+    if authorization.lower().startswith("bearer "):
+        token = authorization[7:]
+    elif WS_BEARER_PROTOCOL in protocols[:-1]:
+        token = protocols[protocols.index(WS_BEARER_PROTOCOL) + 1]
+    try:
+        if token is None:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)
+        async with AsyncSessionLocal() as db:
+            current_user = await authenticate(token, db)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    
+    # The handshake must select one of the offered subprotocols; it never echoes the token
+    await websocket.accept(subprotocol=WS_BEARER_PROTOCOL if WS_BEARER_PROTOCOL in protocols else None)
+    subscription = note_events.subscribe(current_user.id)
+    
+    async def watch_disconnect():
+        # Client messages are ignored; a disconnect ends the subscription
+        try:
+            while (await websocket.receive())["type"] != "websocket.disconnect":
+                pass
+        finally:
+            subscription.close()
+    
+    watcher = asyncio.create_task(watch_disconnect())
+    try:
+        while True:
+            event = await subscription.get(NOTE_EVENTS_PING_SECONDS)
+            if subscription.closed:
+                break
+            await websocket.send_json(event if event is not None else {"type": "ping"})
+            if event is not None and event["type"] == "resync":
+                await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+                break
+    except (WebSocketDisconnect, RuntimeError):
+        pass  # The client went away mid-send
+    finally:
+        watcher.cancel()
+        note_events.unsubscribe(subscription)
 
 # Health check endpoint
 @app.get("/health")
@@ -241,7 +963,22 @@ async def health_check():
     """Health check endpoint."""
     return {"status": "healthy"}
 
+@app.get("/health/pool")
+async def get_pool_stats():
+    """Connection pool occupancy and checkout wait times."""
+    return {
+        "async": pool_stats(async_engine.pool),
+        "sync": pool_stats(engine.pool),
+        **{replica.name: {**pool_stats(replica.engine.pool), "healthy": replica.healthy}
+           for replica in replica_set.replicas},
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus metrics endpoint."""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
-    import os
+    import uvicorn
     port = int(os.environ.get("PORT", 8000))
     uvicorn.run(app, host="0.0.0.0", port=port)
@@ -0,0 +1,280 @@
+"""
+Rate limiting and adaptive load shedding in front of the app
+
+Every HTTP request except health checks and /metrics takes a token from a
+bucket: one per authenticated user (the JWT `sub`), one per client IP for
+anonymous requests, and a tighter per-IP bucket for /auth/login and
+/auth/register, where every request costs a bcrypt hash. An empty bucket
+answers 429 with Retry-After before any database or bcrypt work.
+
+LoadShedder watches the p99 time to first byte of the requests let through
+and the time checkouts wait on the database pool. While either is over its
+threshold it halves every bucket's rate and burst once a second, so the
+heaviest clients are throttled first and light ones keep their headroom;
+when that reaches its floor and the server is still overloaded, requests
+get 503 until latency recovers. Healthy seconds restore the rates gradually.
+"""
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Callable, Optional, Tuple
+
+from auth import verify_token
+from database import pool_wait
+from metrics import registry
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes")
+# Requests per second and burst size per user (or per IP without a valid token)
+RATE_LIMIT_USER_RATE = float(os.getenv("RATE_LIMIT_USER_RATE", 100))
+RATE_LIMIT_USER_BURST = float(os.getenv("RATE_LIMIT_USER_BURST", 1000))
+# Per-IP budget for /auth/login and /auth/register
+RATE_LIMIT_AUTH_RATE = float(os.getenv("RATE_LIMIT_AUTH_RATE", 5))
+RATE_LIMIT_AUTH_BURST = float(os.getenv("RATE_LIMIT_AUTH_BURST", 50))
+RATE_LIMIT_MAX_BUCKETS = int(os.getenv("RATE_LIMIT_MAX_BUCKETS", 100000))
+# memory:// (the in-process store) or redis://... to share buckets between workers
+RATE_LIMIT_SHARED_URL = os.getenv("RATE_LIMIT_SHARED_URL", "")
+# Take the client address from X-Forwarded-For; only safe behind a proxy that sets it
+RATE_LIMIT_TRUST_PROXY = os.getenv("RATE_LIMIT_TRUST_PROXY", "false").lower() in ("1", "true", "yes")
+
+# Load shedding thresholds; 0 turns a signal off
+SHED_P99_MS = float(os.getenv("SHED_P99_MS", 1000))
+SHED_POOL_WAIT_MS = float(os.getenv("SHED_POOL_WAIT_MS", 100))
+SHED_WINDOW_SECONDS = float(os.getenv("SHED_WINDOW_SECONDS", 10))
+SHED_MIN_FACTOR = float(os.getenv("SHED_MIN_FACTOR", 0.1))
+# Fewer requests than this in the window is too little traffic for a p99 worth acting on
+SHED_MIN_SAMPLES = int(os.getenv("SHED_MIN_SAMPLES", 50))
+
+AUTH_PATHS = ("/auth/login", "/auth/register")
+EXEMPT_PATHS = ("/health", "/health/pool", "/metrics")
+
+rejections = registry.counter(
+    "rate_limit_rejections_total", "Requests refused before reaching a handler", ["reason"]
+)
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    rate: float  # Tokens added per second
+    burst: float  # Bucket capacity
+
+
+class LocalBucketStore:
+    """Token buckets in this process: O(1) per request, least recently used keys evicted."""
+
+    def __init__(self, maxsize: int = RATE_LIMIT_MAX_BUCKETS, clock: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.clock = clock
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        """Take a token; 0 if one was available, else seconds until one will be."""
+        with self._lock:
+            now = self.clock()
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                tokens = burst
+                if len(self._buckets) >= self.maxsize:
+                    self._buckets.popitem(last=False)
+            else:
+                tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                self._buckets.move_to_end(key)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            self._buckets[key] = (tokens - 1 if tokens >= 1 else tokens, now)
+            return wait
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class RedisBucketStore:
+    """Token buckets shared by every worker on Redis; needs the optional `redis` package."""
+
+    # Refill, take and expire in one atomic step
+    SCRIPT = """
+    local bucket = redis.call('HMGET', KEYS[1], 't', 'ts')
+    local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+    local tokens = burst
+    if bucket[1] then
+        tokens = math.min(burst, tonumber(bucket[1]) + math.max(0, now - tonumber(bucket[2])) * rate)
+    end
+    local wait = 0
+    if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+    redis.call('HSET', KEYS[1], 't', tokens, 'ts', now)
+    redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+    return tostring(wait)
+    """
+
+    def __init__(self, url: str):
+        import redis.asyncio as redis
+
+        self.client = redis.from_url(url)
+        self.script = self.client.register_script(self.SCRIPT)
+
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        return float(await self.script(keys=["ratelimit:" + key], args=[rate, burst, time.time()]))
+
+    def __len__(self) -> int:
+        return 0  # Not tracked; the store is shared with other processes
+
+
+class LoadShedder:
+    """AIMD factor applied to every rate limit, driven by p99 latency and pool wait."""
+
+    def __init__(
+        self, p99_ms: float = SHED_P99_MS, pool_wait_ms: float = SHED_POOL_WAIT_MS,
+        window: float = SHED_WINDOW_SECONDS, min_factor: float = SHED_MIN_FACTOR,
+        min_samples: int = SHED_MIN_SAMPLES, clock: Callable[[], float] = time.monotonic,
+    ):
+        self.p99_ms = p99_ms
+        self.pool_wait_ms = pool_wait_ms
+        self.window = window
+        self.min_factor = min_factor
+        self.min_samples = max(min_samples, 1)
+        self.clock = clock
+        self.factor = 1.0
+        self.overloaded = False
+        self.p99: Optional[float] = None
+        self.samples = deque(maxlen=20000)  # (observed_at, seconds)
+        self._evaluated_at = clock()
+        self._pool_seen = (pool_wait.count("async"), pool_wait.total("async"))
+
+    @property
+    def shedding(self) -> bool:
+        return self.overloaded and self.factor <= self.min_factor
+
+    def observe(self, seconds: float) -> None:
+        self.samples.append((self.clock(), seconds))
+
+    def evaluate(self, force: bool = False) -> None:
+        """Re-check the load at most once a second and adjust the factor."""
+        now = self.clock()
+        if not force and now - self._evaluated_at < 1.0:
+            return
+        self._evaluated_at = now
+        while self.samples and self.samples[0][0] < now - self.window:
+            self.samples.popleft()
+        durations = sorted(seconds for _, seconds in self.samples)
+        self.p99 = durations[int(len(durations) * 0.99)] if len(durations) >= self.min_samples else None
+
+        count, total = pool_wait.count("async"), pool_wait.total("async")
+        waits, waited = count - self._pool_seen[0], total - self._pool_seen[1]
+        self._pool_seen = (count, total)
+
+        self.overloaded = bool(
+            (self.p99_ms and self.p99 is not None and self.p99 * 1000 > self.p99_ms)
+            or (self.pool_wait_ms and waits and waited / waits * 1000 > self.pool_wait_ms)
+        )
+        if self.overloaded:
+            self.factor = max(self.min_factor, self.factor / 2)
+        else:
+            self.factor = min(1.0, self.factor + 0.1)
+
+
+class RateLimiter:
+    """Which bucket a request draws from, and the limits and shedder applied to it."""
+
+    def __init__(self, store, user_limit: RateLimit, auth_limit: RateLimit, shedder: LoadShedder,
+                 enabled: bool = RATE_LIMIT_ENABLED):
+        self.store = store
+        self.user_limit = user_limit
+        self.auth_limit = auth_limit
+        self.shedder = shedder
+        self.enabled = enabled
+
+    @staticmethod
+    def client_ip(scope) -> str:
+        if RATE_LIMIT_TRUST_PROXY:
+            for name, value in scope["headers"]:
+                if name == b"x-forwarded-for":
+                    return value.decode("latin-1").split(",")[0].strip()
+        client = scope.get("client")
+        return client[0] if client else "unknown"
+
+    def bucket(self, scope) -> Tuple[str, str, RateLimit]:
+        """(reason label, bucket key, limit) for a request."""
+        if scope["path"] in AUTH_PATHS:
+            return "auth", "auth:" + self.client_ip(scope), self.auth_limit
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                scheme, _, token = value.decode("latin-1").partition(" ")
+                subject = verify_token(token) if scheme.lower() == "bearer" else None
+                if subject is not None:
+                    return "user", "user:" + subject, self.user_limit
+                break
+        return "user", "ip:" + self.client_ip(scope), self.user_limit
+
+
+def _store_from_settings():
+    if RATE_LIMIT_SHARED_URL and not RATE_LIMIT_SHARED_URL.startswith("memory://"):
+        return RedisBucketStore(RATE_LIMIT_SHARED_URL)
+    return LocalBucketStore()
+
+
+rate_limiter = RateLimiter(
+    _store_from_settings(),
+    RateLimit(RATE_LIMIT_USER_RATE, RATE_LIMIT_USER_BURST),
+    RateLimit(RATE_LIMIT_AUTH_RATE, RATE_LIMIT_AUTH_BURST),
+    LoadShedder(),
+)
+
+registry.gauge("load_shed_factor", "Fraction of the configured rate limits currently granted",
+               lambda: rate_limiter.shedder.factor)
+registry.gauge("rate_limit_buckets", "Token buckets held in this process", lambda: len(rate_limiter.store))
+
+
+async def _reject(send, status_code: int, detail: str, retry_after: float) -> None:
+    body = json.dumps({"detail": detail}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status_code,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class RateLimitMiddleware:
+    """Pure ASGI middleware, so a refused request costs no routing, parsing or session."""
+
+    def __init__(self, app, limiter: RateLimiter = rate_limiter):
+        self.app = app
+        self.limiter = limiter
+
+    async def __call__(self, scope, receive, send):
+        limiter = self.limiter
+        if scope["type"] != "http" or not limiter.enabled or scope["path"] in EXEMPT_PATHS:
+            return await self.app(scope, receive, send)
+
+        shedder = limiter.shedder
+        shedder.evaluate()
+        if shedder.shedding:
+            rejections.inc("overload")
+            return await _reject(send, 503, "Server is overloaded. Please retry shortly.", 1)
+
+        reason, key, limit = limiter.bucket(scope)
+        factor = shedder.factor
+        wait = await limiter.store.take(key, limit.rate * factor, max(1.0, limit.burst * factor))
+        if wait > 0:
+            rejections.inc(reason)
+            return await _reject(send, 429, "Rate limit exceeded. Please slow down.", wait)
+
+        # Latency is measured to the start of the response, so long streamed bodies don't count
+        start = time.perf_counter()
+        started = False
+
+        async def send_observed(message):
+            nonlocal started
+            if not started and message["type"] == "http.response.start":
+                started = True
+                shedder.observe(time.perf_counter() - start)
+            await send(message)
+
+        await self.app(scope, receive, send_observed)
@@ -0,0 +1,153 @@
+"""
+Note revision history stored as line deltas with periodic snapshots.
+
+Every write to a note records the version it produces in note_revisions:
+a full snapshot every REVISION_SNAPSHOT_INTERVAL versions, otherwise a
+delta against the previous version's content. A version is rebuilt from
+the nearest snapshot at or below it, so at most REVISION_SNAPSHOT_INTERVAL
+rows are read. Notes written before history existed get a snapshot of
+their pre-image on their next update, which anchors the chain.
+"""
+import asyncio
+import json
+import os
+from datetime import datetime
+from difflib import SequenceMatcher
+from typing import List, Optional, Union
+
+from sqlalchemy import exists, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import Note, NoteRevision
+
+REVISION_SNAPSHOT_INTERVAL = int(os.getenv("REVISION_SNAPSHOT_INTERVAL", 20))
+# Changed regions longer than this (old + new lines) are stored as one replacement instead of being diffed
+REVISION_DIFF_MAX_LINES = int(os.getenv("REVISION_DIFF_MAX_LINES", 2000))
+# Content larger than this is stored as a snapshot without diffing
+REVISION_DELTA_MAX_BYTES = int(os.getenv("REVISION_DELTA_MAX_BYTES", 256 * 1024))
+# Updates with more text than this are diffed in a worker thread, off the event loop
+REVISION_DIFF_THREAD_BYTES = int(os.getenv("REVISION_DIFF_THREAD_BYTES", 64 * 1024))
+
+# A delta is a list of operations over the old text's lines:
+#   n > 0   copy the next n old lines
+#   n < 0   skip the next -n old lines
+#   "text"  insert text
+DeltaOp = Union[int, str]
+
+
+def make_delta(old: str, new: str) -> List[DeltaOp]:
+    a = old.splitlines(keepends=True)
+    if old == new:
+        return [len(a)] if a else []
+    b = new.splitlines(keepends=True)
+    # Common leading and trailing lines are matched in linear time; only the
+    # changed region in between goes through SequenceMatcher
+    prefix = 0
+    limit = min(len(a), len(b))
+    while prefix < limit and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+    a_mid, b_mid = a[prefix:len(a) - suffix], b[prefix:len(b) - suffix]
+
+    ops: List[DeltaOp] = [prefix] if prefix else []
+    if len(a_mid) + len(b_mid) > REVISION_DIFF_MAX_LINES:
+        opcodes = [("replace", 0, len(a_mid), 0, len(b_mid))]
+    else:
+        # autojunk keeps repeated lines (blank lines in markdown) from making the match quadratic
+        opcodes = SequenceMatcher(None, a_mid, b_mid).get_opcodes()
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == "equal":
+            ops.append(i2 - i1)
+            continue
+        if i2 > i1:
+            ops.append(i1 - i2)
+        if j2 > j1:
+            ops.append("".join(b_mid[j1:j2]))
+    if suffix:
+        ops.append(suffix)
+    return ops
+
+
+def apply_delta(old: str, ops: List[DeltaOp]) -> str:
+    lines = old.splitlines(keepends=True)
+    out = []
+    position = 0
+    for op in ops:
+        if isinstance(op, str):
+            out.append(op)
+        elif op > 0:
+            out.extend(lines[position:position + op])
+            position += op
+        else:
+            position -= op
+    return "".join(out)
+
+
+def has_revision_column():
+    """Whether the note's current version is already in note_revisions, for selecting alongside Note."""
+    return exists().where(
+        NoteRevision.note_id == Note.id, NoteRevision.version == Note.version
+    ).label("has_revision")
+
+
+def _snapshot(note_id: int, version: int, title: str, content: str, created_at: Optional[datetime]) -> dict:
+    return {"note_id": note_id, "version": version, "is_snapshot": True, "title": title,
+            "data": content, "created_at": created_at or datetime.utcnow()}
+
+
+def revision_rows(
+    note_id: int, old_version: int, old_title: str, old_content: str, old_updated_at: Optional[datetime],
+    has_revision: bool, new_title: str, new_content: str
+) -> List[dict]:
+    """Rows recording the update old_version -> old_version + 1, anchoring the chain first if needed."""
+    rows = []
+    if not has_revision:
+        rows.append(_snapshot(note_id, old_version, old_title, old_content, old_updated_at))
+    version = old_version + 1
+    delta = None
+    if version % REVISION_SNAPSHOT_INTERVAL and len(new_content) <= REVISION_DELTA_MAX_BYTES:
+        delta = json.dumps(make_delta(old_content, new_content), ensure_ascii=False, separators=(",", ":"))
+    if delta is None or len(delta) >= len(new_content):
+        rows.append(_snapshot(note_id, version, new_title, new_content, None))
+    else:
+        rows.append({"note_id": note_id, "version": version, "is_snapshot": False, "title": new_title,
+                     "data": delta, "created_at": datetime.utcnow()})
+    return rows
+
+
+async def revision_rows_async(
+    note_id: int, old_version: int, old_title: str, old_content: str, old_updated_at: Optional[datetime],
+    has_revision: bool, new_title: str, new_content: str
+) -> List[dict]:
+    """revision_rows, run in a worker thread when the texts are large enough for diffing to block the loop."""
+    args = (note_id, old_version, old_title, old_content, old_updated_at, has_revision, new_title, new_content)
+    if len(old_content) + len(new_content) > REVISION_DIFF_THREAD_BYTES:
+        return await asyncio.to_thread(revision_rows, *args)
+    return revision_rows(*args)
+
+
+async def rebuild_revision(db: AsyncSession, note_id: int, version: int) -> Optional[dict]:
+    """Rebuild one version of a note from its nearest snapshot, or None if it isn't recorded."""
+    rows = (await db.execute(
+        select(NoteRevision.version, NoteRevision.is_snapshot, NoteRevision.title,
+               NoteRevision.data, NoteRevision.created_at)
+        .where(
+            NoteRevision.note_id == note_id,
+            NoteRevision.version <= version,
+            NoteRevision.version > version - REVISION_SNAPSHOT_INTERVAL,
+        )
+        .order_by(NoteRevision.version)
+    )).all()
+    if not rows or rows[-1].version != version:
+        return None
+    start = max((i for i, row in enumerate(rows) if row.is_snapshot), default=None)
+    if start is None:
+        return None
+    content = rows[start].data
+    for row in rows[start + 1:]:
+        content = apply_delta(content, json.loads(row.data))
+    target = rows[-1]
+    return {"note_id": note_id, "version": version, "title": target.title,
+            "content": content, "created_at": target.created_at}
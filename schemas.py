@@ -1,6 +1,11 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
+
+# Upper bound on operations accepted by one bulk request
+MAX_BULK_ITEMS = 5000
+# Longest content preview the summary list view returns
+MAX_PREVIEW_CHARS = 500
 
 # User schemas
 class UserBase(BaseModel):
@@ -28,7 +33,7 @@ class NoteCreate(NoteBase):
 class NoteUpdate(BaseModel):
     title: Optional[str] = None
     content: Optional[str] = None
-    version: int  # Required for optimistic locking
+    version: Optional[int] = None  # Required for optimistic locking unless If-Match is sent
 
 class NoteResponse(NoteBase):
     id: int
@@ -40,6 +45,89 @@ class NoteResponse(NoteBase):
     class Config:
         from_attributes = True
 
+class NoteSummary(BaseModel):
+    """List-view projection of a note; content is only present as an optional preview."""
+    id: int
+    title: str
+    updated_at: datetime
+    version: int
+    preview: Optional[str] = None
+
+class NoteRevisionInfo(BaseModel):
+    """One entry of a note's revision history, without its content."""
+    version: int
+    title: str
+    created_at: datetime
+
+class NoteRevisionResponse(BaseModel):
+    """A past version of a note, rebuilt from the revision history."""
+    note_id: int
+    version: int
+    title: str
+    content: str
+    created_at: datetime
+
+class NoteChange(BaseModel):
+    """One entry of the change feed: the note as written, or a deletion."""
+    id: int
+    change_seq: int
+    deleted: bool
+    note: Optional[NoteResponse] = None
+
+class NoteChanges(BaseModel):
+    changes: List[NoteChange]
+    cursor: str
+    has_more: bool
+
+class NoteSearchResult(BaseModel):
+    id: int
+    title: str  # Matched terms wrapped in <mark>...</mark>
+    snippet: str
+    rank: float
+    updated_at: datetime
+    version: int
+
+# Bulk note schemas
+class BulkNoteCreate(BaseModel):
+    items: List[NoteCreate] = Field(..., max_length=MAX_BULK_ITEMS)
+
+class BulkNoteUpdateItem(NoteUpdate):
+    id: int
+    version: int
+
+class BulkNoteUpdate(BaseModel):
+    items: List[BulkNoteUpdateItem] = Field(..., max_length=MAX_BULK_ITEMS)
+
+class BulkNoteDeleteItem(BaseModel):
+    id: int
+    version: Optional[int] = None  # Optional optimistic-lock check
+
+class BulkNoteDelete(BaseModel):
+    items: List[BulkNoteDeleteItem] = Field(..., max_length=MAX_BULK_ITEMS)
+
+class BulkItemResult(BaseModel):
+    index: int
+    status: int  # HTTP status the equivalent single-note request would have returned
+    id: Optional[int] = None
+    note: Optional[NoteResponse] = None
+    detail: Optional[str] = None
+    current_version: Optional[int] = None
+
+class BulkResponse(BaseModel):
+    results: List[BulkItemResult]
+
+# Import schemas
+class ImportLineError(BaseModel):
+    line: int  # 1-based line of the body where the record starts
+    error: str
+
+class ImportSummary(BaseModel):
+    imported: int
+    failed: int
+    batches: int
+    errors: List[ImportLineError]  # First IMPORT_MAX_ERRORS failures only
+    errors_truncated: bool = False
+
 # Auth schemas
 class Token(BaseModel):
     access_token: str
@@ -0,0 +1,186 @@
+"""
+Full-text search over note titles and content.
+
+SQLite uses an FTS5 table kept in sync by triggers on notes; PostgreSQL uses
+a GIN index over a tsvector expression. Other databases fall back to LIKE.
+Returned titles and snippets are HTML-escaped with matches wrapped in <mark>.
+"""
+import html
+import re
+from typing import List
+
+from sqlalchemy import DateTime, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from compression import NOTE_COMPRESSION_ENABLED
+
+HIGHLIGHT_START = "<mark>"
+HIGHLIGHT_END = "</mark>"
+# The database wraps matches in these control characters; the text is then
+# HTML-escaped and only the sentinels are turned into <mark> tags.
+_SENTINEL_START = "\x02"
+_SENTINEL_END = "\x03"
+SNIPPET_TOKENS = 16
+
+# The owner column lets FTS5 intersect the user's posting list with the query terms
+# instead of matching every user's notes and filtering afterwards.
+# The index keeps no copy of the text: it reads titles and content for highlight()
+# and snippet() from notes_fts_source. While notes may be compressed, content goes
+# through note_text(), which only the app registers on its connections (see
+# compression.py); other clients writing to notes then need it too.
+SQLITE_SEARCH_DDL = [
+    """
+    CREATE VIEW IF NOT EXISTS notes_fts_source AS
+    SELECT id, title, {content} AS content, 'u' || owner_id AS owner_key FROM notes
+    """,
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+        title, content, owner_key, content = 'notes_fts_source', content_rowid = 'id',
+        tokenize = 'unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN
+        INSERT INTO notes_fts(rowid, title, content, owner_key)
+        VALUES (new.id, new.title, {new_content}, 'u' || new.owner_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS notes_fts_update AFTER UPDATE OF title, content, owner_id ON notes BEGIN
+        INSERT INTO notes_fts(notes_fts, rowid, title, content, owner_key)
+        VALUES ('delete', old.id, old.title, {old_content}, 'u' || old.owner_id);
+        INSERT INTO notes_fts(rowid, title, content, owner_key)
+        VALUES (new.id, new.title, {new_content}, 'u' || new.owner_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS notes_fts_delete AFTER DELETE ON notes BEGIN
+        INSERT INTO notes_fts(notes_fts, rowid, title, content, owner_key)
+        VALUES ('delete', old.id, old.title, {old_content}, 'u' || old.owner_id);
+    END
+    """,
+]
+
+# Dropped when the index or its triggers need replacing, then rebuilt
+SQLITE_SEARCH_OBJECTS = [
+    ("TRIGGER", "notes_fts_insert"),
+    ("TRIGGER", "notes_fts_update"),
+    ("TRIGGER", "notes_fts_delete"),
+    ("TABLE", "notes_fts"),
+    ("VIEW", "notes_fts_source"),
+]
+
+POSTGRES_SEARCH_VECTOR = "to_tsvector('english', coalesce(title, '') || ' ' || coalesce(content, ''))"
+
+POSTGRES_SEARCH_DDL = [
+    f"CREATE INDEX IF NOT EXISTS ix_notes_search ON notes USING GIN ({POSTGRES_SEARCH_VECTOR})",
+]
+
+
+def sqlite_search_ddl(decode: bool) -> List[str]:
+    """SQLITE_SEARCH_DDL, reading content through note_text() when decode is set."""
+    column = "note_text(%s.content)" if decode else "%s.content"
+    return [
+        statement.format(content=column % "notes", new_content=column % "new", old_content=column % "old")
+        for statement in SQLITE_SEARCH_DDL
+    ]
+
+
+def create_search_index(connection: Connection) -> None:
+    """Create the dialect's full-text index and backfill it for existing notes."""
+    dialect = connection.dialect.name
+    if dialect == "sqlite":
+        # Leave note_text() out of the triggers when nothing can be compressed, so any
+        # SQLite client can write to notes; checked on every startup
+        decode = NOTE_COMPRESSION_ENABLED or connection.execute(
+            text("SELECT 1 FROM notes WHERE typeof(content) = 'blob' LIMIT 1")
+        ).first() is not None
+        existing = connection.execute(
+            text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'notes_fts'")
+        ).scalar()
+        trigger = connection.execute(
+            text("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'notes_fts_insert'")
+        ).scalar() or ""
+        # An index holding its own copy of the text (from before compression) is replaced too
+        if existing is not None and ("notes_fts_source" not in existing or ("note_text(" in trigger) != decode):
+            for kind, name in SQLITE_SEARCH_OBJECTS:
+                connection.execute(text(f"DROP {kind} IF EXISTS {name}"))
+            existing = None
+        for statement in sqlite_search_ddl(decode):
+            connection.execute(text(statement))
+        if existing is None:
+            connection.execute(text("INSERT INTO notes_fts(notes_fts) VALUES ('rebuild')"))
+    elif dialect == "postgresql":
+        for statement in POSTGRES_SEARCH_DDL:
+            connection.execute(text(statement))
+
+
+def build_fts5_query(q: str) -> str:
+    """Turn free text into a safe FTS5 expression: quoted terms ANDed, last term as a prefix."""
+    terms = re.findall(r"\w+", q, flags=re.UNICODE)
+    if not terms:
+        return ""
+    quoted = ['"%s"' % term for term in terms]
+    quoted[-1] += "*"
+    return " AND ".join(quoted)
+
+
+async def search_notes(db: AsyncSession, owner_id: int, q: str, limit: int, offset: int) -> List[dict]:
+    """Return ranked notes matching q with highlighted title and content snippet."""
+    dialect = db.get_bind().dialect.name
+    params = {"owner_id": owner_id, "limit": limit, "offset": offset,
+              "start": _SENTINEL_START, "end": _SENTINEL_END}
+
+    if dialect == "sqlite":
+        match = build_fts5_query(q)
+        if not match:
+            return []
+        params["match"] = f"owner_key : \"u{owner_id}\" AND {{title content}} : ({match})"
+        sql = f"""
+            SELECT n.id, n.updated_at, n.version,
+                   highlight(notes_fts, 0, :start, :end) AS title,
+                   snippet(notes_fts, 1, :start, :end, '…', {SNIPPET_TOKENS}) AS snippet,
+                   -bm25(notes_fts, 10.0, 1.0, 0.0) AS rank
+            FROM notes_fts JOIN notes n ON n.id = notes_fts.rowid
+            WHERE notes_fts MATCH :match
+            ORDER BY bm25(notes_fts, 10.0, 1.0, 0.0)
+            LIMIT :limit OFFSET :offset
+        """
+    elif dialect == "postgresql":
+        params["q"] = q
+        params["options"] = (
+            f"StartSel={_SENTINEL_START}, StopSel={_SENTINEL_END}, MaxWords={SNIPPET_TOKENS}, MinWords=5"
+        )
+        sql = f"""
+            SELECT n.id, n.updated_at, n.version,
+                   ts_headline('english', n.title, query, :options) AS title,
+                   ts_headline('english', n.content, query, :options) AS snippet,
+                   ts_rank({POSTGRES_SEARCH_VECTOR}, query) AS rank
+            FROM notes n, websearch_to_tsquery('english', :q) AS query
+            WHERE n.owner_id = :owner_id AND {POSTGRES_SEARCH_VECTOR} @@ query
+            ORDER BY rank DESC, n.id
+            LIMIT :limit OFFSET :offset
+        """
+    else:
+        params["pattern"] = f"%{q}%"
+        sql = """
+            SELECT n.id, n.updated_at, n.version, n.title,
+                   substr(n.content, 1, 200) AS snippet, 0.0 AS rank
+            FROM notes n
+            WHERE n.owner_id = :owner_id AND (n.title LIKE :pattern OR n.content LIKE :pattern)
+            ORDER BY n.id
+            LIMIT :limit OFFSET :offset
+        """
+
+    rows = await db.execute(text(sql).columns(updated_at=DateTime), params)
+    return [
+        {**row._mapping, "title": _highlight_html(row.title), "snippet": _highlight_html(row.snippet)}
+        for row in rows
+    ]
+
+
+def _highlight_html(value: str) -> str:
+    """HTML-escape note text, then turn the match sentinels into <mark> tags."""
+    escaped = html.escape(value or "", quote=False)
+    return escaped.replace(_SENTINEL_START, HIGHLIGHT_START).replace(_SENTINEL_END, HIGHLIGHT_END)
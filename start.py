@@ -1,44 +1,149 @@
 #!/usr/bin/env python3
 """
 Production startup script for Render deployment
+
+Runs schema setup once, then serves the app with WEB_CONCURRENCY workers:
+through gunicorn with preloading and uvicorn workers when gunicorn is
+installed, otherwise through uvicorn's own process manager.
 """
 import os
 import sys
 
+# Launcher settings
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+KEEPALIVE_TIMEOUT = int(os.getenv("KEEPALIVE_TIMEOUT", 5))  # Keep below the load balancer's idle timeout
+BACKLOG = int(os.getenv("BACKLOG", 2048))
+# Connections a worker serves at once before answering 503; 0 means unlimited
+LIMIT_CONCURRENCY = int(os.getenv("LIMIT_CONCURRENCY", 1000)) or None
+GRACEFUL_TIMEOUT = int(os.getenv("GRACEFUL_TIMEOUT", 30))  # Seconds to drain requests after SIGTERM
+
+try:
+    from uvicorn.workers import UvicornWorker
+except ImportError:  # gunicorn is not installed
+    UvicornWorker = None
+
+if UvicornWorker is not None:
+    class NotesUvicornWorker(UvicornWorker):
+        """Uvicorn worker with the launcher's concurrency limit and drain timeout."""
+        CONFIG_KWARGS = {
+            **UvicornWorker.CONFIG_KWARGS,
+            "limit_concurrency": LIMIT_CONCURRENCY,
+            "timeout_graceful_shutdown": GRACEFUL_TIMEOUT,
+        }
+
+
+def _shared(url: str) -> bool:
+    return bool(url) and not url.startswith("memory://")  # memory:// stays inside one process
+
+
+def per_worker_state() -> list:
+    """State each worker keeps to itself with the current settings, described for a warning."""
+    from cache import NOTE_CACHE_SHARED_URL, NOTE_CACHE_SIZE, USER_CACHE_SIZE, USER_CACHE_TTL_SECONDS
+    from events import NOTE_EVENTS_URL
+    from ratelimit import RATE_LIMIT_ENABLED, RATE_LIMIT_SHARED_URL
+
+    state = []
+    if RATE_LIMIT_ENABLED and not _shared(RATE_LIMIT_SHARED_URL):
+        state.append("rate limit buckets: a client can get up to one limit per worker (set RATE_LIMIT_SHARED_URL)")
+    if not _shared(NOTE_EVENTS_URL):
+        state.append("note events: subscribers only hear of writes their own worker served (set NOTE_EVENTS_URL)")
+    if NOTE_CACHE_SIZE > 0 and not _shared(NOTE_CACHE_SHARED_URL):
+        state.append("note cache: each worker warms its own, and every hit costs a version check "
+                     "(set NOTE_CACHE_SHARED_URL)")
+    if USER_CACHE_SIZE > 0 and USER_CACHE_TTL_SECONDS > 0:
+        state.append(f"user cache: other workers keep a changed user for up to {USER_CACHE_TTL_SECONDS:g}s "
+                     "(set USER_CACHE_SIZE=0 to turn it off)")
+    return state
+
+
+def run_gunicorn(port: int, workers: int):
+    """Preload the app in the master so workers fork with it already imported."""
+    from gunicorn.app.base import BaseApplication
+
+    class NotesApplication(BaseApplication):
+        def load_config(self):
+            settings = {
+                "bind": f"0.0.0.0:{port}",
+                "workers": workers,
+                "worker_class": "start.NotesUvicornWorker",
+                "preload_app": True,
+                "keepalive": KEEPALIVE_TIMEOUT,
+                "backlog": BACKLOG,
+                "graceful_timeout": GRACEFUL_TIMEOUT,
+                "timeout": GRACEFUL_TIMEOUT + 30,
+            }
+            for key, value in settings.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from main import app
+            return app
+
+    NotesApplication().run()
+
+
+def run_uvicorn(port: int, workers: int):
+    import uvicorn
+
+    options = dict(
+        host="0.0.0.0",
+        port=port,
+        log_level="info",
+        timeout_keep_alive=KEEPALIVE_TIMEOUT,
+        backlog=BACKLOG,
+        limit_concurrency=LIMIT_CONCURRENCY,
+        timeout_graceful_shutdown=GRACEFUL_TIMEOUT,
+    )
+    if workers > 1:
+        # Worker processes import the app themselves, so it is passed by name
+        uvicorn.run("main:app", workers=workers, **options)
+    else:
+        from main import app
+        uvicorn.run(app, **options)
+
+
 def main():
     """Main startup function for production"""
     print("🚀 Starting FastAPI Notes CRUD API...")
-    
+
     # Set default environment variables
     if not os.getenv("SECRET_KEY"):
         print("⚠️  No SECRET_KEY found in environment variables")
         sys.exit(1)
-    
-    # Import and create tables
+
+    # Create tables once, before any worker starts
     try:
-        from database import create_tables
-        print("📊 Creating database tables...")
-        create_tables()
-        print("✅ Database tables created successfully")
+        from database import create_tables, engine, DB_MIGRATIONS_MANAGED
+        if DB_MIGRATIONS_MANAGED:
+            print("📊 Schema is managed by migrations, skipping table creation")
+        else:
+            print("📊 Creating database tables...")
+            create_tables()
+            print("✅ Database tables created successfully")
+        # Workers must not inherit this connection
+        engine.dispose()
+        os.environ["NOTES_SCHEMA_READY"] = "1"
     except Exception as e:
         print(f"❌ Error creating database tables: {e}")
         sys.exit(1)
-    
+
     # Start the application
     try:
-        import uvicorn
-        from main import app
-        
         port = int(os.environ.get("PORT", 8000))
-        print(f"🌐 Starting server on port {port}...")
-        
-        uvicorn.run(
-            app, 
-            host="0.0.0.0", 
-            port=port,
-            log_level="info"
-        )
-        
+        workers = max(WEB_CONCURRENCY, 1)
+        if workers > 1:
+            state = per_worker_state()
+            if state:
+                print(f"⚠️  {workers} workers do not share:")
+                for line in state:
+                    print(f"   - {line}")
+        if UvicornWorker is not None and workers > 1:
+            print(f"🌐 Starting gunicorn with {workers} workers on port {port}...")
+            run_gunicorn(port, workers)
+        else:
+            print(f"🌐 Starting uvicorn with {workers} worker(s) on port {port}...")
+            run_uvicorn(port, workers)
+
     except Exception as e:
         print(f"❌ Error starting server: {e}")
         sys.exit(1)
@@ -1,10 +1,31 @@
+import asyncio
+import csv
+import io
+import json
+import time
+import uuid
+
 import pytest
 import httpx
 from fastapi.testclient import TestClient
 from main import app
+from database import async_engine, create_tables
+from ratelimit import rate_limiter
 
+# The app creates its tables in the lifespan hook, which TestClient only runs inside a with block
+create_tables()
+# Every TestClient request comes from the same "testclient" address; TestRateLimiting turns this back on
+rate_limiter.enabled = False
 client = TestClient(app)
 
+
+@pytest.fixture(autouse=True)
+def fresh_async_pool():
+    """Each test drives the app from new event loops; don't hand it connections pooled on an old one."""
+    yield
+    asyncio.run(async_engine.dispose())
+
+
 class TestAuth:
     def test_register_user(self):
         """Test user registration."""
@@ -116,3 +137,1400 @@ class TestNotes:
             headers=self.headers
         )
         assert response.status_code == 409  # Conflict
+
+class TestConcurrency:
+    def setup_method(self):
+        """Setup method to create a user and get token."""
+        client.post("/auth/register", json={
+            "username": "asyncuser",
+            "email": "async@example.com",
+            "password": "asyncpassword123"
+        })
+        response = client.post("/auth/login", json={
+            "username": "asyncuser",
+            "password": "asyncpassword123"
+        })
+        self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    def test_concurrent_note_requests(self):
+        """Test many in-flight requests sharing the async session path."""
+        import asyncio
+
+        async def run():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+                creates = await asyncio.gather(*[
+                    ac.post("/notes", json={"title": f"Concurrent {i}", "content": "body"},
+                            headers=self.headers)
+                    for i in range(20)
+                ])
+                reads = await asyncio.gather(*[
+                    ac.get(f"/notes/{r.json()['id']}", headers=self.headers) for r in creates
+                ])
+            return creates, reads
+
+        creates, reads = asyncio.run(run())
+        assert all(r.status_code == 201 for r in creates)
+        assert all(r.status_code == 200 for r in reads)
+        assert len({r.json()["id"] for r in reads}) == 20
+
+    def test_concurrent_updates_lose_nothing(self):
+        """Test racing writers of one note: one winner per version and every retried edit kept."""
+        import asyncio
+
+        note = client.post("/notes", json={"title": "Race", "content": ""}, headers=self.headers).json()
+        url = f"/notes/{note['id']}"
+
+        async def append(ac, token):
+            while True:
+                current = (await ac.get(url, headers=self.headers)).json()
+                response = await ac.put(url, json={"content": current["content"] + f"[{token}]",
+                                                   "version": current["version"]}, headers=self.headers)
+                if response.status_code == 200:
+                    return
+                assert response.status_code == 409
+
+        async def run():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+                same_version = await asyncio.gather(*[
+                    ac.put(url, json={"title": f"Writer {i}", "version": 1}, headers=self.headers)
+                    for i in range(10)
+                ])
+                await asyncio.gather(*[append(ac, f"{writer}.{n}") for writer in range(8) for n in range(5)])
+            return same_version
+
+        same_version = asyncio.run(run())
+        assert sorted(r.status_code for r in same_version) == [200] + [409] * 9
+
+        final = client.get(url, headers=self.headers).json()
+        assert final["version"] == 42
+        assert all(f"[{writer}.{n}]" in final["content"] for writer in range(8) for n in range(5))
+
+class TestPasswordHashPool:
+    def test_login_sheds_load_when_pool_saturated(self):
+        """Test login returns 503 once the hashing queue is full."""
+        from auth import hash_pool
+        client.post("/auth/register", json={
+            "username": "hashuser",
+            "email": "hash@example.com",
+            "password": "hashpassword123"
+        })
+        saved = hash_pool.in_flight
+        hash_pool.in_flight = hash_pool.workers + hash_pool.max_queue
+        try:
+            response = client.post("/auth/login", json={
+                "username": "hashuser",
+                "password": "hashpassword123"
+            })
+        finally:
+            hash_pool.in_flight = saved
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+
+    def test_hash_timings_exported(self):
+        """Test queue wait and hash time show up on /metrics."""
+        client.post("/auth/login", json={
+            "username": "hashuser",
+            "password": "hashpassword123"
+        })
+        body = client.get("/metrics").text
+        assert 'password_hash_duration_seconds_count{operation="verify"}' in body
+        assert 'password_hash_queue_wait_seconds_count{operation="verify"}' in body
+        assert 'password_hash_rejected_total{operation="verify"}' in body
+
+class TestUserCache:
+    def setup_method(self):
+        """Setup method to create a user and get token."""
+        client.post("/auth/register", json={
+            "username": "cacheuser",
+            "email": "cache@example.com",
+            "password": "cachepassword123"
+        })
+        response = client.post("/auth/login", json={
+            "username": "cacheuser",
+            "password": "cachepassword123"
+        })
+        self.token = response.json()["access_token"]
+        self.headers = {"Authorization": f"Bearer {self.token}"}
+
+    def test_repeated_token_hits_cache(self):
+        """Test the user lookup is served from cache for a reused token."""
+        from cache import user_cache
+        user_cache.pop(self.token)
+        hits = user_cache.hits
+        assert client.get("/users/me", headers=self.headers).status_code == 200
+        assert client.get("/users/me", headers=self.headers).json()["username"] == "cacheuser"
+        assert user_cache.hits == hits + 1
+
+    def test_user_change_invalidates_cache(self):
+        """Test updating a user drops their cached tokens."""
+        import asyncio
+        from cache import user_cache
+        from database import AsyncSessionLocal, User
+        from sqlalchemy import select
+
+        client.get("/users/me", headers=self.headers)
+        assert user_cache.get(self.token) is not None
+
+        async def touch_user():
+            async with AsyncSessionLocal() as session:
+                user = await session.scalar(select(User).where(User.username == "cacheuser"))
+                user.email = "cache2@example.com"
+                await session.commit()
+                user.email = "cache@example.com"
+                await session.commit()
+
+        asyncio.run(touch_user())
+        assert user_cache.get(self.token) is None
+
+    def test_invalidation_waits_for_commit(self):
+        """Test a flushed but uncommitted change keeps the cache, and a Core UPDATE clears it on commit."""
+        import asyncio
+        from cache import user_cache
+        from database import AsyncSessionLocal, User
+        from sqlalchemy import select, update
+
+        client.get("/users/me", headers=self.headers)
+
+        async def flush_then_rollback():
+            async with AsyncSessionLocal() as session:
+                user = await session.scalar(select(User).where(User.username == "cacheuser"))
+                user.email = "flushed@example.com"
+                await session.flush()
+                assert user_cache.get(self.token) is not None
+                await session.rollback()
+
+        async def core_update():
+            async with AsyncSessionLocal() as session:
+                await session.execute(
+                    update(User).where(User.username == "cacheuser").values(email="cache@example.com")
+                )
+                assert user_cache.get(self.token) is not None
+                await session.commit()
+
+        asyncio.run(flush_then_rollback())
+        assert user_cache.get(self.token) is not None
+        asyncio.run(core_update())
+        assert user_cache.get(self.token) is None
+
+class TestPagination:
+    def setup_method(self):
+        """Setup method to create a user with a few notes."""
+        client.post("/auth/register", json={
+            "username": "pageuser",
+            "email": "page@example.com",
+            "password": "pagepassword123"
+        })
+        response = client.post("/auth/login", json={
+            "username": "pageuser",
+            "password": "pagepassword123"
+        })
+        self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+        for i in range(5):
+            client.post("/notes", json={"title": f"Page {i}", "content": "body"}, headers=self.headers)
+
+    def test_cursor_pagination_walks_all_notes(self):
+        """Test following X-Next-Cursor visits every note once, in id order."""
+        seen = []
+        response = client.get("/notes?limit=2", headers=self.headers)
+        while True:
+            assert response.status_code == 200
+            seen.extend(note["id"] for note in response.json())
+            cursor = response.headers.get("X-Next-Cursor")
+            if cursor is None:
+                break
+            response = client.get(f"/notes?limit=2&cursor={cursor}", headers=self.headers)
+        all_ids = [note["id"] for note in client.get("/notes?limit=1000", headers=self.headers).json()]
+        assert seen == sorted(all_ids)
+        assert len(seen) == len(set(seen))
+
+    def test_invalid_cursor(self):
+        """Test a malformed cursor is rejected."""
+        response = client.get("/notes?cursor=not-a-cursor", headers=self.headers)
+        assert response.status_code == 400
+
+class TestBulkNotes:
+    def setup_method(self):
+        """Setup method to create a user and get token."""
+        client.post("/auth/register", json={
+            "username": "bulkuser",
+            "email": "bulk@example.com",
+            "password": "bulkpassword123"
+        })
+        response = client.post("/auth/login", json={
+            "username": "bulkuser",
+            "password": "bulkpassword123"
+        })
+        self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    def test_bulk_create_update_delete(self):
+        """Test bulk endpoints return per-item results and honor versions."""
+        response = client.post("/notes/bulk", json={"items": [
+            {"title": f"Bulk {i}", "content": f"content {i}"} for i in range(50)
+        ]}, headers=self.headers)
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert [r["status"] for r in results] == [201] * 50
+        assert [r["note"]["title"] for r in results] == [f"Bulk {i}" for i in range(50)]
+        ids = [r["id"] for r in results]
+
+        response = client.patch("/notes/bulk", json={"items": [
+            {"id": ids[0], "title": "Bulk updated", "version": 1},
+            {"id": ids[1], "content": "stale", "version": 7},
+            {"id": 10 ** 9, "title": "missing", "version": 1},
+        ]}, headers=self.headers)
+        results = response.json()["results"]
+        assert [r["status"] for r in results] == [200, 409, 404]
+        assert results[0]["note"]["version"] == 2
+        assert results[0]["note"]["title"] == "Bulk updated"
+        assert results[1]["current_version"] == 1
+
+        response = client.post("/notes/bulk/delete", json={"items": [
+            {"id": ids[0], "version": 1},
+            {"id": ids[0], "version": 2},
+            {"id": ids[2]},
+            {"id": ids[2]},
+        ]}, headers=self.headers)
+        results = response.json()["results"]
+        assert [r["status"] for r in results] == [409, 204, 204, 404]
+        assert client.get(f"/notes/{ids[0]}", headers=self.headers).status_code == 404
+        assert client.get(f"/notes/{ids[2]}", headers=self.headers).status_code == 404
+        assert client.get(f"/notes/{ids[3]}", headers=self.headers).status_code == 200
+
+    def test_bulk_update_many_items(self):
+        """Test a large bulk update, including two chained edits of the same note."""
+        created = client.post("/notes/bulk", json={"items": [
+            {"title": f"Many {i}", "content": "old"} for i in range(300)
+        ]}, headers=self.headers).json()["results"]
+        ids = [r["id"] for r in created]
+        items = [{"id": note_id, "content": "new", "version": 1} for note_id in ids]
+        items.append({"id": ids[0], "title": "Many 0 again", "version": 2})
+
+        response = client.patch("/notes/bulk", json={"items": items}, headers=self.headers)
+        results = response.json()["results"]
+        assert all(r["status"] == 200 for r in results)
+        assert results[1]["note"] == {**results[1]["note"], "title": "Many 1", "content": "new", "version": 2}
+        assert results[-1]["note"]["title"] == "Many 0 again"
+        assert results[-1]["note"]["version"] == 3
+
+class TestSearch:
+    def setup_method(self):
+        """Setup method to create a user and get token."""
+        client.post("/auth/register", json={
+            "username": "searchuser",
+            "email": "search@example.com",
+            "password": "searchpassword123"
+        })
+        response = client.post("/auth/login", json={
+            "username": "searchuser",
+            "password": "searchpassword123"
+        })
+        self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    def test_search_ranks_and_highlights(self):
+        """Test search finds matching notes, ranks title hits first and highlights terms."""
+        term = "zq" + uuid.uuid4().hex[:8]
+        grocery = client.post("/notes", json={"title": "Grocery list", "content": f"eggs, milk and {term}"},
+                              headers=self.headers).json()
+        bread = client.post("/notes", json={"title": f"{term} bread", "content": f"bake with {term}"},
+                            headers=self.headers).json()
+        client.post("/notes", json={"title": "Unrelated", "content": "nothing here"},
+                    headers=self.headers)
+
+        response = client.get(f"/notes/search?q={term}", headers=self.headers)
+        assert response.status_code == 200
+        results = response.json()
+        assert [r["id"] for r in results] == [bread["id"], grocery["id"]]
+        assert results[0]["title"] == f"<mark>{term}</mark> bread"
+        assert f"<mark>{term}</mark>" in results[1]["snippet"]
+
+    def test_search_escapes_html_and_ignores_owner_key(self):
+        """Test stored markup is escaped and the hidden owner column is not searchable."""
+        term = "zq" + uuid.uuid4().hex[:8]
+        note = client.post("/notes", json={"title": "<b>bold</b>", "content": f"<script>{term}</script>"},
+                           headers=self.headers).json()
+        result = client.get(f"/notes/search?q={term}", headers=self.headers).json()[0]
+        assert result["title"] == "&lt;b&gt;bold&lt;/b&gt;"
+        assert f"&lt;script&gt;<mark>{term}</mark>&lt;/script&gt;" in result["snippet"]
+
+        me = client.get("/users/me", headers=self.headers).json()
+        ids = [r["id"] for r in client.get(f"/notes/search?q=u{me['id']}", headers=self.headers).json()]
+        assert note["id"] not in ids
+
+    def test_search_tracks_updates_deletes_and_owner(self):
+        """Test the index follows updates and deletes and never leaks other users' notes."""
+        note = client.post("/notes", json={"title": "Quokka", "content": "marsupial"},
+                           headers=self.headers).json()
+        client.put(f"/notes/{note['id']}", json={"content": "wombat", "version": 1}, headers=self.headers)
+        assert client.get("/notes/search?q=marsupial", headers=self.headers).json() == []
+        assert len(client.get("/notes/search?q=wombat", headers=self.headers).json()) == 1
+
+        client.delete(f"/notes/{note['id']}", headers=self.headers)
+        assert client.get("/notes/search?q=wombat", headers=self.headers).json() == []
+
+        other = client.post("/auth/login", json={"username": "noteuser", "password": "notepassword123"})
+        other_headers = {"Authorization": f"Bearer {other.json()['access_token']}"}
+        client.post("/notes", json={"title": "Private okapi", "content": "x"}, headers=other_headers)
+        assert client.get("/notes/search?q=okapi", headers=self.headers).json() == []
+        assert client.get("/notes/search?q=oka", headers=other_headers).json()[0]["id"]
+
+class TestDatabasePool:
+    def test_pool_stats(self):
+        """Test the pool stats endpoint reports occupancy and wait times."""
+        response = client.get("/health/pool")
+        assert response.status_code == 200
+        for stats in response.json().values():
+            for key in ("size", "checked_out", "overflow", "wait_count", "wait_seconds_total"):
+                assert key in stats
+        from database import async_engine, _is_sqlite_memory
+        if not _is_sqlite_memory(str(async_engine.url)):
+            # Request handlers reuse pooled connections instead of reconnecting each time
+            assert response.json()["async"]["pool"] == "TimedAsyncQueuePool"
+        stats = response.json()["sync"]
+        if stats["pool"] == "TimedQueuePool":
+            assert stats["checked_out"] == 0
+            assert stats["overflow"] >= 0
+            # Nothing has contended for the sync pool, so no checkout waited
+            assert stats["wait_count"] == 0
+
+    def test_sqlite_pragmas_applied(self):
+        """Test new SQLite connections run in WAL mode with a busy timeout."""
+        from sqlalchemy import text
+        from database import engine
+        if engine.dialect.name != "sqlite":
+            pytest.skip("SQLite only")
+        with engine.connect() as connection:
+            assert connection.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+            assert connection.execute(text("PRAGMA busy_timeout")).scalar() == 5000
+
+class TestConditionalRequests:
+    def setup_method(self):
+        """Setup method to create a user, a note and get token."""
+        client.post("/auth/register", json={
+            "username": "etaguser",
+            "email": "etag@example.com",
+            "password": "etagpassword123"
+        })
+        response = client.post("/auth/login", json={
+            "username": "etaguser",
+            "password": "etagpassword123"
+        })
+        self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+        self.note = client.post("/notes", json={"title": "Tagged", "content": "body"},
+                                headers=self.headers).json()
+
+    def test_single_note_etag_and_304(self):
+        """Test GET /notes/{id} returns an ETag and honors If-None-Match."""
+        url = f"/notes/{self.note['id']}"
+        response = client.get(url, headers=self.headers)
+        etag = response.headers["ETag"]
+        assert etag == f'"n{self.note["id"]}-v1"'
+
+        response = client.get(url, headers={**self.headers, "If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.content == b""
+
+        client.put(url, json={"title": "Retagged", "version": 1}, headers=self.headers)
+        response = client.get(url, headers={**self.headers, "If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+
+    def test_list_etag_changes_with_page(self):
+        """Test GET /notes answers 304 until a note on the page changes."""
+        response = client.get("/notes", headers=self.headers)
+        etag = response.headers["ETag"]
+        assert client.get("/notes", headers={**self.headers, "If-None-Match": etag}).status_code == 304
+
+        client.post("/notes", json={"title": "Another", "content": "x"}, headers=self.headers)
+        assert client.get("/notes", headers={**self.headers, "If-None-Match": etag}).status_code == 200
+
+    def test_put_with_if_match(self):
+        """Test If-Match can stand in for the body version."""
+        url = f"/notes/{self.note['id']}"
+        etag = client.get(url, headers=self.headers).headers["ETag"]
+        response = client.put(url, json={"title": "Via If-Match"}, headers={**self.headers, "If-Match": etag})
+        assert response.status_code == 200
+        assert response.json()["version"] == 2
+
+        response = client.put(url, json={"title": "Stale"}, headers={**self.headers, "If-Match": etag})
+        assert response.status_code == 412
+        assert response.headers["X-Current-Version"] == "2"
+
+        assert client.put(url, json={"title": "No version"}, headers=self.headers).status_code == 428
+
+class TestRequestTiming:
+    def setup_method(self):
+        """Setup method to create a user and get token."""
+        client.post("/auth/register", json={
+            "username": "timinguser",
+            "email": "timing@example.com",
+            "password": "timingpassword123"
+        })
+        response = client.post("/auth/login", json={
+            "username": "timinguser",
+            "password": "timingpassword123"
+        })
+        self.login_timing = response.headers["Server-Timing"]
+        self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    def test_server_timing_header(self):
+        """Test responses break their time down into phases."""
+        assert "bcrypt;dur=" in self.login_timing
+
+        response = client.get("/notes", headers=self.headers)
+        timing = response.headers["Server-Timing"]
+        for phase in ("sql;dur=", "endpoint;dur=", "serialize;dur=", "total;dur="):
+            assert phase in timing
+        assert 'sql_count;desc="' in timing
+
+    def test_route_histograms_on_metrics(self):
+        """Test per-route phase histograms are labelled with the route template."""
+        note = client.post("/notes", json={"title": "t", "content": "c"}, headers=self.headers).json()
+        client.get(f"/notes/{note['id']}", headers=self.headers)
+
+        body = client.get("/metrics").text
+        assert 'http_request_duration_seconds_count{method="GET",route="/notes/{note_id}",status="200"}' in body
+        assert 'http_request_phase_seconds_count{route="/notes/{note_id}",phase="sql"}' in body
+        assert 'http_request_sql_queries_count{route="/notes/{note_id}"}' in body
+
+    def test_failed_statement_keeps_its_error(self):
+        """Test the error hook counts a failed statement without masking its exception."""
+        from sqlalchemy import text
+        from sqlalchemy.exc import OperationalError
+        from database import engine
+
+        with engine.connect() as connection:
+            with pytest.raises(OperationalError):
+                connection.execute(text("SELECT * FROM no_such_table"))
+            assert not connection.info.get("query_start")
+
+class TestExport:
+    def setup_method(self):
+        """Setup method to create a fresh user with a few notes."""
+        username = f"export{uuid.uuid4().hex[:8]}"
+        client.post("/auth/register", json={
+            "username": username,
+            "email": f"{username}@example.com",
+            "password": "exportpassword123"
+        })
+        response = client.post("/auth/login", json={
+            "username": username,
+            "password": "exportpassword123"
+        })
+        self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+        client.post("/notes/bulk", json={"items": [
+            {"title": f"Export {i}", "content": f"line one, \"quoted\"\nline two {i}"} for i in range(5)
+        ]}, headers=self.headers)
+
+    def test_export_ndjson(self):
+        """Test NDJSON export streams one note per line in id order."""
+        response = client.get("/notes/export", headers=self.headers)
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        records = [json.loads(line) for line in response.text.splitlines()]
+        assert [r["title"] for r in records] == [f"Export {i}" for i in range(5)]
+        assert records[0]["content"] == 'line one, "quoted"\nline two 0'
+
+    def test_export_csv_gzip(self):
+        """Test CSV export with gzip round-trips multi-line content."""
+        response = client.get("/notes/export?format=csv&gzip=true", headers=self.headers)
+        assert response.status_code == 200
+        assert response.headers["content-encoding"] == "gzip"
+        rows = list(csv.reader(io.StringIO(response.text)))
+        assert rows[0] == ["id", "title", "content", "created_at", "updated_at", "version"]
+        assert len(rows) == 6
+        assert rows[1][2] == 'line one, "quoted"\nline two 0'
+
+class TestImport:
+    def setup_method(self):
+        """Setup method to create a fresh user and get token."""
+        username = f"import{uuid.uuid4().hex[:8]}"
+        client.post("/auth/register", json={
+            "username": username,
+            "email": f"{username}@example.com",
+            "password": "importpassword123"
+        })
+        response = client.post("/auth/login", json={
+            "username": username,
+            "password": "importpassword123"
+        })
+        self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    def test_import_ndjson_in_batches(self):
+        """Test NDJSON rows are validated per line and inserted in batches."""
+        lines = [json.dumps({"title": f"Imported {i}", "content": f"body {i} x"}) for i in range(7)]
+        lines.insert(3, "{not json")
+        lines.insert(5, json.dumps({"title": "missing content"}))
+        body = "\n".join(lines) + "\n"
+
+        def chunks():
+            # Uneven chunks so records straddle chunk boundaries
+            data = body.encode()
+            for start in range(0, len(data), 13):
+                yield data[start:start + 13]
+
+        response = client.post("/notes/import?batch_size=3", content=chunks(), headers=self.headers)
+        assert response.status_code == 200
+        summary = response.json()
+        assert summary["imported"] == 7
+        assert summary["failed"] == 2
+        assert summary["batches"] == 3
+        assert [error["line"] for error in summary["errors"]] == [4, 6]
+        assert "content" in summary["errors"][1]["error"]
+
+        notes = client.get("/notes?limit=100", headers=self.headers).json()
+        assert [n["title"] for n in notes] == [f"Imported {i}" for i in range(7)]
+        assert notes[0]["content"] == "body 0 x"
+
+    def test_export_import_csv_round_trip(self):
+        """Test a CSV export can be imported back, multi-line fields included."""
+        client.post("/notes", json={"title": "Quoted, title", "content": "a \"b\"\nc"}, headers=self.headers)
+        exported = client.get("/notes/export?format=csv", headers=self.headers).content
+
+        response = client.post("/notes/import?format=csv", content=exported, headers=self.headers)
+        assert response.json()["imported"] == 1
+        notes = client.get("/notes", headers=self.headers).json()
+        assert [(n["title"], n["content"]) for n in notes] == [("Quoted, title", "a \"b\"\nc")] * 2
+
+class TestNoteSummary:
+    def setup_method(self):
+        """Setup method to create a fresh user with long notes."""
+        username = f"summary{uuid.uuid4().hex[:8]}"
+        client.post("/auth/register", json={
+            "username": username,
+            "email": f"{username}@example.com",
+            "password": "summarypassword123"
+        })
+        response = client.post("/auth/login", json={
+            "username": username,
+            "password": "summarypassword123"
+        })
+        self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+        client.post("/notes/bulk", json={"items": [
+            {"title": f"Long {i}", "content": f"{i} " + "x" * 5000} for i in range(3)
+        ]}, headers=self.headers)
+
+    def test_summary_leaves_out_content(self):
+        """Test the summary view never selects the content column."""
+        from sqlalchemy import event
+        from database import async_engine
+
+        statements = []
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(async_engine.sync_engine, "before_cursor_execute", capture)
+        try:
+            response = client.get("/notes/summary?limit=2", headers=self.headers)
+        finally:
+            event.remove(async_engine.sync_engine, "before_cursor_execute", capture)
+
+        assert response.status_code == 200
+        assert [n["title"] for n in response.json()] == ["Long 0", "Long 1"]
+        assert set(response.json()[0]) == {"id", "title", "updated_at", "version"}
+        assert "X-Next-Cursor" in response.headers
+        assert not any("notes.content" in statement for statement in statements)
+
+    def test_summary_preview(self):
+        """Test preview=N returns the first N characters of the content."""
+        response = client.get("/notes/summary?preview=10", headers=self.headers)
+        assert [n["preview"] for n in response.json()] == [f"{i} xxxxxxxx" for i in range(3)]
+        assert client.get("/notes/summary?preview=501", headers=self.headers).status_code == 422
+
+class TestNoteCache:
+    def setup_method(self):
+        """Setup method to create a fresh user with a note."""
+        username = f"notecache{uuid.uuid4().hex[:8]}"
+        client.post("/auth/register", json={
+            "username": username,
+            "email": f"{username}@example.com",
+            "password": "notecachepassword123"
+        })
+        response = client.post("/auth/login", json={
+            "username": username,
+            "password": "notecachepassword123"
+        })
+        self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+        self.note = client.post("/notes", json={"title": "Cached", "content": "v1"}, headers=self.headers).json()
+
+    def test_reads_hit_cache_until_update(self):
+        """Test repeated reads are cache hits and updates invalidate on commit."""
+        from cache import note_cache
+        url = f"/notes/{self.note['id']}"
+        client.get(url, headers=self.headers)
+        hits = note_cache.hits
+        assert client.get(url, headers=self.headers).json()["content"] == "v1"
+        assert note_cache.hits == hits + 1
+
+        client.put(url, json={"content": "v2", "version": 1}, headers=self.headers)
+        assert client.get(url, headers=self.headers).json()["content"] == "v2"
+
+        client.patch("/notes/bulk", json={"items": [{"id": self.note["id"], "content": "v3", "version": 2}]},
+                     headers=self.headers)
+        assert client.get(url, headers=self.headers).json()["content"] == "v3"
+
+        client.post("/notes/bulk/delete", json={"items": [{"id": self.note["id"]}]}, headers=self.headers)
+        assert client.get(url, headers=self.headers).status_code == 404
+
+    def test_hits_are_checked_against_the_current_version(self):
+        """Test a cached note another worker has since updated is not served, nor used for a 304."""
+        from dataclasses import replace
+        from cache import note_cache
+        url = f"/notes/{self.note['id']}"
+        key = (self.note["owner_id"], self.note["id"])
+        client.get(url, headers=self.headers)
+        client.put(url, json={"content": "v2", "version": 1}, headers=self.headers)
+        current = client.get(url, headers=self.headers).json()
+
+        # What this worker still holds after a PUT served by another worker
+        stale = replace(asyncio.run(note_cache.get(key)), content="v1", version=1)
+        note_cache.backend.entries.set(key, stale)
+        stale_count = note_cache.stale
+        response = client.get(url, headers={**self.headers, "If-None-Match": '"n%d-v1"' % self.note["id"]})
+        assert response.status_code == 200
+        assert response.json() == current
+        assert note_cache.stale == stale_count + 1
+
+    def test_single_flight_and_invalidation_during_load(self):
+        """Test concurrent misses share one load, and a load racing an invalidation isn't cached."""
+        import asyncio
+        from datetime import datetime
+        from cache import CachedNote, LocalNoteBackend, NoteCache
+
+        note = CachedNote(id=1, title="t", content="c", created_at=datetime.utcnow(),
+                          updated_at=datetime.utcnow(), owner_id=7, version=1)
+        loads = 0
+
+        async def scenario():
+            nonlocal loads
+            cache = NoteCache(LocalNoteBackend(100, 60))
+
+            async def loader():
+                nonlocal loads
+                loads += 1
+                await asyncio.sleep(0.01)
+                return note
+
+            results = await asyncio.gather(*(cache.get_or_load((7, 1), loader) for _ in range(5)))
+            assert results == [note] * 5
+            assert loads == 1 and cache.coalesced == 4
+            assert await cache.get((7, 1)) == note
+
+            async def racing_loader():
+                cache.invalidate([(7, 2)])
+                return note
+
+            await cache.load((7, 2), racing_loader)
+            assert await cache.get((7, 2)) is None
+
+        asyncio.run(scenario())
+
+    def test_shared_backend_round_trip(self):
+        """Test the shared backend stores notes as bytes and honors invalidation."""
+        import asyncio
+        from datetime import datetime
+        from cache import CachedNote, InMemorySharedStore, NoteCache, SharedNoteBackend
+
+        note = CachedNote(id=3, title="t", content="c", created_at=datetime(2024, 1, 1),
+                          updated_at=datetime(2024, 1, 2), owner_id=7, version=4)
+
+        async def scenario():
+            store = InMemorySharedStore()
+            cache = NoteCache(SharedNoteBackend(store, 60))
+            async def loader():
+                return note
+            await cache.load((7, 3), loader)
+            assert isinstance(await store.get("note:7:3"), bytes)
+            assert await cache.get((7, 3)) == note
+            cache.invalidate([(7, 3)])
+            await asyncio.sleep(0)
+            assert await cache.get((7, 3)) is None
+
+        asyncio.run(scenario())
+
+class TestFastJSON:
+    def setup_method(self):
+        """Setup method to create a fresh user with a few notes."""
+        username = f"fastjson{uuid.uuid4().hex[:8]}"
+        client.post("/auth/register", json={
+            "username": username,
+            "email": f"{username}@example.com",
+            "password": "fastjsonpassword123"
+        })
+        response = client.post("/auth/login", json={
+            "username": username,
+            "password": "fastjsonpassword123"
+        })
+        self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+        client.post("/notes/bulk", json={"items": [
+            {"title": f"Fast {i}", "content": "ünïcode \"quoted\" " * 10} for i in range(3)
+        ]}, headers=self.headers)
+
+    @pytest.mark.parametrize("with_orjson", [True, False])
+    def test_fast_path_matches_response_model(self, monkeypatch, with_orjson):
+        """Test the fast path returns the same JSON and headers as the pydantic path."""
+        import fastjson
+        slow_list = client.get("/notes?limit=2", headers=self.headers)
+        note_id = slow_list.json()[0]["id"]
+        slow_note = client.get(f"/notes/{note_id}", headers=self.headers)
+
+        monkeypatch.setattr(fastjson, "FAST_JSON_RESPONSES", True)
+        if not with_orjson:
+            monkeypatch.setattr(fastjson, "orjson", None)
+        fast_list = client.get("/notes?limit=2", headers=self.headers)
+        fast_note = client.get(f"/notes/{note_id}", headers=self.headers)
+
+        assert fast_list.json() == slow_list.json()
+        assert fast_list.headers["ETag"] == slow_list.headers["ETag"]
+        assert fast_list.headers["X-Next-Cursor"] == slow_list.headers["X-Next-Cursor"]
+        assert fast_note.json() == slow_note.json()
+        assert fast_note.headers["ETag"] == slow_note.headers["ETag"]
+
+class TestStartup:
+    def test_import_is_side_effect_free(self, tmp_path):
+        """Test importing main runs no DDL and defers the auth libraries."""
+        import os
+        import subprocess
+        import sys
+        db_path = tmp_path / "startup.db"
+        code = (
+            "import sys, main; "
+            "print(','.join(m for m in ('passlib', 'jose', 'uvicorn') if m in sys.modules))"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env={**os.environ, "DATABASE_URL": f"sqlite:///{db_path}"},
+        )
+        assert result.stdout.strip() == ""
+        assert not db_path.exists() or db_path.stat().st_size == 0
+
+    def test_lifespan_creates_tables_unless_migrations_managed(self, tmp_path):
+        """Test the lifespan hook creates tables, and skips them when migrations own the schema."""
+        import os
+        import subprocess
+        import sys
+        code = (
+            "from fastapi.testclient import TestClient; import main; "
+            "from sqlalchemy import inspect; "
+            "c = TestClient(main.app); c.__enter__(); c.__exit__(None, None, None); "
+            "print('notes' in inspect(main.engine).get_table_names())"
+        )
+        for managed, expected in (("false", "True"), ("true", "False")):
+            result = subprocess.run(
+                [sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                env={**os.environ, "DATABASE_URL": f"sqlite:///{tmp_path}/{managed}.db",
+                     "DB_MIGRATIONS_MANAGED": managed},
+            )
+            assert result.stdout.strip() == expected
+
+    def test_lifespan_skips_tables_start_py_created(self, tmp_path):
+        """Test workers started by start.py, which sets NOTES_SCHEMA_READY, run no DDL of their own."""
+        import os
+        import subprocess
+        import sys
+        code = (
+            "from fastapi.testclient import TestClient; import main; "
+            "from sqlalchemy import inspect; "
+            "c = TestClient(main.app); c.__enter__(); c.__exit__(None, None, None); "
+            "print('notes' in inspect(main.engine).get_table_names())"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env={**os.environ, "DATABASE_URL": f"sqlite:///{tmp_path}/ready.db", "NOTES_SCHEMA_READY": "1"},
+        )
+        assert result.stdout.strip() == "False"
+
+    def test_forked_worker_drops_inherited_pools(self, tmp_path):
+        """Test a forked child gets fresh pools instead of the parent's open connections."""
+        import os
+        import subprocess
+        import sys
+        if not hasattr(os, "register_at_fork"):
+            pytest.skip("Needs os.fork")
+        code = (
+            "import os, database; "
+            "database.engine.connect().close(); "
+            "pools = (database.engine.pool, database.async_engine.pool); "
+            "pid = os.fork(); "
+            "os._exit(0 if database.engine.pool.checkedin() == 0 and database.engine.pool not in pools "
+            "and database.async_engine.pool not in pools else 1) if pid == 0 else None; "
+            "print(os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]), pools[0].checkedin())"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env={**os.environ, "DATABASE_URL": f"sqlite:///{tmp_path}/fork.db"},
+        )
+        # The child replaced both pools; the parent still holds its pooled connection
+        assert result.stdout.split() == ["0", "1"]
+
+    def test_warns_about_state_workers_do_not_share(self, monkeypatch):
+        """Test start.py lists per-process state for multi-worker runs until shared backends are set."""
+        import cache
+        import events
+        import ratelimit
+        import start
+
+        monkeypatch.setattr(cache, "NOTE_CACHE_SHARED_URL", "memory://")  # Still one process's memory
+        state = start.per_worker_state()
+        assert [line.split(":")[0] for line in state] == [
+            "rate limit buckets", "note events", "note cache", "user cache"
+        ]
+
+        monkeypatch.setattr(ratelimit, "RATE_LIMIT_SHARED_URL", "redis://cache:6379/0")
+        monkeypatch.setattr(events, "NOTE_EVENTS_URL", "redis://cache:6379/1")
+        monkeypatch.setattr(cache, "NOTE_CACHE_SHARED_URL", "redis://cache:6379/2")
+        monkeypatch.setattr(cache, "USER_CACHE_SIZE", 0)
+        assert start.per_worker_state() == []
+
+class TestJWTFastPath:
+    def test_matches_jose_and_rejects_bad_tokens(self):
+        """Test the HS256 verifier accepts what jose accepts and rejects tampered tokens."""
+        import base64
+        from datetime import timedelta
+        from auth import HS256Verifier, SECRET_KEY, create_access_token, decode_token_jose
+
+        verifier = HS256Verifier(SECRET_KEY, cache_size=0)
+        token = create_access_token({"sub": "alice"}, timedelta(minutes=5))
+        assert verifier.decode(token) == decode_token_jose(token)
+
+        header, payload, signature = token.split(".")
+        forged = base64.urlsafe_b64encode(b'{"sub":"mallory","exp":9999999999}').rstrip(b"=").decode()
+        none_header = base64.urlsafe_b64encode(b'{"alg":"none","typ":"JWT"}').rstrip(b"=").decode()
+        for bad in (
+            f"{header}.{forged}.{signature}",
+            f"{header}.{payload}.{signature[:-2]}AA",
+            f"{none_header}.{payload}.",
+            f"{header}.{payload}",
+            "not-a-token",
+            create_access_token({"sub": "alice"}, timedelta(minutes=-1)),
+            create_access_token({"user": "alice"}, timedelta(minutes=5)),
+        ):
+            assert verifier.decode(bad) is None
+        assert HS256Verifier("another-secret", cache_size=0).decode(token) is None
+
+    def test_verified_cache_expires_with_token(self):
+        """Test cached verifications are reused only until the token's exp."""
+        from datetime import timedelta
+        from auth import HS256Verifier, SECRET_KEY, create_access_token
+
+        now = [time.time()]
+        verifier = HS256Verifier(SECRET_KEY, cache_size=2, clock=lambda: now[0])
+        token = create_access_token({"sub": "bob"}, timedelta(minutes=5))
+        claims = verifier.decode(token)
+        assert verifier.decode(token) is claims
+
+        for name in ("carol", "dave"):
+            verifier.decode(create_access_token({"sub": name}, timedelta(minutes=5)))
+        assert token not in verifier._verified  # LRU evicted
+
+        verifier.decode(token)
+        now[0] += 600
+        assert verifier.decode(token) is None
+
+class TestRevisions:
+    def setup_method(self):
+        """Setup method to create a fresh user with a long multi-line note."""
+        username = f"revisions{uuid.uuid4().hex[:8]}"
+        client.post("/auth/register", json={
+            "username": username,
+            "email": f"{username}@example.com",
+            "password": "revisionspassword123"
+        })
+        response = client.post("/auth/login", json={
+            "username": username,
+            "password": "revisionspassword123"
+        })
+        self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+        self.lines = [f"line {i} " + "x" * 60 + "\n" for i in range(200)]
+        self.note = client.post("/notes", json={"title": "History", "content": "".join(self.lines)},
+                                headers=self.headers).json()
+
+    def test_every_version_rebuilds_from_compact_history(self):
+        """Test each version rebuilds exactly and deltas stay a fraction of full copies."""
+        from sqlalchemy import func, select
+        from database import NoteRevision, SessionLocal
+
+        note_id = self.note["id"]
+        contents = {1: "".join(self.lines)}
+        for version in range(1, 46):
+            self.lines[version * 7 % 200] = f"edit {version}\n"
+            response = client.put(f"/notes/{note_id}", json={"content": "".join(self.lines), "version": version},
+                                  headers=self.headers)
+            assert response.status_code == 200
+            contents[version + 1] = "".join(self.lines)
+
+        for version, content in contents.items():
+            response = client.get(f"/notes/{note_id}/revisions/{version}", headers=self.headers)
+            assert response.status_code == 200
+            assert response.json()["content"] == content
+        past = client.get(f"/notes/{note_id}/revisions/10", headers=self.headers)
+        assert "immutable" in past.headers["cache-control"]
+        assert client.get(f"/notes/{note_id}/revisions/47", headers=self.headers).status_code == 404
+
+        listed = client.get(f"/notes/{note_id}/revisions?limit=5&before=40", headers=self.headers).json()
+        assert [r["version"] for r in listed] == [39, 38, 37, 36, 35]
+
+        with SessionLocal() as db:
+            stored = db.scalar(select(func.sum(func.length(NoteRevision.data))).where(NoteRevision.note_id == note_id))
+        assert stored < 0.2 * sum(len(content) for content in contents.values())
+
+        client.delete(f"/notes/{note_id}", headers=self.headers)
+        with SessionLocal() as db:
+            assert db.scalar(select(func.count()).where(NoteRevision.note_id == note_id)) == 0
+
+    def test_repetitive_content_diffs_in_linear_time(self):
+        """Test edits to a large note full of repeated blank lines stay fast and rebuild exactly."""
+        from revisions import apply_delta, make_delta
+
+        lines = ["\n" if i % 2 else f"paragraph {i}\n" for i in range(12000)]
+        old = "".join(lines)
+        lines[6001] = "edited\n"
+        new = "".join(lines)
+        start = time.perf_counter()
+        delta = make_delta(old, new)
+        unchanged = make_delta(old, old)
+        assert time.perf_counter() - start < 1.0
+        assert apply_delta(old, delta) == new
+        assert unchanged == [12000]
+
+    def test_bulk_update_records_revisions(self):
+        """Test bulk updates, including repeated items for one note, are kept in the history."""
+        note_id = self.note["id"]
+        assert [r["version"] for r in client.get(f"/notes/{note_id}/revisions", headers=self.headers).json()] == [1]
+
+        response = client.patch("/notes/bulk", json={"items": [
+            {"id": note_id, "version": 1, "title": "Renamed"},
+            {"id": note_id, "version": 2, "content": "short"},
+        ]}, headers=self.headers)
+        assert [r["status"] for r in response.json()["results"]] == [200, 200]
+
+        v2 = client.get(f"/notes/{note_id}/revisions/2", headers=self.headers).json()
+        assert (v2["title"], v2["content"]) == ("Renamed", "".join(self.lines))
+        assert client.get(f"/notes/{note_id}/revisions/1", headers=self.headers).json()["title"] == "History"
+        assert client.get(f"/notes/{note_id}/revisions/3", headers=self.headers).json()["content"] == "short"
+
+class TestChangeFeed:
+    def setup_method(self):
+        """Setup method to create a fresh user with a few notes."""
+        username = f"changes{uuid.uuid4().hex[:8]}"
+        client.post("/auth/register", json={
+            "username": username,
+            "email": f"{username}@example.com",
+            "password": "changespassword123"
+        })
+        response = client.post("/auth/login", json={
+            "username": username,
+            "password": "changespassword123"
+        })
+        self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+        self.ids = [
+            client.post("/notes", json={"title": f"Note {i}", "content": "c"}, headers=self.headers).json()["id"]
+            for i in range(3)
+        ]
+
+    def sync(self, since=None, limit=500):
+        params = {"limit": limit} if since is None else {"since": since, "limit": limit}
+        response = client.get("/notes/changes", params=params, headers=self.headers)
+        assert response.status_code == 200
+        return response.json()
+
+    def test_changes_since_cursor_include_tombstones(self):
+        """Test a sync returns only what changed after the cursor, deletions included."""
+        full = self.sync()
+        assert [c["id"] for c in full["changes"]] == self.ids
+        assert not full["has_more"]
+        assert self.sync(full["cursor"])["changes"] == []
+
+        client.put(f"/notes/{self.ids[0]}", json={"content": "edited", "version": 1}, headers=self.headers)
+        client.delete(f"/notes/{self.ids[1]}", headers=self.headers)
+        new_id = client.post("/notes", json={"title": "New", "content": "c"}, headers=self.headers).json()["id"]
+
+        delta = self.sync(full["cursor"])
+        assert [(c["id"], c["deleted"]) for c in delta["changes"]] == [
+            (self.ids[0], False), (self.ids[1], True), (new_id, False)
+        ]
+        assert delta["changes"][0]["note"]["content"] == "edited"
+        assert delta["changes"][1]["note"] is None
+        seqs = [c["change_seq"] for c in delta["changes"]]
+        assert seqs == sorted(seqs)
+
+        assert client.get("/notes/changes?since=bogus", headers=self.headers).status_code == 400
+
+    def test_bulk_writes_and_paging(self):
+        """Test bulk create, update and delete feed the same sequence, paged by limit."""
+        cursor = self.sync()["cursor"]
+        created = client.post("/notes/bulk", json={"items": [
+            {"title": f"Bulk {i}", "content": "c"} for i in range(4)
+        ]}, headers=self.headers).json()["results"]
+        bulk_ids = [r["id"] for r in created]
+        client.patch("/notes/bulk", json={"items": [{"id": bulk_ids[0], "version": 1, "title": "Moved"}]},
+                     headers=self.headers)
+        client.post("/notes/bulk/delete", json={"items": [{"id": bulk_ids[1]}]}, headers=self.headers)
+
+        seen = []
+        while True:
+            page = self.sync(cursor, limit=2)
+            seen += [(c["id"], c["deleted"]) for c in page["changes"]]
+            cursor = page["cursor"]
+            if not page["has_more"]:
+                break
+        assert seen == [(bulk_ids[2], False), (bulk_ids[3], False), (bulk_ids[0], False), (bulk_ids[1], True)]
+
+class TestNoteEvents:
+    def setup_method(self):
+        """Setup method to create a fresh user and token."""
+        username = f"events{uuid.uuid4().hex[:8]}"
+        client.post("/auth/register", json={
+            "username": username,
+            "email": f"{username}@example.com",
+            "password": "eventspassword123"
+        })
+        response = client.post("/auth/login", json={
+            "username": username,
+            "password": "eventspassword123"
+        })
+        self.token = response.json()["access_token"]
+        self.headers = {"Authorization": f"Bearer {self.token}"}
+
+    def test_websocket_receives_committed_changes(self):
+        """Test create, update and delete each push one event to the owner's socket."""
+        from starlette.websockets import WebSocketDisconnect
+
+        for url, protocols in (("/notes/events", ["notes.bearer", "bogus"]),
+                               (f"/notes/events?token={self.token}", [])):  # URLs end up in access logs
+            with pytest.raises(WebSocketDisconnect):
+                with client.websocket_connect(url, subprotocols=protocols) as ws:
+                    ws.receive_json()
+
+        with client.websocket_connect("/notes/events", subprotocols=["notes.bearer", self.token]) as ws:
+            assert ws.accepted_subprotocol == "notes.bearer"
+            note = client.post("/notes", json={"title": "Live", "content": "c"}, headers=self.headers).json()
+            client.put(f"/notes/{note['id']}", json={"content": "d", "version": 1}, headers=self.headers)
+            client.delete(f"/notes/{note['id']}", headers=self.headers)
+            events = [ws.receive_json() for _ in range(3)]
+        assert [(e["type"], e["id"], e["version"]) for e in events] == [
+            ("created", note["id"], 1), ("updated", note["id"], 2), ("deleted", note["id"], None)
+        ]
+        assert events[0]["change_seq"] < events[1]["change_seq"] < events[2]["change_seq"]
+
+        # Clients that can set headers send the token as usual
+        with client.websocket_connect("/notes/events", headers=self.headers) as ws:
+            client.post("/notes", json={"title": "Header", "content": "c"}, headers=self.headers)
+            assert ws.receive_json()["type"] == "created"
+
+    def test_shared_bus_and_overflow(self):
+        """Test events cross brokers on a shared bus and a slow subscriber is told to resync."""
+        import asyncio
+        from events import InMemoryEventBus, NoteEventBroker
+
+        bus = InMemoryEventBus()
+        worker_a, worker_b = NoteEventBroker(bus), NoteEventBroker(bus, queue_size=2)
+
+        async def scenario():
+            local = worker_a.subscribe(7)
+            remote = worker_b.subscribe(7)
+            other_owner = worker_b.subscribe(8)
+            worker_a.publish(7, "updated", 1, version=2, change_seq=5)
+            assert (await local.get(1))["id"] == 1
+            assert (await remote.get(1))["change_seq"] == 5
+            assert await local.get(0.01) is None
+            assert await other_owner.get(0.01) is None
+
+            for version in range(3, 6):
+                worker_a.publish(7, "updated", 1, version=version)
+            assert (await remote.get(1))["type"] == "resync"
+            worker_b.unsubscribe(remote)
+            assert worker_b.resyncs == 1 and len(worker_b) == 1
+
+        asyncio.run(scenario())
+
+class TestRateLimiting:
+    def test_token_bucket(self):
+        """Test a bucket allows its burst, then refills at its rate."""
+        import asyncio
+        from ratelimit import LocalBucketStore
+
+        now = [0.0]
+        store = LocalBucketStore(maxsize=2, clock=lambda: now[0])
+
+        async def scenario():
+            assert [await store.take("a", 2, 2) for _ in range(3)] == [0, 0, 0.5]
+            now[0] += 0.5
+            assert await store.take("a", 2, 2) == 0
+            await store.take("b", 2, 2)
+            await store.take("c", 2, 2)
+            assert len(store) == 2 and await store.take("a", 2, 2) == 0  # "a" was evicted, so it starts full
+
+        asyncio.run(scenario())
+
+    def test_auth_limited_per_ip_and_users_separately(self, monkeypatch):
+        """Test the auth bucket refuses with 429 and one user's bucket doesn't spend another's."""
+        from ratelimit import LocalBucketStore, RateLimit
+
+        monkeypatch.setattr(rate_limiter, "enabled", True)
+        monkeypatch.setattr(rate_limiter, "store", LocalBucketStore())
+        tokens = []
+        for name in ("ratelimited1", "ratelimited2"):
+            client.post("/auth/register", json={
+                "username": name, "email": f"{name}@example.com", "password": "ratepassword123"
+            })
+            tokens.append(client.post("/auth/login", json={
+                "username": name, "password": "ratepassword123"
+            }).json()["access_token"])
+
+        monkeypatch.setattr(rate_limiter, "auth_limit", RateLimit(rate=0.01, burst=1))
+        monkeypatch.setattr(rate_limiter, "user_limit", RateLimit(rate=0.01, burst=2))
+        login = {"username": "ratelimited1", "password": "ratepassword123"}
+        assert client.post("/auth/login", json=login).status_code == 200
+        refused = client.post("/auth/login", json=login)
+        assert refused.status_code == 429
+        assert int(refused.headers["Retry-After"]) >= 1
+
+        first, second = ({"Authorization": f"Bearer {token}"} for token in tokens)
+        assert [client.get("/users/me", headers=first).status_code for _ in range(3)] == [200, 200, 429]
+        assert client.get("/users/me", headers=second).status_code == 200
+        assert client.get("/health").status_code == 200
+
+    def test_load_shedder_backs_off_and_recovers(self, monkeypatch):
+        """Test a slow p99 halves the limits, sheds with 503 at the floor, then recovers."""
+        from ratelimit import LoadShedder
+
+        now = [0.0]
+        shedder = LoadShedder(p99_ms=100, pool_wait_ms=0, window=10, min_factor=0.25,
+                              min_samples=10, clock=lambda: now[0])
+        for _ in range(20):
+            shedder.observe(0.5)
+        for expected in (0.5, 0.25):
+            now[0] += 1
+            shedder.evaluate()
+            assert shedder.factor == expected
+        assert shedder.shedding
+
+        monkeypatch.setattr(rate_limiter, "enabled", True)
+        monkeypatch.setattr(rate_limiter, "shedder", shedder)
+        response = client.get("/users/me")
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+
+        now[0] += 11  # The slow samples leave the window
+        shedder.evaluate()
+        assert not shedder.shedding and shedder.factor == 0.35
+
+
+class TestCompression:
+    def setup_method(self):
+        """Setup method to create a fresh user with a note large enough to be compressed."""
+        username = f"compress{uuid.uuid4().hex[:8]}"
+        client.post("/auth/register", json={
+            "username": username,
+            "email": f"{username}@example.com",
+            "password": "compresspassword123"
+        })
+        response = client.post("/auth/login", json={
+            "username": username,
+            "password": "compresspassword123"
+        })
+        self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+        self.content = "".join(f"Paragraph {i}: the quick brown fox jumps over the lazy dog.\n" for i in range(400))
+        self.content += "zebracorn\n"
+        self.note = client.post("/notes", json={"title": "Large", "content": self.content},
+                                headers=self.headers).json()
+
+    def test_large_content_is_stored_compressed(self):
+        """Test large content is a compressed BLOB at rest yet reads, searches and previews as text."""
+        from sqlalchemy import text
+        from database import engine
+
+        note_id = self.note["id"]
+        with engine.connect() as connection:
+            kind, size = connection.execute(
+                text("SELECT typeof(content), length(content) FROM notes WHERE id = :id"), {"id": note_id}
+            ).one()
+            # A row written before compression existed still reads back
+            connection.execute(text("UPDATE notes SET content = 'legacy text' WHERE id = :id"), {"id": note_id})
+            legacy = connection.execute(text("SELECT note_text(content) FROM notes WHERE id = :id"),
+                                        {"id": note_id}).scalar()
+            connection.rollback()
+        assert kind == "blob"
+        assert size < len(self.content) / 5
+        assert legacy == "legacy text"
+
+        assert client.get(f"/notes/{note_id}", headers=self.headers).json()["content"] == self.content
+        results = client.get("/notes/search?q=zebracorn", headers=self.headers).json()
+        assert [r["id"] for r in results] == [note_id]
+        assert "<mark>zebracorn</mark>" in results[0]["snippet"]
+        summary = client.get("/notes/summary?preview=12", headers=self.headers).json()
+        assert summary[0]["preview"] == "Paragraph 0:"
+
+        edited = self.content.replace("Paragraph 7:", "Paragraph seven:")
+        response = client.put(f"/notes/{note_id}", json={"content": edited, "version": 1}, headers=self.headers)
+        assert response.status_code == 200
+        assert client.get(f"/notes/{note_id}/revisions/1", headers=self.headers).json()["content"] == self.content
+        assert client.get("/notes/search?q=seven", headers=self.headers).json()[0]["id"] == note_id
+        assert client.get("/notes/search?q=zebracorn", headers=self.headers).json()[0]["id"] == note_id
+
+    def test_large_responses_are_gzipped(self):
+        """Test /notes responses are gzip-encoded when accepted and large enough."""
+        response = client.get("/notes", headers={**self.headers, "Accept-Encoding": "gzip"})
+        assert response.headers["content-encoding"] == "gzip"
+        assert "Accept-Encoding" in response.headers["vary"]
+        assert int(response.headers["content-length"]) < len(self.content) / 5
+        assert response.json()[0]["content"] == self.content
+
+        identity = client.get("/notes", headers={**self.headers, "Accept-Encoding": "identity"})
+        assert "content-encoding" not in identity.headers
+        assert identity.json() == response.json()
+
+        small = client.post("/notes", json={"title": "Small", "content": "tiny"}, headers=self.headers).json()
+        response = client.get(f"/notes/{small['id']}", headers={**self.headers, "Accept-Encoding": "gzip"})
+        assert "content-encoding" not in response.headers
+        assert response.json()["content"] == "tiny"
+
+    def test_search_triggers_need_note_text_only_while_notes_may_be_compressed(self, tmp_path):
+        """Test other SQLite clients can write to notes once compression is off and no row is compressed."""
+        import os
+        import sqlite3
+        import subprocess
+        import sys
+        path = tmp_path / "external.db"
+        seed = (
+            "import sys; from database import SessionLocal, Note, User, create_tables; create_tables(); "
+            "db = SessionLocal(); "
+            "user = db.query(User).first() or User(username='ext', email='ext@example.com', hashed_password='x'); "
+            "db.add(user); db.flush(); db.add(Note(title='Wombat', content=sys.argv[1], owner_id=user.id)); "
+            "db.commit()"
+        )
+
+        def start(compression, content=None):
+            code = seed if content is not None else "from database import create_tables; create_tables()"
+            subprocess.run(
+                [sys.executable, "-c", code] + ([content] if content is not None else []),
+                capture_output=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+                env={**os.environ, "DATABASE_URL": f"sqlite:///{path}", "NOTE_COMPRESSION": compression},
+            )
+
+        def external_update(content):
+            # A plain sqlite3 connection: no note_text() registered
+            with sqlite3.connect(str(path)) as connection:
+                connection.execute("UPDATE notes SET content = ?", (content,))
+                return connection.execute("SELECT rowid FROM notes_fts WHERE notes_fts MATCH 'quokka'").fetchall()
+
+        start("none", "burrowing marsupial")
+        assert external_update("quokka") == [(1,)]
+
+        start("zlib")  # Compression on: the triggers decode content with note_text()
+        with pytest.raises(sqlite3.OperationalError, match="no such function: note_text"):
+            external_update("quokka again")
+
+        start("zlib", "quokka " * 2000)  # Stored compressed
+        start("none")  # Compressed rows remain, so the triggers keep decoding them
+        with pytest.raises(sqlite3.OperationalError, match="no such function: note_text"):
+            external_update("quokka again")
+
+
+class TestReadReplicas:
+    def setup_method(self):
+        """Setup method to create a fresh user with one note."""
+        self.username = f"replica{uuid.uuid4().hex[:8]}"
+        client.post("/auth/register", json={
+            "username": self.username,
+            "email": f"{self.username}@example.com",
+            "password": "replicapassword123"
+        })
+        response = client.post("/auth/login", json={
+            "username": self.username,
+            "password": "replicapassword123"
+        })
+        self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+        self.first = client.post("/notes", json={"title": "First", "content": "On the replica"},
+                                 headers=self.headers).json()
+        # Start without a read-your-writes window from this or an earlier test's writes
+        client.cookies.clear()
+
+    @staticmethod
+    def snapshot(path):
+        """Copy the primary SQLite database to path: a replica frozen at this point."""
+        import sqlite3
+        from database import engine
+
+        source, target = sqlite3.connect(engine.url.database), sqlite3.connect(str(path))
+        source.backup(target)
+        source.close()
+        target.close()
+
+    def test_reads_go_to_replica_outside_read_your_writes_window(self, tmp_path, monkeypatch):
+        """Test GET reads use a lagging replica, except a client's reads just after its own writes."""
+        import database
+        from sqlalchemy.ext.asyncio import create_async_engine
+
+        self.snapshot(tmp_path / "replica.db")
+        replica = database.Replica(create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'replica.db'}"), "test")
+        monkeypatch.setattr(database, "replica_set", database.ReplicaSet([replica]))
+        monkeypatch.setattr(database, "READ_YOUR_WRITES_SECONDS", 0.5)
+        routed = database.routed_reads.value("replica")
+
+        # A client without a recent write is served by the lagging copy
+        assert [n["id"] for n in client.get("/notes", headers=self.headers).json()] == [self.first["id"]]
+        assert database.routed_reads.value("replica") > routed
+
+        # A write opens the client's read-your-writes window on the primary
+        second = client.post("/notes", json={"title": "Second", "content": "Primary only"},
+                             headers=self.headers).json()
+        assert database.LAST_WRITE_COOKIE in client.cookies
+        notes = client.get("/notes", headers=self.headers).json()
+        assert [n["id"] for n in notes] == [self.first["id"], second["id"]]
+        # The window travels with the client, so another worker's fresh replica set honours it too
+        monkeypatch.setattr(database, "replica_set", database.ReplicaSet([replica]))
+        client.put(f"/notes/{second['id']}", json={"title": "Second v2", "version": 1}, headers=self.headers)
+        notes = client.get("/notes", headers=self.headers).json()
+        assert [(n["id"], n["version"]) for n in notes] == [(self.first["id"], 1), (second["id"], 2)]
+        time.sleep(0.6)
+        assert [n["id"] for n in client.get("/notes", headers=self.headers).json()] == [self.first["id"]]
+
+        # Accounts the replica doesn't have yet are looked up again on the primary
+        username = f"late{uuid.uuid4().hex[:8]}"
+        client.post("/auth/register", json={"username": username, "email": f"{username}@example.com",
+                                             "password": "replicapassword123"})
+        token = client.post("/auth/login", json={"username": username, "password": "replicapassword123"})
+        response = client.get("/users/me", headers={"Authorization": f"Bearer {token.json()['access_token']}"})
+        assert response.status_code == 200
+        assert response.json()["username"] == username
+
+    def test_unreachable_replica_is_skipped(self, tmp_path, monkeypatch):
+        """Test a replica that fails to connect leaves rotation and reads fall back to the primary."""
+        import database
+        from sqlalchemy.ext.asyncio import create_async_engine
+
+        broken = database.Replica(
+            create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'missing' / 'replica.db'}"), "broken"
+        )
+        monkeypatch.setattr(database, "replica_set", database.ReplicaSet([broken]))
+        with pytest.raises(Exception):
+            client.get("/notes/summary", headers=self.headers)
+        assert not broken.healthy
+        response = client.get("/notes/summary", headers=self.headers)
+        assert response.status_code == 200
+        assert [n["id"] for n in response.json()] == [self.first["id"]]
+
+    def test_balancing(self):
+        """Test round-robin alternates between healthy replicas and least-connections picks the idlest."""
+        import database
+
+        class FakeReplica:
+            def __init__(self, in_use, healthy=True):
+                self.in_use = in_use
+                self.healthy = healthy
+
+            def checked_out(self):
+                return self.in_use
+
+        a, b, down = FakeReplica(3), FakeReplica(1), FakeReplica(0, healthy=False)
+        replicas = database.ReplicaSet([a, b, down], balance="round_robin")
+        assert [replicas.choose() for _ in range(4)] == [a, b, a, b]
+        replicas = database.ReplicaSet([a, b, down], balance="least_connections")
+        assert {replicas.choose() for _ in range(4)} == {b}
+        assert database.ReplicaSet([down]).choose() is None
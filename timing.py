@@ -0,0 +1,206 @@
+"""
+Per-request timing: where a request's time goes, by phase
+
+TimingMiddleware puts a RequestTimings object in a context variable for the
+duration of each HTTP request. Code on the hot path adds to it with
+`timed(phase)` or `add(phase, seconds)`; SQL statements are counted and timed
+through cursor execute events on both engines. When the response starts the
+phases are sent as a Server-Timing header, and when it finishes they are
+recorded in per-route histograms on /metrics.
+
+Recording costs a few perf_counter() calls and dict updates per request.
+"""
+import asyncio
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Dict, Optional
+
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+
+from metrics import registry
+
+SERVER_TIMING_HEADER = os.getenv("SERVER_TIMING_HEADER", "true").lower() in ("1", "true", "yes")
+
+# Phases reported for every request, in Server-Timing order
+PHASES = ("jwt", "user", "sql", "bcrypt", "endpoint", "serialize", "compress")
+
+request_duration = registry.histogram(
+    "http_request_duration_seconds", "Time from request start to end of response", ["method", "route", "status"]
+)
+phase_duration = registry.histogram(
+    "http_request_phase_seconds", "Time a request spent in each instrumented phase", ["route", "phase"]
+)
+sql_queries = registry.histogram(
+    "http_request_sql_queries", "SQL statements executed per request", ["route"],
+    buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100),
+)
+
+
+class RequestTimings:
+    """Mutable per-request accumulator; shared by every task the request spawns."""
+
+    __slots__ = ("phases", "sql_count", "endpoint_finished")
+
+    def __init__(self):
+        self.phases: Dict[str, float] = {}
+        self.sql_count = 0
+        self.endpoint_finished: Optional[float] = None
+
+    def add(self, phase: str, seconds: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def server_timing(self, total: float) -> str:
+        parts = [
+            "%s;dur=%.3f" % (phase, self.phases[phase] * 1000) for phase in PHASES if phase in self.phases
+        ]
+        if self.sql_count:
+            parts.append('sql_count;desc="%d"' % self.sql_count)
+        parts.append("total;dur=%.3f" % (total * 1000))
+        return ", ".join(parts)
+
+
+_current: ContextVar[Optional[RequestTimings]] = ContextVar("request_timings", default=None)
+
+
+def current() -> Optional[RequestTimings]:
+    return _current.get()
+
+
+def add(phase: str, seconds: float) -> None:
+    timings = _current.get()
+    if timings is not None:
+        timings.add(phase, seconds)
+
+
+@contextmanager
+def timed(phase: str):
+    """Add the time spent in the block to the current request's phase."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(phase, time.perf_counter() - start)
+
+
+def _route_label(scope) -> str:
+    # Route templates keep the label set bounded; unmatched paths share one label
+    route = scope.get("route")
+    return getattr(route, "path", None) or "<unmatched>"
+
+
+class TimingMiddleware:
+    """Pure ASGI middleware, so it adds no task or body buffering to the request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        timings = RequestTimings()
+        token = _current.set(timings)
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_with_timing(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if SERVER_TIMING_HEADER:
+                    header = timings.server_timing(time.perf_counter() - start)
+                    message = {**message, "headers": [*message.get("headers", []),
+                                                      (b"server-timing", header.encode())]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+            route = _route_label(scope)
+            request_duration.observe(time.perf_counter() - start, scope["method"], route, str(status_code))
+            for phase, seconds in timings.phases.items():
+                phase_duration.observe(seconds, route, phase)
+            sql_queries.observe(timings.sql_count, route)
+
+
+class TimedRoute(APIRoute):
+    """APIRoute that splits handler time into the endpoint body and response serialization."""
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, _time_endpoint(endpoint), **kwargs)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def timed_handler(request):
+            response = await handler(request)
+            timings = _current.get()
+            if timings is not None and timings.endpoint_finished is not None:
+                # Everything after the endpoint returned: validation against
+                # response_model, jsonable_encoder and rendering the body
+                timings.add("serialize", time.perf_counter() - timings.endpoint_finished)
+            return response
+
+        return timed_handler
+
+
+def _endpoint_finished(start: float) -> None:
+    timings = _current.get()
+    if timings is not None:
+        timings.endpoint_finished = time.perf_counter()
+        timings.add("endpoint", timings.endpoint_finished - start)
+
+
+def _time_endpoint(endpoint):
+    # functools.wraps keeps __wrapped__, which FastAPI follows to read the signature.
+    # Sync endpoints stay sync so FastAPI still runs them in the threadpool.
+    if asyncio.iscoroutinefunction(endpoint):
+        @wraps(endpoint)
+        async def timed_endpoint(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                _endpoint_finished(start)
+    else:
+        @wraps(endpoint)
+        def timed_endpoint(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                _endpoint_finished(start)
+
+    return timed_endpoint
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_start"].pop()
+    timings = _current.get()
+    if timings is not None:
+        timings.sql_count += 1
+        timings.add("sql", time.perf_counter() - started)
+
+
+def _handle_error(exception_context):
+    # after_cursor_execute doesn't run for failed statements; still count their time
+    # ExceptionContextImpl leaves its `cursor` slot unset in SQLAlchemy 2.0, so test the execution context
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("query_start") and exception_context.execution_context is not None:
+        _after_cursor_execute(conn, None, None, None, None, False)
+
+
+def instrument_engine(engine) -> None:
+    """Count and time every statement run on a sync Engine (or an AsyncEngine's sync_engine)."""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
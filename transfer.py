@@ -0,0 +1,261 @@
+"""
+Streaming export and import of a user's notes as NDJSON or CSV.
+
+Exports read from a server-side cursor in fixed-size partitions and encode
+one partition at a time. Imports parse the request body as it arrives and
+insert in batched transactions. Either way memory stays flat however many
+notes are involved.
+"""
+import codecs
+import csv
+import io
+import json
+import os
+import zlib
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+from pydantic import ValidationError
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from changes import allocate_change_seqs
+from database import AsyncSessionLocal, Note
+from metrics import registry
+from schemas import NoteCreate
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", 1000))
+IMPORT_MAX_ERRORS = int(os.getenv("IMPORT_MAX_ERRORS", 100))
+# A record longer than this is rejected rather than buffered without bound
+IMPORT_MAX_RECORD_BYTES = int(os.getenv("IMPORT_MAX_RECORD_BYTES", 1024 * 1024))
+
+import_rows = registry.counter(
+    "notes_import_rows_total", "Rows processed by /notes/import, updated after every batch", ["result"]
+)
+
+EXPORT_COLUMNS = ("id", "title", "content", "created_at", "updated_at", "version")
+
+EXPORT_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+
+
+def _encode_ndjson(rows: Sequence, header: bool) -> bytes:
+    lines = []
+    for row in rows:
+        record = dict(zip(EXPORT_COLUMNS, row))
+        record["created_at"] = record["created_at"].isoformat() if record["created_at"] else None
+        record["updated_at"] = record["updated_at"].isoformat() if record["updated_at"] else None
+        lines.append(json.dumps(record, ensure_ascii=False))
+    return ("\n".join(lines) + "\n").encode() if lines else b""
+
+
+def _encode_csv(rows: Sequence, header: bool) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        writer.writerow([value.isoformat() if hasattr(value, "isoformat") else value for value in row])
+    return buffer.getvalue().encode()
+
+
+_ENCODERS = {"ndjson": _encode_ndjson, "csv": _encode_csv}
+
+
+async def export_notes(owner_id: int, fmt: str, compress: bool = False) -> AsyncIterator[bytes]:
+    """Yield the owner's notes, ordered by id, encoded as fmt and optionally gzipped.
+
+    Opens its own session: the request's session is closed before a
+    streaming body starts being sent.
+    """
+    encode = _ENCODERS[fmt]
+    compressor = zlib.compressobj(wbits=31) if compress else None  # wbits=31 writes a gzip container
+    query = (
+        select(*(getattr(Note, column) for column in EXPORT_COLUMNS))
+        .where(Note.owner_id == owner_id)
+        .order_by(Note.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+    header = True
+    async with AsyncSessionLocal() as session:
+        result = await session.stream(query)
+        async for rows in result.partitions():
+            chunk = encode(rows, header)
+            header = False
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+    if header:
+        # No rows at all: CSV still gets its header line
+        chunk = encode([], True)
+        if compressor is not None:
+            chunk = compressor.compress(chunk)
+        if chunk:
+            yield chunk
+    if compressor is not None:
+        yield compressor.flush()
+
+
+class RecordTooLarge(ValueError):
+    pass
+
+
+async def _decoded_lines(chunks: AsyncIterator[bytes], gzipped: bool) -> AsyncIterator[str]:
+    """Split a byte stream into text lines (newline kept) without holding more than one line."""
+    inflater = zlib.decompressobj(wbits=31) if gzipped else None
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    pending = ""
+    async for chunk in chunks:
+        if inflater is not None:
+            chunk = inflater.decompress(chunk)
+        pending += decoder.decode(chunk)
+        # Only "\n" ends a line: str.splitlines() would also split on characters
+        # such as U+2028 that JSON strings may contain unescaped
+        lines = pending.split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line + "\n"
+        if len(pending) > IMPORT_MAX_RECORD_BYTES:
+            raise RecordTooLarge(f"line longer than {IMPORT_MAX_RECORD_BYTES} bytes")
+    if inflater is not None:
+        pending += decoder.decode(inflater.flush())
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+async def _ndjson_records(lines: AsyncIterator[str]) -> AsyncIterator[Tuple[int, Optional[dict], Optional[str]]]:
+    line_no = 0
+    async for line in lines:
+        line_no += 1
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as exc:
+            yield line_no, None, f"invalid JSON: {exc}"
+            continue
+        if not isinstance(record, dict):
+            yield line_no, None, "expected a JSON object"
+            continue
+        yield line_no, record, None
+
+
+async def _csv_records(lines: AsyncIterator[str]) -> AsyncIterator[Tuple[int, Optional[dict], Optional[str]]]:
+    """Group physical lines into CSV records; a record is complete once its quotes balance."""
+    header = None
+    line_no = 0
+    start = 0
+    parts: List[str] = []
+    size = quotes = 0
+    async for line in lines:
+        line_no += 1
+        if not parts:
+            start = line_no
+        parts.append(line)
+        size += len(line)
+        quotes += line.count('"')
+        if quotes % 2:
+            if size > IMPORT_MAX_RECORD_BYTES:
+                raise RecordTooLarge(f"record starting on line {start} is longer than {IMPORT_MAX_RECORD_BYTES} bytes")
+            continue
+        text = "".join(parts)
+        parts, size, quotes = [], 0, 0
+        if not text.strip():
+            continue
+        row = next(csv.reader([text]))
+        if header is None:
+            header = row
+            continue
+        if len(row) != len(header):
+            yield start, None, f"expected {len(header)} fields, got {len(row)}"
+            continue
+        yield start, dict(zip(header, row)), None
+    if parts:
+        yield start, None, "unterminated quoted field"
+
+
+_RECORD_READERS = {"ndjson": _ndjson_records, "csv": _csv_records}
+
+
+async def _insert_batch(db: AsyncSession, owner_id: int, rows: List[Dict]) -> None:
+    """Insert one batch in its own transaction, with COPY on asyncpg."""
+    first_seq = await allocate_change_seqs(db, owner_id, len(rows))
+    for offset, row in enumerate(rows):
+        row["change_seq"] = first_seq + offset
+    if db.get_bind().dialect.driver == "asyncpg":
+        # COPY skips column defaults, so fill them in here
+        now = datetime.utcnow()
+        columns = ["title", "content", "owner_id", "created_at", "updated_at", "version", "change_seq"]
+        records = [(row["title"], row["content"], row["owner_id"], now, now, 1, row["change_seq"]) for row in rows]
+        connection = await db.connection()
+        raw = await connection.get_raw_connection()
+        await raw.driver_connection.copy_records_to_table(
+            Note.__tablename__, records=records, columns=columns
+        )
+    else:
+        await db.execute(insert(Note), rows)
+    await db.commit()
+
+
+async def import_notes(
+    db: AsyncSession, owner_id: int, chunks: AsyncIterator[bytes], fmt: str,
+    batch_size: int = IMPORT_BATCH_SIZE, gzipped: bool = False
+) -> dict:
+    """Validate each record against NoteCreate and insert the valid ones in batches.
+
+    Batches already committed stay committed if a later one fails; the
+    summary says how far the import got.
+    """
+    summary = {"imported": 0, "failed": 0, "batches": 0, "errors": [], "errors_truncated": False}
+
+    def fail(line_no: int, message: str, count: int = 1) -> None:
+        summary["failed"] += count
+        import_rows.inc("failed", amount=count)
+        if len(summary["errors"]) < IMPORT_MAX_ERRORS:
+            summary["errors"].append({"line": line_no, "error": message})
+        else:
+            summary["errors_truncated"] = True
+
+    async def flush(batch: List[Dict], first_line: int) -> None:
+        try:
+            await _insert_batch(db, owner_id, batch)
+        except Exception as exc:  # Report the batch and keep going with the next one
+            await db.rollback()
+            fail(first_line, f"batch of {len(batch)} rows starting here was not inserted: {exc.__class__.__name__}",
+                 count=len(batch))
+            return
+        summary["imported"] += len(batch)
+        summary["batches"] += 1
+        import_rows.inc("imported", amount=len(batch))
+
+    batch: List[Dict] = []
+    first_line = 0
+    records = _RECORD_READERS[fmt](_decoded_lines(chunks, gzipped))
+    try:
+        async for line_no, record, error in records:
+            if error is not None:
+                fail(line_no, error)
+                continue
+            try:
+                note = NoteCreate.model_validate(record)
+            except ValidationError as exc:
+                fail(line_no, "; ".join(
+                    f"{'.'.join(str(part) for part in err['loc'])}: {err['msg']}" for err in exc.errors()
+                ))
+                continue
+            if not batch:
+                first_line = line_no
+            batch.append({"title": note.title, "content": note.content, "owner_id": owner_id})
+            if len(batch) >= batch_size:
+                await flush(batch, first_line)
+                batch = []
+    except (RecordTooLarge, zlib.error) as exc:
+        fail(0, f"stopped reading the body: {exc}")
+    if batch:
+        await flush(batch, first_line)
+    return summary